@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Compares the time monitor cycle spends on logging with the synchronous and the queued log handlers.
+Usage: python -m bench.bench_logging [cycles] [messages per cycle] [write stall ms]
+The write stall emulates the SD card pausing the writes now and then (every 50th record).
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from src.utils import create_log_handlers, AsyncQueueHandler, ContextFilter, log_context
+
+
+class StallingHandler(logging.Handler):
+    def __init__(self, handler, stall_ms):
+        super().__init__(handler.level)
+        self.handler = handler
+        self.stall = stall_ms / 1000
+        self.written = 0
+
+    def emit(self, record):
+        self.written += 1
+        if self.stall and self.written % 50 == 0:
+            time.sleep(self.stall)
+        self.handler.emit(record)
+
+
+def run(handler, cycles, messages):
+    logger = logging.getLogger("bench-%s" % id(handler))
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    durations = []
+    for cycle in range(cycles):
+        started = time.perf_counter()
+        with log_context(line=1, state="IDLE"):
+            for i in range(messages):
+                logger.info("[DB] Get value for key '%s'" % "MONITOR_SLEPT_AT")
+        durations.append(time.perf_counter() - started)
+    durations.sort()
+    return sum(durations) / len(durations), durations[len(durations) * 95 // 100]
+
+
+def main(cycles=1000, messages=20, stall_ms=0):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for log_format in ["text", "json"]:
+            # console output is left out as it's usually not watched on the Pi
+            handlers = {}
+            for name in ["sync", "queued"]:
+                filename = os.path.join(tmp, "%s-%s.log" % (name, log_format))
+                handlers[name] = StallingHandler(create_log_handlers(filename, log_format)[1], stall_ms)
+            handlers["queued"] = AsyncQueueHandler([handlers["queued"]])
+            for name, handler in handlers.items():
+                handler.addFilter(ContextFilter())
+                avg, p95 = run(handler, cycles, messages)
+                results["logging.%s.%s" % (log_format, name)] = avg
+                print("%-6s %-6s avg %.3f ms, p95 %.3f ms per cycle (%d messages)" %
+                      (log_format, name, avg * 1000, p95 * 1000, messages))
+            handlers["queued"].close()
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
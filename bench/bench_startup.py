@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Measures the import time of the application modules, each time in the fresh interpreter (as after the restart),
+and lists the heavy third-party modules loaded by the import.
+Usage: python -m bench.bench_startup --<platform> [runs]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+MODULES = ["src.monitors", "main"]
+HEAVY = ["selenium", "telegram", "smpplib", "requests", "sqlite3worker"]
+
+CODE = """
+import json, sys, time
+started = time.perf_counter()
+import %s
+print(json.dumps({"seconds": time.perf_counter() - started, "loaded": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def import_time(module, platform, cwd):
+    output = subprocess.check_output([sys.executable, "-c", CODE % (module, HEAVY), platform], cwd=cwd,
+                                     env=dict(os.environ, PYTHONPATH=ROOT_DIR))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main(platform="--raspberry", runs=5):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:  # the log file is created on import
+        for module in MODULES:
+            samples = [import_time(module, platform, tmp) for _ in range(runs)]
+            seconds = statistics.median(sample["seconds"] for sample in samples)
+            results["import.%s" % module] = seconds
+            print("%-14s median %.3f sec of %d runs, heavy modules loaded: %s" %
+                  (module, seconds, runs, ", ".join(samples[-1]["loaded"]) or "none"))
+    return results
+
+
+if __name__ == '__main__':
+    main(*(sys.argv[1:2] + [int(arg) for arg in sys.argv[2:3]]))
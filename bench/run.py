@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Benchmark suite of the monitor running against the local GoIP simulator (bench/simulator.py).
+Usage: python -m bench.run --<platform> [--samples N] [--only name,...] [--lines N] [--real-sleeps]
+The platform goes first as for main.py (PhantomJS driver is taken from the current dir).
+The suite runs in the temporary dir, so the project DB and logs are not touched. Use the test bot secrets:
+bot messages are not sent anywhere, but the personal bot still polls the updates.
+Results are appended to bench/results.jsonl and compared to the previous run of the same platform.
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+RESULTS = os.path.join(BENCH_DIR, "results.jsonl")
+BENCHMARKS = ["poll_cycle", "call_detection", "ussd_round_trip", "sms_throughput", "reset_restore"]
+
+SentMessage = namedtuple("SentMessage", ["message_id"])
+
+
+def measure(samples, action):
+    durations = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        action()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Condition is not met in %.0f sec" % timeout)
+        time.sleep(0.001)
+
+
+class Suite:
+    def __init__(self, sim, samples):
+        from src.const import USER, PASS, SIP, SIP_PASS
+        from src.monitors import GoipMonitor, CallMonitor
+        self.sim = sim
+        self.samples = samples
+        self.goip = GoipMonitor(sim.address, USER, PASS, SIP, SIP_PASS)
+        self.cm = CallMonitor(self.goip)
+
+    def cycle(self):
+        from src.browser import BrowserWrapper
+        with BrowserWrapper.lock:
+            self.cm.monitor_cycle()
+
+    def poll_cycle(self):
+        self.cycle()  # warm-up
+        return {"poll_cycle": measure(self.samples, self.cycle)}
+
+    def call_detection(self):
+        """Time from the line state change at the GoIP till it's noticed by the state machine (cycles back-to-back)"""
+        monitor = self.cm.line_monitors[0]
+        started, finished = [], []
+        for i in range(self.samples):
+            self.sim.set_line(1, line_state="CONNECTED:05012345%02d" % i)
+            t = time.perf_counter()
+            while not monitor.call_started:
+                self.cycle()
+            started.append(time.perf_counter() - t)
+            self.sim.set_line(1, line_state="IDLE")
+            t = time.perf_counter()
+            while monitor.call_or_dialing_started():
+                self.cycle()
+            finished.append(time.perf_counter() - t)
+        return {"call_detection.start": started, "call_detection.finish": finished}
+
+    def ussd_round_trip(self):
+        from src.const import USSD_GENERAL_STATUS
+        from src.sms import SmsWrapper
+        return {"ussd_round_trip": measure(self.samples, lambda: SmsWrapper.sms.send_ussd(USSD_GENERAL_STATUS))}
+
+    def sms_throughput(self, messages=100):
+        """Seconds per message: SMPP submits (till all of them reach the GoIP) and HTTP line sends"""
+        from src.sms import SmsWrapper
+        results = {"sms_throughput.smpp": [], "sms_throughput.http": []}
+        for _ in range(self.samples):
+            expected = len(self.sim.sms_smpp) + messages
+            t = time.perf_counter()
+            for i in range(messages):
+                SmsWrapper.sms.send_sms("+380501234567", "Benchmark message %d" % i)
+            wait_for(lambda: len(self.sim.sms_smpp) >= expected)
+            results["sms_throughput.smpp"].append((time.perf_counter() - t) / messages)
+            t = time.perf_counter()
+            for i in range(messages):
+                SmsWrapper.sms.send_sms("+380501234567", "Benchmark message %d" % i, line=1)
+            results["sms_throughput.http"].append((time.perf_counter() - t) / messages)
+        return results
+
+    def reset_restore(self):
+        from src.browser import BrowserWrapper
+
+        def reset_and_restore():
+            with BrowserWrapper.lock:
+                self.goip.reset_and_restore()
+                BrowserWrapper.b.open_menu("Status")
+            if self.sim.line[1]["status_line"] != "Y" or not self.sim.smpp_enabled:
+                raise Exception("Configuration is not restored: %s" % self.sim.config)
+        return {"reset_restore": measure(max(1, self.samples // 10), reset_and_restore)}
+
+
+def summarise(durations):
+    durations = sorted(durations)
+    p95 = durations[min(len(durations) - 1, len(durations) * 95 // 100)]
+    return {"median": statistics.median(durations), "p95": p95, "samples": len(durations)}
+
+
+def previous_results(platform):
+    if not os.path.exists(RESULTS):
+        return None
+    with open(RESULTS, encoding="utf-8") as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    runs = [run for run in runs if run.get("platform") == platform]
+    return runs[-1] if runs else None
+
+
+def compare(results, previous, threshold):
+    """Prints the results next to the previous run, returns names of the regressed benchmarks"""
+    regressions = []
+    print("%-26s %10s %10s %10s %8s" % ("benchmark", "median ms", "p95 ms", "prev ms", "change"))
+    for name, result in sorted(results.items()):
+        prev = (previous or {}).get("results", {}).get(name)
+        change = ""
+        if prev and prev["median"]:
+            ratio = result["median"] / prev["median"] - 1
+            change = "%+.0f%%" % (100 * ratio)
+            if ratio > threshold:
+                regressions.append(name)
+                change += " !"
+        print("%-26s %10.2f %10.2f %10s %8s" % (name, result["median"] * 1000, result["p95"] * 1000,
+                                                 "%.2f" % (prev["median"] * 1000) if prev else "-", change))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("--raspberry", "--windows", "--mac"):
+        print(__doc__)
+        return 2
+    platform = sys.argv[1]
+    parser = argparse.ArgumentParser(description="GoIP monitor benchmarks against the local simulator")
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--only", default=",".join(BENCHMARKS))
+    parser.add_argument("--lines", type=int, default=1)
+    parser.add_argument("--http-port", type=int, default=8088)
+    parser.add_argument("--threshold", type=float, default=0.2, help="median slowdown reported as regression")
+    parser.add_argument("--real-sleeps", action="store_true", help="keep the waits for the GoIP to reboot/reset")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args(sys.argv[2:])
+
+    # everything the monitor writes (DB, logs, traces, screenshots) goes to the temp dir
+    work_dir = tempfile.mkdtemp(prefix="goip-bench-")
+    for name in ["phantomjs", "phantomjs.exe"]:
+        if os.path.exists(os.path.join(os.getcwd(), name)):
+            os.symlink(os.path.join(os.getcwd(), name), os.path.join(work_dir, name))
+    os.chdir(work_dir)
+    sys.path.insert(0, ROOT_DIR)
+    sys.argv = sys.argv[:2]  # src.const takes the platform from the first argument
+
+    from bench.simulator import GoipSimulator
+    from src.const import USER, PASS, SMPP_PORT, SMPP_USER, SMPP_SECRET
+    sim = GoipSimulator(lines=args.lines, http_port=args.http_port, smpp_port=SMPP_PORT, user=USER, pwd=PASS,
+                        smpp_user=SMPP_USER, smpp_secret=SMPP_SECRET).start()
+
+    started = time.perf_counter()
+    import src.monitors
+    import_seconds = time.perf_counter() - started
+    from src.app import App, bot
+    ids = itertools.count(1)
+    bot.outbox.deliver = lambda action, handle, text: SentMessage(next(ids))  # nothing is sent to Telegram
+    App.get("bot").connect = lambda: None
+    if not args.real_sleeps:
+        src.monitors.sleep = lambda *_, **__: None
+
+    started = time.perf_counter()
+    suite = Suite(sim, args.samples)
+    suite.cycle()
+    results = {"startup.import": summarise([import_seconds]),
+               "startup.first_poll": summarise([time.perf_counter() - started])}
+    for name in args.only.split(","):
+        started = time.perf_counter()
+        for result_name, durations in getattr(suite, name)().items():
+            results[result_name] = summarise(durations)
+        print("[Bench] %s done in %.1f sec" % (name, time.perf_counter() - started))
+    regressions = compare(results, previous_results(platform), args.threshold)
+    if not args.no_save:
+        with open(RESULTS, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.strftime("%Y-%m-%d %H:%M:%S"), "commit": git_commit(),
+                                "platform": platform, "lines": args.lines, "samples": args.samples,
+                                "results": results}) + "\n")
+    sim.stop()
+    if regressions:
+        print("Regressions (>%d%% slower): %s" % (100 * args.threshold, ", ".join(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Local stand-in for the GoIP gateway: the web UI pages used by the monitor (status page, config menus,
+reboot/reset), the HTTP SMS/USSD endpoints and the SMPP server. Only the standard library is used.
+Usage: python -m bench.simulator [http port] [lines] - then point IP in the secrets to 127.0.0.1:<http port>
+"""
+import base64
+import html
+import itertools
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+PAGES = "/default/en_US/"
+
+# USSD replies matching the regexes in src/sms.py
+USSD_REPLIES = {
+    "*101#": "Na vashem schete 95.50 grn. Taryf 'Simulator'. Nomer deystvitelen do 20.12.2030. Dyakuemo",
+    "*101*4#": "Bezlimit v merezhi ta 500 MB pidkliucheni. Zalyshok: 500 MB, 290 hv ta 50 SMS. Diie do 23.02.30",
+    "*365*1#": "Taryf 'Rik' diie do 12.12.30 vkliuchno",
+}
+
+SAVE = "Save Changes"
+
+
+def menus(lines):
+    """Fields of the config menus filled by GoipMonitor.restore_config(): (kind, id, options)"""
+    per_line = range(1, lines + 1)
+    return {
+        "Configurations": [("text", "time_zone", None), ("text", "ntp_server", None),
+                           ("radio", "auto_reboot_disable", None), ("radio", "ivr_enable_disable", None),
+                           ("radio", "smpp_enable_enable", None), ("text", "smpp_id", None),
+                           ("text", "smpp_key", None), ("text", "dtmf_min_gap", None)],
+        "Network": [("select", "pc_port_select", ["Router mode", "Bridge mode"])],
+        "Basic VoIP": [("text", name, None) for name in ["sip_auth_id", "sip_auth_passwd", "sip_registrar",
+                                                         "sip_phone_number", "sip_display_name"]],
+        "Advance VoIP": [("select", "sip_local_port_mode_select", ["Random", "Fixed"]),
+                         ("select", "sip_183_select", ["SIP 183", "SIP 180"])],
+        "Media": [("expand", "Audio Codec Preference", None)] +
+                 [("codec", name, None) for name in ["g729", "g729a", "g729ab", "g7231", "g711u", "g711a"]],
+        "Call Out": [("text", "gsm_outc_noans_t", None)],
+        "Call Out Auth": [("select", "line%d_fw2pstn_auth_mode_select" % n, ["Disable", "Whitelist", "Blacklist"])
+                          for n in per_line] + [("expand", "Whitelist/Blacklist", None)] +
+                         [("text", "l%d_voip_trust_num%d" % (n, i), None) for n in per_line for i in range(1, 5)],
+        "Call In": [("radio", "line%d_fw_to_voip_disable" % n, None) for n in per_line],
+        "SIM": [("radio", "gprs_disable", None), ("radio", "expiry_m_enable", None)] +
+               [(kind, "line%d_%s" % (n, name), None) for n in per_line
+                for kind, name in [("text", "gsm_num"), ("text", "gsm_pin2"), ("radio", "exp_drop_disable")]],
+        "Tools": [],
+        "User Management": [],
+    }
+
+
+class GoipSimulator:
+    """State of the simulated gateway. Benchmarks change the lines state right through set_line()."""
+    def __init__(self, lines=1, http_port=8088, smpp_port=7777, user="admin", pwd="admin", smpp_user="admin",
+                 smpp_secret="admin", default_pwd="admin", ussd_delay=0.0, listen="127.0.0.1"):
+        self.lines = lines
+        self.user = user
+        self.pwd = pwd
+        self.default_pwd = default_pwd
+        self.smpp_user = smpp_user
+        self.smpp_secret = smpp_secret
+        self.ussd_delay = ussd_delay
+        self.menus = menus(lines)
+        self.lock = threading.Lock()
+        self.booted_at = time.time()
+        self.config = {}
+        self.smpp_enabled = True
+        self.line = {n: {"line_state": "IDLE", "status_line": "Y", "gsm_sim": "Y", "gsm_status": "Y",
+                         "cdrt": time.strftime("%Y-%m-%d %H:%M:%S"), "cdrd": "0", "cdrn": ""}
+                     for n in range(1, lines + 1)}
+        self.ussd = {n: {"id": "", "status": "", "error": "", "ready_at": 0} for n in range(1, lines + 1)}
+        self.sms_http = []
+        self.sms_smpp = []
+        self.counters = {"requests": 0, "saves": 0, "reboots": 0, "resets": 0, "ussd": 0, "smpp_binds": 0}
+        simulator = self
+
+        class HttpHandler(SimulatorHttpHandler):
+            sim = simulator
+
+        self.httpd = ThreadingHTTPServer((listen, http_port), HttpHandler)
+        self.httpd.daemon_threads = True
+
+        class SmppHandler(SimulatorSmppHandler):
+            sim = simulator
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.smppd = socketserver.ThreadingTCPServer((listen, smpp_port), SmppHandler)
+        self.smppd.daemon_threads = True
+
+    @property
+    def address(self):
+        return "%s:%d" % self.httpd.server_address
+
+    def start(self):
+        for server, name in [(self.httpd, "SimulatorHttp"), (self.smppd, "SimulatorSmpp")]:
+            threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in [self.httpd, self.smppd]:
+            server.shutdown()
+            server.server_close()
+
+    def set_line(self, line=1, **fields):
+        with self.lock:
+            self.line[line].update(fields)
+
+    def add_call_record(self, line, number, seconds, started=None):
+        """Sets the last call record of the line as GoIP does once the call is over"""
+        started = started or time.time() - seconds
+        self.set_line(line, cdrt=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)), cdrd=str(seconds),
+                      cdrn=number)
+
+    def uptime(self):
+        return int(time.time() - self.booted_at)
+
+    def reboot(self):
+        with self.lock:
+            self.counters["reboots"] += 1
+            self.booted_at = time.time()
+            for status in self.line.values():
+                status.update(line_state="IDLE", cdrt=time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    def reset(self):
+        with self.lock:
+            self.counters["resets"] += 1
+            self.booted_at = time.time()
+            self.pwd = self.default_pwd
+            self.config = {}
+            self.smpp_enabled = False  # as the real GoIP does after the reset
+            for status in self.line.values():
+                status.update(line_state="IDLE", status_line="0")
+
+    def save(self, menu, fields):
+        with self.lock:
+            self.counters["saves"] += 1
+            self.config.update(fields)
+            if menu == "Configurations":
+                self.smpp_enabled = fields.get("smpp_enable") == "enable"
+            if menu == "Basic VoIP" and fields.get("sip_auth_id") and fields.get("sip_auth_passwd"):
+                for status in self.line.values():
+                    status["status_line"] = "Y"
+
+    def start_ussd(self, line, key, code):
+        with self.lock:
+            self.counters["ussd"] += 1
+            self.ussd[line] = {"id": key, "status": "STARTED", "ready_at": time.time() + self.ussd_delay,
+                               "error": USSD_REPLIES.get(code, "Unknown USSD request %s" % code)}
+
+
+class SimulatorHttpHandler(BaseHTTPRequestHandler):
+    sim = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def authorized(self, query):
+        if query.get("u") == self.sim.user and query.get("p") == self.sim.pwd:
+            return True
+        auth = self.headers.get("Authorization", "")
+        expected = "%s:%s" % (self.sim.user, self.sim.pwd)
+        return auth == "Basic %s" % base64.b64encode(expected.encode("utf-8")).decode("utf-8")
+
+    def do_GET(self):
+        self.handle_request(None)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        self.handle_request({name: values[-1] for name, values in parse_qs(body, keep_blank_values=True).items()})
+
+    def handle_request(self, form):
+        self.sim.counters["requests"] += 1
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path in ("/", "/default", PAGES[:-1]):
+            return self.reply(302, "", headers={"Location": PAGES + "status.html"})
+        if not url.path.startswith(PAGES):
+            return self.reply(404, "Not found")
+        if not self.authorized(query):
+            return self.reply(401, "<html><body>401 Unauthorized</body></html>",
+                              headers={"WWW-Authenticate": 'Basic realm="Web Server Authentication"'})
+        page = url.path[len(PAGES):]
+        if page == "status.html":
+            return self.reply(200, self.status_page())
+        if page == "config.html":
+            menu = query.get("menu", "Tools")
+            if form is not None:
+                self.sim.save(menu, form)
+            return self.reply(200, self.config_page(menu))
+        if page == "user.html":
+            if form and form.get("passwd") and form.get("passwd") == form.get("confirm_passwd"):
+                self.sim.pwd = form["passwd"]
+            return self.reply(200, self.config_page("User Management"))
+        if page == "reboot.html":
+            self.sim.reboot()
+            return self.reply(200, "<html><body>Rebooting...</body></html>")
+        if page == "reset_config.html":
+            self.sim.reset()
+            return self.reply(200, "<html><body>Resetting...</body></html>")
+        if page == "sms_info.html" and form is not None:
+            line = next((int(name[4:]) for name in form if name.startswith("line") and name[4:].isdigit()), 1)
+            self.sim.start_ussd(line, form.get("smskey", ""), form.get("telnum", ""))
+            return self.reply(200, "<html><body>Sending...</body></html>")
+        if page == "send_status.xml":
+            return self.reply(200, self.ussd_status(), content_type="text/xml")
+        if page == "send.html":
+            with self.sim.lock:
+                self.sim.sms_http.append((int(query.get("l", 1)), query.get("n"), query.get("m")))
+                sms_id = len(self.sim.sms_http)
+            return self.reply(200, "Sending,L%s Send SMS to:%s; ID:%08x" % (query.get("l"), query.get("n"), sms_id),
+                              content_type="text/plain")
+        return self.reply(404, "Not found")
+
+    def reply(self, code, text, content_type="text/html", headers=None):
+        body = text.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "%s; charset=utf-8" % content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def menu(self):
+        items = ['<div class="title" onclick="location.href=\'status.html\'">Status</div>']
+        for name in self.sim.menus:
+            items.append('<div class="title" onclick="location.href=\'config.html?menu=%s\'">%s</div>' %
+                         (name.replace(" ", "+"), name))
+        return "\n".join(items)
+
+    def status_page(self):
+        with self.sim.lock:
+            rows = []
+            for n, status in sorted(self.sim.line.items()):
+                rows.append("<tr>%s</tr>" % "".join('<td id="l%d_%s">%s</td>' % (n, field, html.escape(value))
+                                                     for field, value in sorted(status.items())))
+        return "<html><head><script>var uptime_s = %d;</script></head><body>%s<table>%s</table></body></html>" % \
+               (self.sim.uptime(), self.menu(), "\n".join(rows))
+
+    def config_page(self, menu):
+        if menu == "User Management":
+            form = ("<table><tr><td>Administration Level</td></tr><tr><td>"
+                    '<form name="form2" method="POST" action="user.html">'
+                    '<input type="password" name="passwd"><input type="password" name="confirm_passwd">'
+                    '<input type="submit" value="Change"></form></td></tr></table>')
+            return "<html><body>%s%s</body></html>" % (self.menu(), form)
+        fields = []
+        for kind, name, options in self.sim.menus.get(menu, []):
+            value = html.escape(self.sim.config.get(name, ""))
+            if kind == "text":
+                fields.append('<input type="text" id="%s" name="%s" value="%s">' % (name, name, value))
+            elif kind == "radio":
+                group, choice = name.rsplit("_", 1)
+                fields.append('<input type="radio" id="%s" name="%s" value="%s">' % (name, group, choice))
+            elif kind == "select":
+                fields.append('<select id="%s" name="%s">%s</select>' % (
+                    name, name[:-len("_select")], "".join("<option>%s</option>" % o for o in options)))
+            elif kind == "expand":
+                fields.append('<div style="cursor:hand">%s</div>' % name)
+            elif kind == "codec":
+                fields.append('<div class="audiocodec"><input type="checkbox" name="codec_%s" value="1" checked>'
+                              '<span class="codec_name">%s</span></div>' % (name, name))
+        if fields:
+            fields.append('<input type="button" value="UP">' if menu == "Media" else "")
+            fields.append('<input type="submit" value="%s">' % SAVE)
+        return '<html><body>%s<form method="POST" action="config.html?menu=%s">%s</form></body></html>' % \
+               (self.menu(), menu.replace(" ", "+"), "\n".join(fields))
+
+    def ussd_status(self):
+        items = []
+        with self.sim.lock:
+            for n, ussd in sorted(self.sim.ussd.items()):
+                done = ussd["id"] and time.time() >= ussd["ready_at"]
+                items.append("<id%d>%s</id%d><status%d>%s</status%d><error%d>%s</error%d>" % (
+                    n, ussd["id"], n, n, "DONE" if done else ussd["status"], n,
+                    n, html.escape(ussd["error"]) if done else "", n))
+        return '<?xml version="1.0" encoding="utf-8"?><send-sms-status>%s</send-sms-status>' % "".join(items)
+
+
+# SMPP v3.4 command ids
+BIND_RECEIVER, BIND_TRANSMITTER, SUBMIT_SM, UNBIND, BIND_TRANSCEIVER, ENQUIRE_LINK = 0x1, 0x2, 0x4, 0x6, 0x9, 0x15
+GENERIC_NACK, RESP = 0x80000000, 0x80000000
+ESME_ROK, ESME_RINVCMDID, ESME_RBINDFAIL = 0x0, 0x3, 0xD
+
+
+def c_string(body, offset):
+    end = body.index(b"\0", offset)
+    return body[offset:end].decode("latin-1"), end + 1
+
+
+def parse_submit_sm(body):
+    offset = c_string(body, 0)[1] + 2  # service_type, source_addr_ton/npi
+    source, offset = c_string(body, offset)
+    destination, offset = c_string(body, offset + 2)
+    offset += 3  # esm_class, protocol_id, priority_flag
+    offset = c_string(body, c_string(body, offset)[1])[1]  # schedule_delivery_time, validity_period
+    data_coding, length = body[offset + 2], body[offset + 4]
+    return source, destination, data_coding, body[offset + 5:offset + 5 + length]
+
+
+class SimulatorSmppHandler(socketserver.BaseRequestHandler):
+    sim = None
+    _message_ids = itertools.count(1)
+
+    def read(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def send_pdu(self, command_id, status, sequence, body=b""):
+        self.request.sendall(struct.pack(">IIII", 16 + len(body), command_id, status, sequence) + body)
+
+    def handle(self):
+        bound = False
+        try:
+            while True:
+                length, command_id, _, sequence = struct.unpack(">IIII", self.read(16))
+                body = self.read(length - 16)
+                if command_id in (BIND_RECEIVER, BIND_TRANSMITTER, BIND_TRANSCEIVER):
+                    system_id, offset = c_string(body, 0)
+                    password, _ = c_string(body, offset)
+                    bound = self.sim.smpp_enabled and (system_id, password) == \
+                        (self.sim.smpp_user, self.sim.smpp_secret)
+                    self.sim.counters["smpp_binds"] += bound
+                    self.send_pdu(RESP | command_id, ESME_ROK if bound else ESME_RBINDFAIL, sequence, b"GoIP\0")
+                elif command_id == SUBMIT_SM and bound:
+                    source, destination, data_coding, message = parse_submit_sm(body)
+                    with self.sim.lock:
+                        self.sim.sms_smpp.append((source, destination, data_coding, message))
+                    self.send_pdu(RESP | SUBMIT_SM, ESME_ROK, sequence, b"%d\0" % next(self._message_ids))
+                elif command_id == ENQUIRE_LINK:
+                    self.send_pdu(RESP | ENQUIRE_LINK, ESME_ROK, sequence)
+                elif command_id == UNBIND:
+                    self.send_pdu(RESP | UNBIND, ESME_ROK, sequence)
+                    return
+                elif not command_id & RESP:  # responses of the client (e.g. deliver_sm_resp) are ignored
+                    self.send_pdu(GENERIC_NACK, ESME_RINVCMDID, sequence)
+        except (EOFError, ConnectionError, socket.error):
+            return
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    sim = GoipSimulator(http_port=args[0] if args else 8088, lines=args[1] if len(args) > 1 else 1).start()
+    print("GoIP simulator is listening on %s (SMPP port %d)" % (sim.address, sim.smppd.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -1,16 +1,27 @@
 #!/usr/bin/env python
 # coding=utf-8
+import atexit
 import threading
 
 from src.const import IP, USER, PASS, SIP, SIP_PASS
+from src.events import EventBus
+from src.exporter import MetricsExporter
 from src.monitors import GoipMonitor, CallMonitor
+from src.profiler import Profiler
+from src.supervisor import Supervisor
 from src.utils import safe
+from src.watchdog import Watchdog
 
 
 @safe(msg="Я впав та не можу піднятись. Поможіть!")
 def main():
+    MetricsExporter.start()
+    Profiler.install_signal()
     goip = GoipMonitor(IP, USER, PASS, SIP, SIP_PASS)
     cm = CallMonitor(goip)
+    atexit.register(EventBus.flush)  # registered after the bot outbox, so it's run before the outbox is flushed
+    Supervisor.start()
+    Watchdog.start()
     t = threading.Thread(target=cm.monitor, daemon=True)
     t.start()
     t.join()
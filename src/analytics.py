@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# coding=utf-8
+import json
+import logging
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from src.app import vs
+from src.cdr import normalize_number
+from src.const import CUR_DIR, ANALYTICS_CACHE, ANALYTICS_TOP, ANALYTICS_MIN_CALLS, ANALYTICS_CACHE_LAG_DAYS
+from src.metrics import timed
+from src.utils import log, current_date, seconds_to_time_str
+
+# columns of the call history: start time (seconds since 1970 in the local time), line, duration, whether the call
+# was answered and the id of the number (normalized, so the same subscriber has the single id whatever the format)
+COLUMNS = {"started": np.int64, "line": np.int16, "seconds": np.int32, "ok": np.bool_, "number": np.int32}
+EPOCH = datetime(1970, 1, 1)
+
+
+def epoch_seconds(dt):
+    return int((dt - EPOCH).total_seconds())
+
+
+def empty_columns():
+    return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def to_columns(calls, numbers, ids):
+    """Columns of the calls returned by Storage.calls(). New numbers are added to the numbers list and ids"""
+    if not calls:
+        return empty_columns()
+    lines, started, number, seconds, ok, _ = zip(*calls)
+    number_ids = []
+    for n in number:
+        n = normalize_number(n)
+        if n not in ids:
+            ids[n] = len(numbers)
+            numbers.append(n)
+        number_ids.append(ids[n])
+    return {"started": np.array(started, dtype="datetime64[s]").astype(np.int64),
+            "line": np.array(lines, dtype=COLUMNS["line"]),
+            "seconds": np.array(seconds, dtype=COLUMNS["seconds"]),
+            "ok": np.array(ok, dtype=COLUMNS["ok"]),
+            "number": np.array(number_ids, dtype=COLUMNS["number"])}
+
+
+def display_number(number):
+    if not number:
+        return "невідомо"
+    return "0%s" % number if len(number) == 9 else number  # normalized numbers are shown in the local format
+
+
+def concat(*parts):
+    return {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+
+
+class CallHistory:
+    """Call history (the 'calls' table) as the columnar arrays. The days older than ANALYTICS_CACHE_LAG_DAYS are
+    cached to the .npy files which are memory-mapped, so only the days after the cached ones are read from the DB.
+    The recent days are read on each request as the calls might still be added to them.
+    """
+    _dir = os.path.join(CUR_DIR, ANALYTICS_CACHE)
+    _cached = None  # columns of the calls before `_till`
+    _till = None  # the first day which is not cached
+    _numbers = []
+    _ids = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _path(cls, name):
+        return os.path.join(cls._dir, name)
+
+    @classmethod
+    def _load_cache(cls, till):
+        cls._cached, cls._till, cls._numbers, cls._ids = empty_columns(), EPOCH, [], {}
+        try:
+            with open(cls._path("meta.json")) as f:
+                meta = json.load(f)
+            cached = {name: np.load(cls._path("%s.npy" % name), mmap_mode="r") for name in COLUMNS}
+        except (OSError, ValueError) as e:
+            log.info("[Analytics] No call history cache (%s) - building it from the DB" % e)
+            return
+        if len({len(column) for column in cached.values()}) != 1 or len(cached["started"]) != meta["rows"]:
+            log.warning("[Analytics] Call history cache is inconsistent - building it from the DB")
+            return
+        if datetime.strptime(meta["till"], "%Y-%m-%d") > till:
+            log.warning("[Analytics] Call history cache has the recent days - building it from the DB")
+            return
+        cls._cached, cls._numbers = cached, meta["numbers"]
+        cls._till = datetime.strptime(meta["till"], "%Y-%m-%d")
+        cls._ids = {number: i for i, number in enumerate(cls._numbers)}
+
+    @classmethod
+    def _save_cache(cls):
+        os.makedirs(cls._dir, exist_ok=True)
+        for name, column in cls._cached.items():
+            with open(cls._path("%s.npy.tmp" % name), "wb") as f:
+                np.save(f, column)
+            os.replace(cls._path("%s.npy.tmp" % name), cls._path("%s.npy" % name))
+        # meta is written the last - it tells the columns are complete
+        with open(cls._path("meta.json.tmp"), "w") as f:
+            json.dump({"till": cls._till.strftime("%Y-%m-%d"), "rows": len(cls._cached["started"]),
+                       "numbers": cls._numbers}, f)
+        os.replace(cls._path("meta.json.tmp"), cls._path("meta.json"))
+        cls._cached = {name: np.load(cls._path("%s.npy" % name), mmap_mode="r") for name in COLUMNS}
+
+    @classmethod
+    def columns(cls):
+        """Returns the columns of all the calls till now and the numbers list (the number column has its indexes)"""
+        today = current_date().replace(hour=0, minute=0, second=0, microsecond=0)
+        till = today - timedelta(days=ANALYTICS_CACHE_LAG_DAYS)
+        with cls._lock:
+            if cls._cached is None:
+                cls._load_cache(till)
+            if cls._till < till:
+                new = to_columns(vs.calls(cls._till, till), cls._numbers, cls._ids)
+                log.info("[Analytics] Caching %d call(s) since %s" % (len(new["started"]), cls._till.date()))
+                cls._cached, cls._till = concat(cls._cached, new), till
+                cls._save_cache()
+            current = to_columns(vs.calls(cls._till, today + timedelta(days=1)), cls._numbers, cls._ids)
+            return concat(cls._cached, current), list(cls._numbers)
+
+
+def select(columns, days=None, line=None):
+    """Columns of the calls of the last `days` days (including today) of the line (all lines if None)"""
+    mask = np.ones(len(columns["started"]), dtype=bool)
+    if days:
+        since = current_date().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+        mask &= columns["started"] >= epoch_seconds(since)
+    if line:
+        mask &= columns["line"] == line
+    return {name: column[mask] for name, column in columns.items()}
+
+
+def talk_seconds(columns):
+    return np.where(columns["ok"], columns["seconds"], 0)
+
+
+def busiest_hours(columns, top=ANALYTICS_TOP):
+    """Returns [(hour, calls, talk seconds)] of the hours with the most calls"""
+    hours = (columns["started"] // 3600) % 24
+    calls = np.bincount(hours, minlength=24)
+    talk = np.bincount(hours, weights=talk_seconds(columns), minlength=24)
+    order = np.lexsort((-talk, -calls))[:top]  # the last key is the primary one
+    return [(int(hour), int(calls[hour]), int(talk[hour])) for hour in order if calls[hour]]
+
+
+def top_numbers(columns, numbers, top=ANALYTICS_TOP):
+    """Returns [(number, talk seconds, calls)] of the numbers with the most talk time"""
+    calls = np.bincount(columns["number"], minlength=len(numbers))
+    talk = np.bincount(columns["number"], weights=talk_seconds(columns), minlength=len(numbers))
+    order = np.argsort(-talk, kind="stable")[:top]
+    return [(numbers[i], int(talk[i]), int(calls[i])) for i in order if talk[i]]
+
+
+def call_length(columns):
+    """Returns (median, p95) duration of the answered calls, None if there are no such calls"""
+    seconds = columns["seconds"][columns["ok"]]
+    if not len(seconds):
+        return None
+    median, p95 = np.percentile(seconds, [50, 95])
+    return int(median), int(p95)
+
+
+def failure_rates(columns, numbers, top=ANALYTICS_TOP, min_calls=ANALYTICS_MIN_CALLS):
+    """Returns [(number, failed share, calls)] of the numbers failed the most (called at least min_calls times)"""
+    calls = np.bincount(columns["number"], minlength=len(numbers))
+    failed = np.bincount(columns["number"], weights=~columns["ok"], minlength=len(numbers))
+    rate = failed / np.maximum(calls, 1)
+    candidates = np.flatnonzero((calls >= min_calls) & (failed > 0))
+    order = candidates[np.lexsort((-calls[candidates], -rate[candidates]))][:top]
+    return [(numbers[i], float(rate[i]), int(calls[i])) for i in order]
+
+
+@timed("analytics.report")
+def report(days=None, line=None):
+    columns, numbers = CallHistory.columns()
+    columns = select(columns, days=days, line=line)
+    calls = len(columns["started"])
+    period = "за %d дні(в)" % days if days else "за весь час"
+    string = "Дзвінків %s: %d (%d успішних)\n" % (period, calls, int(np.count_nonzero(columns["ok"])))
+    if not calls:
+        return string
+    string += "Розмов %s\n" % seconds_to_time_str(int(talk_seconds(columns).sum()), no_seconds=True)
+    length = call_length(columns)
+    if length:
+        string += "Тривалість розмови: медіана %s, p95 %s\n" % tuple(seconds_to_time_str(s) for s in length)
+    string += "\nГодини з найбільшою кількістю дзвінків:\n"
+    for hour, hour_calls, talk in busiest_hours(columns):
+        string += "%02d:00 - %d дзв., %s\n" % (hour, hour_calls, seconds_to_time_str(talk, no_seconds=True))
+    string += "\nНайдовше говорили з:\n"
+    for number, talk, number_calls in top_numbers(columns, numbers):
+        string += "%s - %s (%d дзв.)\n" % (display_number(number),
+                                          seconds_to_time_str(talk, no_seconds=True).strip(), number_calls)
+    failures = failure_rates(columns, numbers)
+    if failures:
+        string += "\nНайчастіше невдалі дзвінки до:\n"
+        for number, rate, number_calls in failures:
+            string += "%s - %d%% з %d дзв.\n" % (display_number(number), 100 * rate, number_calls)
+    return string
+
+
+if __name__ == '__main__':
+    # python -m src.analytics [days] [line]
+    args = sys.argv[1:]
+    log.setLevel(logging.WARNING)
+    print(report(days=int(args[0]) if args and int(args[0]) > 0 else None,
+                 line=int(args[1]) if len(args) > 1 else None))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding=utf-8
+import importlib
+import threading
+import time
+
+from src.utils import log
+
+
+class App:
+    """Container of the application components. Each component is built on its first use rather than at import
+    time, so importing the modules is cheap and the startup does only the work which is actually needed.
+    Factories given as 'module:callable' strings are imported on the first use as well.
+    """
+    _factories = {}
+    _components = {}
+    _locks = {}
+    _lock = threading.Lock()
+    timings = {}  # name => seconds it took to build the component
+
+    @classmethod
+    def register(cls, name, factory):
+        with cls._lock:
+            cls._factories[name] = factory
+            cls._locks.setdefault(name, threading.RLock())
+
+    @classmethod
+    def lazy(cls, name, factory):
+        """Registers the component and returns the proxy building it on the first attribute access."""
+        cls.register(name, factory)
+        return Lazy(name)
+
+    @classmethod
+    def built(cls, name):
+        return name in cls._components
+
+    @classmethod
+    def get(cls, name):
+        component = cls._components.get(name)
+        if component is not None:
+            return component
+        with cls._locks[name]:  # components are built independently, so the slow ones don't block the rest
+            if name not in cls._components:
+                factory = cls._factories[name]
+                if isinstance(factory, str):
+                    module, attr = factory.split(":")
+                    factory = getattr(importlib.import_module(module), attr)
+                started = time.perf_counter()
+                cls._components[name] = factory()
+                cls.timings[name] = time.perf_counter() - started
+                log.info("[App] Built '%s' in %.3f sec" % (name, cls.timings[name]))
+            return cls._components[name]
+
+
+class Lazy:
+    __slots__ = ("_name", )
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(App.get(self._name), attr)
+
+    def __repr__(self):
+        return "<lazy '%s'%s>" % (self._name, "" if App.built(self._name) else " (not built)")
+
+
+# the application-wide components (modules defining them re-export these as before)
+vs = App.lazy("storage", "src.db:Storage")
+bot = App.lazy("bot", "src.bot.common:CommonBot")
+pbot = App.lazy("personal_bot", "src.bot.personal:PersonalBot")
+scheduler = App.lazy("scheduler", "src.scheduler:Scheduler")
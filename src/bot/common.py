@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 # coding=utf-8
+import atexit
 import html
-import telegram
-from telegram.parsemode import ParseMode
-from telegram.utils.request import Request
 
+from src.bot.outbox import Outbox, MessageHandle, SEND, EDIT, NORMAL, LOW
 from src.const import TEL_KEY, TEL_CHAT, IS_PROD
+from src.metrics import timed
 
 
 class CommonBot:
@@ -15,31 +15,54 @@ class CommonBot:
     msg_append = "" if IS_PROD else " (ТЕСТ)"
 
     def __init__(self, token=TEL_KEY, chat_id=TEL_CHAT):
+        import telegram
+        from telegram.utils.request import Request
         request = Request(con_pool_size=4+6)  # 4 - used by default threads, 6 - extra capacity == 10 (8 recommended)
         self._bot = telegram.Bot(token=token, request=request)
         self.default_msg_params = {"chat_id": chat_id}
+        self.outbox = Outbox(deliver=self._deliver)
+        atexit.register(self.outbox.flush)
 
     @safe()
-    def send(self, text, escape=False):
+    @timed("bot.send")
+    def send(self, text, escape=False, priority=NORMAL, handle=None):
+        """Queues the message and returns its MessageHandle (to be used for the later edits) right away."""
         self.log.info("[Bot] Send message text: %s" % text)
         if escape:
             text = html.escape(text)
+        return self.outbox.put(SEND, handle or MessageHandle(), text, priority=priority,
+                               chat=self.default_msg_params["chat_id"])
+
+    @safe()
+    @timed("bot.edit")
+    def edit(self, msg, text, priority=LOW):
+        import telegram
+        if isinstance(msg, telegram.Message):
+            msg = MessageHandle(msg)
+        if not isinstance(msg, MessageHandle):
+            raise Exception("Incorrect param type (expected MessageHandle): %s" % msg)
+        self.log.info("[Bot] Edit message %s, new text: '%s'" % (msg, text))
+        return self.outbox.put(EDIT, msg, text, priority=priority, chat=self.default_msg_params["chat_id"])
+
+    def connect(self):
+        """Opens the connection to the Bot API in advance, so the first message is not delayed by it."""
+        try:
+            me = self._bot.get_me()
+            self.log.info("[Bot] Connected as @%s" % me.username)
+        except Exception as e:  # messages are queued by the outbox till the connection is back
+            self.log.error("[Bot] Unable to connect: %s" % e)
+
+    def _deliver(self, action, handle, text):
+        from telegram.parsemode import ParseMode
+        if action == EDIT:
+            msg = self._bot.edit_message_text(message_id=handle.message_id,
+                                              text="%s%s" % (text, self.msg_append),
+                                              **self.default_msg_params)
+            self.log.info("[Bot] Edit message result: %s" % msg)
+            return msg
         msg = self._bot.send_message(text="%s%s" % (text, self.msg_append),
                                      parse_mode=ParseMode.HTML,
                                      **self.default_msg_params)
         self.log.info("[Bot] Send message result: %s" % msg)
         return msg
 
-    @safe()
-    def edit(self, msg, text):
-        if not isinstance(msg, telegram.Message):
-            raise Exception("Incorrect param type (expected telegram.Message): %s" % msg)
-        self.log.info("[Bot] Edit message %s, new text: '%s'" % (msg, text))
-        msg = self._bot.edit_message_text(message_id=msg.message_id,
-                                          text="%s%s" % (text, self.msg_append),
-                                          **self.default_msg_params)
-        self.log.info("[Bot] Edit message result: %s" % msg)
-        return msg
-
-
-bot = CommonBot()
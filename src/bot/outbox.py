@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# coding=utf-8
+import itertools
+import os
+import threading
+import time
+from collections import namedtuple
+
+from src.const import OUTBOX_SIZE, OUTBOX_RETRIES, OUTBOX_FLUSH_SECONDS, BOT_CHAT_RATE, BOT_CHAT_BURST, \
+    BOT_GLOBAL_RATE, BOT_GLOBAL_BURST
+from src.metrics import Metrics
+from src.utils import log
+
+# priorities of the outgoing messages (lower value is delivered first and dropped last)
+HIGH, NORMAL, LOW = range(3)
+
+SEND, EDIT = "send", "edit"
+
+DeliveredMessage = namedtuple("DeliveredMessage", ["message_id"])
+
+
+class MessageHandle:
+    """Placeholder of the message which is (or will be) delivered by the outbox.
+    Could be passed to CommonBot.edit() right away - even before the message itself is delivered.
+    """
+    def __init__(self, message=None):
+        self.message = message
+        self.dropped = False
+        self._delivered = threading.Event()
+        if message is not None:
+            self._delivered.set()
+
+    @property
+    def message_id(self):
+        return self.message.message_id if self.message is not None else None
+
+    def resolved(self):
+        return self._delivered.is_set()
+
+    def resolve(self, message):
+        self.message = message
+        self.dropped = False
+        self._delivered.set()
+
+    def wait(self, timeout=None):
+        self._delivered.wait(timeout)
+        return self.message
+
+    @classmethod
+    def from_id(cls, message_id):
+        """Handle of the message delivered earlier (e.g. by the previous run of the application)."""
+        return cls(DeliveredMessage(message_id))
+
+    def __repr__(self):
+        return "MessageHandle(message_id=%s, dropped=%s)" % (self.message_id, self.dropped)
+
+
+class TokenBucket:
+    """Allows `rate` messages per second on average with bursts of up to `capacity` messages."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now):
+        """Seconds to wait till the next token is available (0 if it's available right now)."""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutgoingMessage:
+    _seq = itertools.count()
+
+    def __init__(self, action, handle, text, priority, kwargs, chat=None):
+        self.action = action
+        self.chat = chat
+        self.handle = handle
+        self.text = text
+        self.priority = priority
+        self.kwargs = kwargs
+        self.seq = next(self._seq)
+        self.queued_at = time.monotonic()
+        self.tries = 0
+
+    def sort_key(self):
+        return self.priority, self.seq
+
+    def __repr__(self):
+        return "OutgoingMessage(%s, %s, priority=%d)" % (self.action, self.handle, self.priority)
+
+
+class Outbox:
+    """Bounded queue of the outgoing bot messages drained by the background worker thread.
+    Pending edits of the same message are merged, so only the latest text is sent. Delivery is throttled by
+    the per-chat and global token buckets to stay within Telegram limits. On overflow the least important
+    message is dropped.
+    """
+    def __init__(self, deliver, size=OUTBOX_SIZE, retries=OUTBOX_RETRIES):
+        self.deliver = deliver
+        self.size = size
+        self.retries = retries
+        self.delivered = 0
+        self.dropped = 0
+        self.latency_max = 0.0
+        self.latency_sum = 0.0
+        self.merged = 0
+        self.throttled = 0
+        self.global_bucket = TokenBucket(BOT_GLOBAL_RATE, BOT_GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.blocked_until = {}  # chat => time till which Telegram asked us to hold off (retry_after)
+        self._pid = None
+
+    def _ensure_worker(self):
+        # the worker thread is not inherited by the forked processes (SMPP listener), so each gets its own one
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._items = []
+        self._busy = False
+        threading.Thread(target=self._work, name="BotOutbox", daemon=True).start()
+
+    def put(self, action, handle, text, priority=NORMAL, chat=None, **kwargs):
+        self._ensure_worker()
+        item = OutgoingMessage(action, handle, text, priority, kwargs, chat=chat)
+        with self._cond:
+            if self._merge(item):
+                return handle
+            if len(self._items) >= self.size:
+                if not self._drop_less_important(item):
+                    log.warning("[Outbox] Queue is full - dropping %s" % item)
+                    self._drop(item)
+                    return handle
+            self._items.append(item)
+            self._cond.notify()
+        return handle
+
+    def _merge(self, item):
+        if item.action != EDIT:
+            return False
+        # the edit replaces the text of the pending edit or even of the message which is not sent yet
+        for pending in self._items:
+            if pending.handle is item.handle:
+                log.info("[Outbox] Merging edit into the pending %s" % pending)
+                pending.text = item.text
+                pending.kwargs = item.kwargs
+                pending.priority = min(pending.priority, item.priority)
+                self.merged += 1
+                return True
+        return False
+
+    def _drop_less_important(self, item):
+        victim = max(self._items, key=lambda pending: pending.sort_key())
+        if victim.priority <= item.priority:
+            return False
+        log.warning("[Outbox] Queue is full - dropping %s" % victim)
+        self._items.remove(victim)
+        self._drop(victim)
+        return True
+
+    def _drop(self, item):
+        self.dropped += 1
+        if item.handle is not None and item.action == SEND:
+            item.handle.dropped = True
+
+    def _chat_bucket(self, chat):
+        if chat not in self.chat_buckets:
+            self.chat_buckets[chat] = TokenBucket(BOT_CHAT_RATE, BOT_CHAT_BURST)
+        return self.chat_buckets[chat]
+
+    def _next_item(self):
+        """Returns the next message allowed to go out right now and the seconds to wait if there is no such one."""
+        now = time.monotonic()
+        wait = None
+        for item in sorted(self._items, key=lambda pending: pending.sort_key()):
+            # edits are held back while the message they are editing is still on its way
+            if item.action == EDIT and not (item.handle.resolved() or item.handle.dropped):
+                continue
+            chat_bucket = self._chat_bucket(item.chat)
+            delay = max(self.blocked_until.get(item.chat, 0) - now, chat_bucket.delay(now),
+                        self.global_bucket.delay(now))
+            if delay <= 0:
+                chat_bucket.take(now)
+                self.global_bucket.take(now)
+                self._items.remove(item)
+                return item, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                item, wait = self._next_item()
+                while item is None:
+                    self._cond.wait(timeout=wait or 1)
+                    item, wait = self._next_item()
+                self._busy = True
+            try:
+                self._process(item)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _process(self, item):
+        from telegram.error import NetworkError, BadRequest, RetryAfter
+        action = item.action
+        if action == EDIT and item.handle.dropped and not item.handle.resolved():
+            action = SEND  # original message never left, so deliver the latest text as a new one
+        while True:
+            item.tries += 1
+            try:
+                message = self.deliver(action, item.handle, item.text, **item.kwargs)
+                break
+            except RetryAfter as e:
+                # put the message back and hold off the whole chat - other chats are still served meanwhile
+                log.warning("[Outbox] Flood control - retrying %s in %s seconds" % (item, e.retry_after))
+                with self._cond:
+                    self.throttled += 1
+                    self.blocked_until[item.chat] = time.monotonic() + e.retry_after
+                    item.tries -= 1  # flood control is not a delivery failure
+                    # newer edit of the same message could be queued meanwhile - it's the one to be sent then
+                    if item.action == SEND or not any(pending.handle is item.handle for pending in self._items):
+                        self._items.append(item)
+                return
+            except BadRequest as e:
+                log.error("[Outbox] Message %s was rejected: %s" % (item, e))
+                return self._failed(item, action)
+            except NetworkError as e:
+                if item.tries >= self.retries:
+                    log.error("[Outbox] Giving up on %s after %d tries: %s" % (item, item.tries, e))
+                    return self._failed(item, action)
+                log.warning("[Outbox] Network error while delivering %s: %s. Retrying..." % (item, e))
+                time.sleep(item.tries)
+            except Exception as e:
+                log.error("[Outbox] Exception while delivering %s: %s" % (item, e))
+                return self._failed(item, action)
+        if action == SEND and message is not None:
+            item.handle.resolve(message)
+        latency = time.monotonic() - item.queued_at
+        self.delivered += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        Metrics.record("bot.delivery", latency)
+        log.info("[Outbox] Delivered %s in %.2f sec" % (item, latency))
+
+    def _failed(self, item, action):
+        if action == SEND:
+            item.handle.dropped = True  # let the pending edits of this message go out as the new messages
+
+    def pending(self):
+        if self._pid != os.getpid():
+            return 0
+        with self._cond:
+            return len(self._items) + (1 if self._busy else 0)
+
+    def stats(self):
+        return {"pending": self.pending(), "delivered": self.delivered, "dropped": self.dropped,
+                "merged": self.merged, "throttled": self.throttled,
+                "latency_avg": self.latency_sum / self.delivered if self.delivered else 0.0,
+                "latency_max": self.latency_max}
+
+    def flush(self, timeout=OUTBOX_FLUSH_SECONDS):
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._items or self._busy:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    log.warning("[Outbox] %d message(s) were not delivered in time" % len(self._items))
+                    return
+                self._cond.wait(timeout=left)
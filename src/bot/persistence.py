@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# coding=utf-8
+import atexit
+import json
+import os
+import pickle
+import sqlite3
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+from src.const import BOT_PERSISTENCE_FLUSH_SECONDS
+from src.db import DATABASE
+from src.utils import log
+
+USER, CHAT, BOT, CONVERSATION = "user", "chat", "bot", "conv:%s"
+
+
+class SqlitePersistence(BasePersistence):
+    """Keeps the bot user/chat data and conversation states as separate rows of the project DB.
+    Only the changed rows are written - in a single transaction, at most once per `flush_seconds`.
+    """
+    create_table = """ CREATE TABLE IF NOT EXISTS bot_state (
+                        kind text NOT NULL,
+                        key text NOT NULL,
+                        value blob,
+                        PRIMARY KEY (kind, key)); """
+
+    def __init__(self, database=DATABASE, flush_seconds=BOT_PERSISTENCE_FLUSH_SECONDS, import_from=None):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.flush_seconds = flush_seconds
+        self._lock = threading.RLock()
+        self._timer = None
+        self._dirty = {}  # (kind, key) => pickled value or None to delete the row
+        self._written = {}  # (kind, key) => pickled value which is stored in the DB
+        self.conn = sqlite3.connect(database, check_same_thread=False, timeout=30)
+        self.conn.execute(self.create_table)
+        self.conn.commit()
+        self._load()
+        if import_from and not self._written and os.path.exists(import_from):
+            self._import_pickle(import_from)
+        atexit.register(self.flush)
+
+    def _load(self):
+        self.user_data = defaultdict(dict)
+        self.chat_data = defaultdict(dict)
+        self.bot_data = {}
+        self.conversations = defaultdict(dict)
+        for kind, key, value in self.conn.execute("SELECT kind, key, value FROM bot_state"):
+            self._written[(kind, key)] = value
+            data = pickle.loads(value)
+            if kind == USER:
+                self.user_data[int(key)] = data
+            elif kind == CHAT:
+                self.chat_data[int(key)] = data
+            elif kind == BOT:
+                self.bot_data = data
+            else:
+                self.conversations[kind.split(":", 1)[1]][tuple(json.loads(key))] = data
+        log.info("[Bot persistence] Loaded %d rows" % len(self._written))
+
+    def _import_pickle(self, filename):
+        log.info("[Bot persistence] Importing state from '%s'" % filename)
+        try:
+            with open(filename, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            log.error("[Bot persistence] Unable to import '%s': %s" % (filename, e))
+            return
+        for user_id, user_data in data.get("user_data", {}).items():
+            self.update_user_data(user_id, user_data)
+        for chat_id, chat_data in data.get("chat_data", {}).items():
+            self.update_chat_data(chat_id, chat_data)
+        self.update_bot_data(data.get("bot_data", {}))
+        for name, states in data.get("conversations", {}).items():
+            for key, state in states.items():
+                self.update_conversation(name, key, state)
+        self.flush()
+
+    def _mark(self, kind, key, data):
+        value = pickle.dumps(data) if data is not None else None
+        with self._lock:
+            if self._written.get((kind, key)) == value:
+                self._dirty.pop((kind, key), None)  # changed back to what is stored
+                return
+            self._dirty[(kind, key)] = value
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def get_user_data(self):
+        return self.user_data
+
+    def get_chat_data(self):
+        return self.chat_data
+
+    def get_bot_data(self):
+        return self.bot_data
+
+    def get_conversations(self, name):
+        return self.conversations[name].copy()
+
+    def update_user_data(self, user_id, data):
+        self.user_data[user_id] = data
+        self._mark(USER, str(user_id), data)
+
+    def update_chat_data(self, chat_id, data):
+        self.chat_data[chat_id] = data
+        self._mark(CHAT, str(chat_id), data)
+
+    def update_bot_data(self, data):
+        self.bot_data = data
+        self._mark(BOT, "", data)
+
+    def update_conversation(self, name, key, new_state):
+        if self.conversations[name].get(key) == new_state:
+            return
+        self.conversations[name][key] = new_state
+        self._mark(CONVERSATION % name, json.dumps(list(key)), new_state)
+
+    def flush(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            try:
+                with self.conn:  # single transaction for the whole batch
+                    self.conn.executemany("REPLACE INTO bot_state(kind, key, value) VALUES(?, ?, ?)",
+                                          [(kind, key, value) for (kind, key), value in dirty.items()
+                                           if value is not None])
+                    self.conn.executemany("DELETE FROM bot_state WHERE kind = ? AND key = ?",
+                                          [(kind, key) for (kind, key), value in dirty.items() if value is None])
+            except sqlite3.Error as e:
+                log.error("[Bot persistence] Unable to flush %d rows: %s" % (len(dirty), e))
+                dirty.update(self._dirty)
+                self._dirty = dirty  # keep them for the next flush
+                return
+            for row, value in dirty.items():
+                if value is None:
+                    self._written.pop(row, None)
+                else:
+                    self._written[row] = value
+            log.info("[Bot persistence] Flushed %d rows" % len(dirty))
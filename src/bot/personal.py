@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 # coding=utf-8
+import html
+import secrets
 import threading
 from collections import namedtuple
 from functools import wraps
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ChatAction
-from telegram.ext import Updater, CommandHandler, PicklePersistence, CallbackQueryHandler, ConversationHandler, \
-    Filters, MessageHandler
-
-from src.bot.common import bot
-from src.const import ALLOWED_USERS
-from src.utils import log, sleep
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ChatAction, ParseMode
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, ConversationHandler, Filters, MessageHandler
+
+from src.app import bot, pbot, scheduler
+from src.bot.persistence import SqlitePersistence
+from src.bot.request_queue import RequestQueue, RequestRejected
+from src.bot.webhook import WebhookServer
+from src.const import ALLOWED_USERS, BOT_WEBHOOK_URL, BOT_WEBHOOK_SECRET, PROFILE_SECONDS, PROFILE_MAX_SECONDS
+from src.events import EventBus
+from src.metrics import Metrics
+from src.profiler import Profiler
+from src.supervisor import Supervisor
+from src.utils import log
 
 FIX, BALANCE, REBOOT, USSD, SMS = range(5)
 
@@ -88,43 +96,77 @@ def restricted():
     return decorator
 
 
+# priorities of the requests (lower value is processed first)
+URGENT, REGULAR = range(2)
+
+
 class BaseRequest:
     update = None
     context = None
+    priority = REGULAR
+    # whether request could be processed while the caller is busy with a call
+    allowed_in_call = False
+    # whether the caller is restarted by the request
+    restarts_caller = False
 
     def __init__(self, update, context):
         self.update = update
         self.context = context
-        send_bot_msg(update, context, msg="Створено запит")
+        self.user = update.effective_user.username if update and update.effective_user else None
+
+    def key(self):
+        """Identical pending requests have the same key. The progress is replied to the requester only,
+        so the same request of the other user is not identical.
+        """
+        return self.__class__.__name__, self.user
 
     def process(self, *args, **kwargs):
         raise NotImplementedError("This method should be implemented")
 
+    def __repr__(self):
+        return "%s%s" % (self.__class__.__name__, self.key()[1:] or "")
+
 
 class BalanceRequest(BaseRequest):
     def __init__(self, update, context):
         super().__init__(update, context)
         log.info("[Personal bot] Balance info requested")
 
-    def process(self, *args, **kwargs):
+    def process(self, goip):
         from src.monitors import daily_status
-        return daily_status(scheduled_run=False)
+        return daily_status(lines=goip.lines, scheduled_run=False)
 
 
 class RebootRequest(BaseRequest):
+    priority = URGENT
+    # we have a confirmation message before running it
+    allowed_in_call = True
+    restarts_caller = True
+
     def __init__(self, update, context):
         super().__init__(update, context)
         log.info("[Personal bot] Reboot requested")
 
+    def key(self):
+        return self.__class__.__name__,  # the caller is rebooted once whoever asked (it's reported to the common chat)
+
     def process(self, goip):
         return goip.reboot()
 
 
 class ResetRestoreRequest(BaseRequest):
+    priority = URGENT
+    # we have a confirmation message before running it
+    allowed_in_call = True
+    restarts_caller = True
+
     def __init__(self, update, context):
         super().__init__(update, context)
         log.info("[Personal bot] Fix requested")
 
+    def key(self):
+        return self.__class__.__name__,  # the caller is fixed once whoever asked (it's reported to the common chat)
+
     def process(self, goip):
         return goip.reset_and_restore()
 
@@ -136,6 +178,9 @@ class SendSmsRequest(BaseRequest):
         self.text = text
         log.info("[Personal bot] Send SMS requested: number=%s, message=%s" % (num, text))
 
+    def key(self):
+        return self.__class__.__name__, self.user, self.num, self.text
+
     def process(self, *args, **kwargs):
         from src.sms import SmsWrapper
         return SmsWrapper.sms.send_sms(self.num, self.text)
@@ -147,6 +192,9 @@ class SendUssdRequest(BaseRequest):
         self.code = code
         log.info("[Personal bot] Send USSD requested: code=%s" % code)
 
+    def key(self):
+        return self.__class__.__name__, self.user, self.code
+
     def process(self, *args, **kwargs):
         from src.sms import SmsWrapper
         return SmsWrapper.sms.send_ussd(self.code, bot_msg=True)
@@ -186,11 +234,6 @@ def store_cnxt_val(context, key, value):
 @restricted()
 @answer_query()
 def start(update, context, first_run=True):
-    # prevent someone from sending new requests while current one is still processed
-    while pbot.has_request():
-        context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=ChatAction.TYPING)
-        log.info("[Personal bot] Waiting for request to be processed...")
-        sleep(5)
     msg = 'Чим я можу допомогти?' if first_run else 'Може ще щось?'
     header_buttons = InlineKeyboardButton(mm_buttons.BALANCE, callback_data=mm_buttons.BALANCE)
     button_list = [
@@ -208,6 +251,38 @@ def start_over(update, context):
     start(update, context, first_run=False)
 
 
+@restricted()
+def stats(update, context):
+    """Replies with the durations of the hot-path operations, the queues, the supervised components and the jobs."""
+    text = "%s\n\nЧерга запитів: %s\nЧерга повідомлень: %s\n\n%s\n\n%s\n\n%s" % (
+        Metrics.summary(), pbot.requests.stats(), bot.outbox.stats(), EventBus.summary(), Supervisor.summary(),
+        scheduler.summary())
+    update.effective_message.reply_text(text="<pre>%s</pre>" % html.escape(text), parse_mode=ParseMode.HTML)
+
+
+@restricted()
+def profile(update, context):
+    """Starts the sampling profiler: '/profile [seconds]'. Summary is sent back once it's done."""
+    seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else PROFILE_SECONDS
+    message = update.effective_message
+
+    def on_done(text):
+        message.reply_text(text="<pre>%s</pre>" % html.escape(text), parse_mode=ParseMode.HTML)
+    if Profiler.start(seconds=seconds, on_done=on_done):
+        message.reply_text(text="Профілюю %d сек" % min(seconds, PROFILE_MAX_SECONDS))
+    else:
+        message.reply_text(text="Профілювання вже триває")
+
+
+@restricted()
+def analytics(update, context):
+    """Replies with the call history analytics: '/analytics [days] [line]' (all the history by default)."""
+    from src.analytics import report  # NumPy is imported on the first request only
+    args = [int(arg) for arg in context.args or [] if arg.isdigit()]
+    text = report(days=args[0] if args else None, line=args[1] if len(args) > 1 else None)
+    update.effective_message.reply_text(text="<pre>%s</pre>" % html.escape(text), parse_mode=ParseMode.HTML)
+
+
 @restricted()
 def error(update, context):
     """Log Errors caused by Updates."""
@@ -217,7 +292,7 @@ def error(update, context):
 @restricted()
 @answer_query()
 def balance(update, context):
-    pbot.request = BalanceRequest(update, context)
+    pbot.add_request(BalanceRequest(update, context))
     return g_buttons.StartOver
 
 
@@ -231,7 +306,7 @@ def reboot_confirm(update, context):
 @restricted()
 @answer_query()
 def reboot(update, context):
-    pbot.request = RebootRequest(update, context)
+    pbot.add_request(RebootRequest(update, context))
     return g_buttons.StartOver
 
 
@@ -245,7 +320,7 @@ def fix_confirm(update, context):
 @restricted()
 @answer_query()
 def fix(update, context):
-    pbot.request = ResetRestoreRequest(update, context)
+    pbot.add_request(ResetRestoreRequest(update, context))
     return g_buttons.StartOver
 
 
@@ -260,7 +335,7 @@ def ask_ussd_code(update, context):
 @restricted()
 def send_ussd(update, context):
     code = update.message.text
-    pbot.request = SendUssdRequest(update, context, code=code)
+    pbot.add_request(SendUssdRequest(update, context, code=code))
     return g_buttons.StartOver
 
 
@@ -286,18 +361,21 @@ def ask_sms_text(update, context):
 def send_sms(update, context):
     num = get_cnxt_val(context, "num")
     text = update.message.text
-    pbot.request = SendSmsRequest(update, context, num=num, text=text)
+    pbot.add_request(SendSmsRequest(update, context, num=num, text=text))
     return g_buttons.StartOver
 
 
 class PersonalBot:
-    request = None
-
     def __init__(self):
-        persistence = PicklePersistence(filename='bot-settings')
+        self.requests = RequestQueue()
+        # state kept by the previous versions in 'bot-settings' pickle file is imported on the first start
+        persistence = SqlitePersistence(import_from='bot-settings')
         updater = Updater(bot=bot._bot, persistence=persistence, use_context=True)
         cancel_handler = CallbackQueryHandler(pattern='^%s$' % g_buttons.Cancel, callback=start)
         updater.dispatcher.add_handler(CommandHandler(command='start', callback=start))
+        updater.dispatcher.add_handler(CommandHandler(command='stats', callback=stats))
+        updater.dispatcher.add_handler(CommandHandler(command='profile', callback=profile))
+        updater.dispatcher.add_handler(CommandHandler(command='analytics', callback=analytics))
         updater.dispatcher.add_handler(CallbackQueryHandler(pattern='^%s|%s$' % (g_buttons.Cancel, g_buttons.StartOver),
                                                             callback=start_over))
         updater.dispatcher.add_handler(CallbackQueryHandler(pattern='^%s$' % mm_buttons.BALANCE, callback=balance))
@@ -339,22 +417,37 @@ class PersonalBot:
         )
         updater.dispatcher.add_handler(sms_conv_handler)
         updater.dispatcher.add_error_handler(error)
-        updater.start_polling()
-        log.info("[Personal bot] Started")
+        self.webhook = None
+        if BOT_WEBHOOK_URL:
+            self.webhook = WebhookServer(updater.dispatcher, secret=BOT_WEBHOOK_SECRET or secrets.token_urlsafe(32))
+            self.webhook.start()
+        else:
+            updater.start_polling()
+        log.info("[Personal bot] Started (%s mode)" % ("webhook" if self.webhook else "polling"))
 
     def has_request(self):
-        return self.request is not None
+        return self.requests.busy()
 
-    def process_request(self, goip):
-        if not self.has_request():
-            log.info("[ProcessRequest] No request to process")
+    def add_request(self, request):
+        try:
+            depth = self.requests.put(request)
+        except RequestRejected as e:
+            log.info("[Personal bot] Request %s rejected: %s" % (request, e))
+            send_bot_msg(request.update, request.context, msg=str(e))
             return
-        update = self.request.update
-        context = self.request.context
+        send_bot_msg(request.update, request.context,
+                     msg="Створено запит" if depth == 1 else "Створено запит (%d у черзі)" % depth)
+
+    def start_processing(self, run, can_run):
+        self.requests.start(run=run, can_run=can_run)
+
+    def process_request(self, request, goip):
+        update = request.update
+        context = request.context
         try:
             threading.Thread(target=start_over, args=(update, context, )).start()
             send_bot_msg(update, context, msg="Виконую запит")
-            result = self.request.process(goip)
+            result = request.process(goip)
             if result:
                 bot.send(result)
             send_bot_msg(update, context, msg="Тринь, ісполнєно!")
@@ -364,8 +457,3 @@ class PersonalBot:
                 log.error("[Personal bot] Exception while processing request: %s" % e)
             except Exception as e1:
                 log.error("[Personal bot] Exception while handling exception: %s\noriginal exception: %s" % (e1, e))
-        finally:
-            self.request = None
-
-
-pbot = PersonalBot()
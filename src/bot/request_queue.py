@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding=utf-8
+import itertools
+import threading
+import time
+
+from src.const import MAX_REQUESTS_PER_USER
+from src.metrics import Metrics, timing
+from src.tracing import trace
+from src.utils import log
+
+
+class RequestRejected(Exception):
+    pass
+
+
+class RequestQueue:
+    """Pending personal bot requests processed one by one by the background worker thread.
+    Requests with the lower `priority` value go first, identical pending requests are not queued twice.
+    """
+    _seq = itertools.count()
+
+    def __init__(self, max_per_user=MAX_REQUESTS_PER_USER):
+        self.max_per_user = max_per_user
+        self.processed = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self._items = []
+        self._current = None
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def put(self, request):
+        with self._cond:
+            if any(pending.key() == request.key() for pending in self._all()):
+                raise RequestRejected("Такий запит вже в черзі")
+            if len([pending for pending in self._all() if pending.user == request.user]) >= self.max_per_user:
+                raise RequestRejected("Забагато запитів, зачекай трохи")
+            request.queued_at = time.monotonic()
+            request.seq = next(self._seq)
+            self._items.append(request)
+            self._cond.notify_all()
+            depth = len(self._items)
+        log.info("[Request queue] Queued %s (depth %d)" % (request, depth))
+        return depth
+
+    def _all(self):
+        return self._items + ([self._current] if self._current else [])
+
+    def depth(self):
+        with self._cond:
+            return len(self._items)
+
+    def busy(self):
+        with self._cond:
+            return bool(self._items or self._current)
+
+    def start(self, run, can_run):
+        """Starts the worker calling `run(request)` for each request once `can_run(request)` allows it."""
+        if self._worker:
+            return
+        self._worker = threading.Thread(target=self._work, args=(run, can_run), name="BotRequests", daemon=True)
+        self._worker.start()
+
+    def _next(self, can_run):
+        for request in sorted(self._items, key=lambda pending: (pending.priority, pending.seq)):
+            if can_run(request):
+                self._items.remove(request)
+                return request
+            if not getattr(request, "deferred", False):
+                log.info("[Request queue] Could not process %s right now. Waiting..." % request)
+                request.deferred = True
+
+    def _work(self, run, can_run):
+        while True:
+            with self._cond:
+                request = self._next(can_run)
+                while request is None:
+                    self._cond.wait(timeout=1 if self._items else None)
+                    request = self._next(can_run)
+                self._current = request
+            waited = time.monotonic() - request.queued_at
+            log.info("[Request queue] Processing %s (waited %.1f sec, %d more in queue)" %
+                     (request, waited, self.depth()))
+            Metrics.record("requests.wait", waited)
+            try:
+                with trace("request", request=repr(request)), timing("requests.process"):
+                    run(request)
+            except Exception as e:
+                log.error("[Request queue] Exception while processing %s: %s" % (request, e))
+            finally:
+                with self._cond:
+                    self._current = None
+                    self.processed += 1
+                    self.wait_sum += waited
+                    self.wait_max = max(self.wait_max, waited)
+
+    def stats(self):
+        return {"depth": self.depth(), "processed": self.processed,
+                "wait_avg": self.wait_sum / self.processed if self.processed else 0.0, "wait_max": self.wait_max}
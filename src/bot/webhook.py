@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding=utf-8
+import hmac
+import json
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.const import BOT_WEBHOOK_URL, BOT_WEBHOOK_LISTEN, BOT_WEBHOOK_PORT, BOT_WEBHOOK_PATH, BOT_WEBHOOK_RECORD
+from src.utils import log
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Local HTTP receiver of the bot updates pushed by Telegram (instead of the long polling).
+    Updates are dispatched to the regular handlers right in the request thread, so the response time
+    is the update-to-response latency.
+    """
+    def __init__(self, dispatcher, secret, listen=BOT_WEBHOOK_LISTEN, port=BOT_WEBHOOK_PORT, path=BOT_WEBHOOK_PATH,
+                 record=BOT_WEBHOOK_RECORD):
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.path = path
+        self.record = record
+        self.handled = 0
+        self.rejected = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self._record_lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.handle(self)
+
+            def log_message(self, fmt, *args):
+                log.debug("[Webhook] %s" % (fmt % args))
+
+        self.httpd = ThreadingHTTPServer((listen, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self, register_url=BOT_WEBHOOK_URL):
+        threading.Thread(target=self.httpd.serve_forever, name="BotWebhook", daemon=True).start()
+        log.info("[Webhook] Listening on %s:%d%s" % (self.httpd.server_address + (self.path, )))
+        if register_url:
+            # secret_token is passed through to the Bot API as is
+            self.dispatcher.bot.set_webhook(url=register_url.rstrip("/") + self.path, secret_token=self.secret)
+            log.info("[Webhook] Registered at %s" % register_url)
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def handle(self, request):
+        started = time.monotonic()
+        if request.path != self.path:
+            return self._reply(request, 404)
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            log.error("[Webhook] Update with the wrong secret token from %s" % request.client_address[0])
+            return self._reply(request, 403)
+        body = request.rfile.read(int(request.headers.get("Content-Length", 0)))
+        try:
+            from telegram import Update
+            update = Update.de_json(json.loads(body.decode("utf-8")), self.dispatcher.bot)
+        except Exception as e:
+            log.error("[Webhook] Malformed update: %s" % e)
+            return self._reply(request, 400)
+        if self.record:
+            with self._record_lock, open(self.record, "ab") as f:
+                f.write(body.strip() + b"\n")
+        self.dispatcher.process_update(update)
+        latency = time.monotonic() - started
+        self.handled += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        log.info("[Webhook] Update %s handled in %.3f sec" % (update.update_id, latency))
+        self._reply(request, 200)
+
+    @staticmethod
+    def _reply(request, code):
+        request.send_response(code)
+        request.send_header("Content-Length", "0")
+        request.end_headers()
+
+    def stats(self):
+        return {"handled": self.handled, "rejected": self.rejected,
+                "latency_avg": self.latency_sum / self.handled if self.handled else 0.0,
+                "latency_max": self.latency_max}
+
+
+def replay(filename, url, secret, speed=0.0):
+    """Posts the recorded updates (one JSON per line) to the webhook receiver like Telegram does.
+    :param speed: seconds to wait in-between the updates
+    """
+    latencies = []
+    with open(filename, "rb") as f:
+        for body in filter(None, (line.strip() for line in f)):
+            request = urllib.request.Request(url, data=body, method="POST",
+                                             headers={"Content-Type": "application/json", SECRET_HEADER: secret})
+            started = time.monotonic()
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            latencies.append(time.monotonic() - started)
+            time.sleep(speed)
+    if latencies:
+        latencies.sort()
+        print("Updates: %d, avg: %.3f sec, p50: %.3f sec, max: %.3f sec" %
+              (len(latencies), sum(latencies) / len(latencies), latencies[len(latencies) // 2], latencies[-1]))
+    return latencies
+
+
+if __name__ == '__main__':
+    # python -m src.bot.webhook <recorded-updates-file> <secret> [url]
+    if len(sys.argv) < 3:
+        print("Usage: python -m src.bot.webhook <recorded-updates-file> <secret> [url]")
+        sys.exit(1)
+    replay(sys.argv[1], sys.argv[3] if len(sys.argv) > 3 else
+           "http://127.0.0.1:%d%s" % (BOT_WEBHOOK_PORT, BOT_WEBHOOK_PATH), sys.argv[2])
@@ -3,9 +3,10 @@
 import atexit
 import base64
 import signal
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from src.const import DRIVER_EXECUTABLE, STORE_SCREENS
+import threading
+from src.const import DRIVER_EXECUTABLE, STORE_SCREENS, DRIVER_COMMAND_TIMEOUT_SECONDS, \
+    SUPERVISOR_PROBE_TIMEOUT_SECONDS, CDR_FIELDS
+from src.metrics import timed
 from src.utils import log
 
 
@@ -13,10 +14,31 @@ class NotLoggedIn(Exception):
     pass
 
 
+# collects the status fields of every line shown on the 'Status' page (l1_*, l2_*, ...) in a single driver call
+LINES_STATUS_SCRIPT = """
+var fields = arguments[0], lines = [];
+for (var n = 1; document.getElementById('l' + n + '_line_state'); n++) {
+    var line = {};
+    for (var i = 0; i < fields.length; i++) {
+        var elem = document.getElementById('l' + n + '_' + fields[i]);
+        line[fields[i]] = elem ? (elem.textContent || '').trim() : null;
+    }
+    lines.push(line);
+}
+return lines;
+"""
+
+
 class Browser:
+    # the last call record fields are read as well to reconcile the calls missed in-between the polls
+    LINE_FIELDS = ["line_state", "status_line", "gsm_sim", "gsm_status"] + \
+        sorted(set(CDR_FIELDS.values()) | {"cdrt"})
     driver = None
 
     def __init__(self, url, uname, pwd):
+        from selenium import webdriver  # imported on the first use as it takes a while on the Pi
+        from selenium.webdriver.remote.remote_connection import RemoteConnection
+        RemoteConnection.set_timeout(DRIVER_COMMAND_TIMEOUT_SECONDS)  # hung PhantomJS ends the command with error
         self.close()
         self.url = url
         self.uname = uname
@@ -43,7 +65,19 @@ class Browser:
             if err_log:
                 log.error("[Browser] Close exception : {}".format(e))
         self.driver = None
+
+    def terminate(self):
+        """Kills the PhantomJS process, so the driver commands it hung in end at once"""
+        try:
+            self.driver.service.process.send_signal(signal.SIGTERM)
+        except Exception as e:
+            log.error("[Browser] Terminate exception : {}".format(e))
+
+    def process_alive(self):
+        process = self.driver.service.process if self.driver else None
+        return process is not None and process.poll() is None
     
+    @timed("browser.go")
     def go(self, url):
         log.info("[Browser] Open URL: %s" % url)
         self.driver.get(url)
@@ -56,6 +90,7 @@ class Browser:
     def by_xpath(self, xpath):
         return self.driver.find_element_by_xpath(xpath)
         
+    @timed("browser.by_id")
     def by_id(self, id):
         return self.driver.find_element_by_id(id)
     
@@ -94,6 +129,14 @@ class Browser:
         log.info("[Browser] Received uptime value '%s'" % value)
         return int(value)
     
+    @timed("browser.refresh")
+    def refresh(self):
+        self.driver.refresh()
+
+    @timed("browser.lines_status")
+    def lines_status(self):
+        return self.driver.execute_script(LINES_STATUS_SCRIPT, self.LINE_FIELDS) or []
+
     def current_url(self):
         return self.driver.current_url
     
@@ -101,6 +144,7 @@ class Browser:
         return self.go(self.current_url().rsplit("/", 1)[0] + "/" + url)
 
     def is_authorized(self):
+        from selenium.common.exceptions import NoSuchElementException
         try:
             return self.by_xpath("//div[contains(@class, 'title') and text()='Status']").is_displayed()
         except NoSuchElementException:
@@ -109,6 +153,8 @@ class Browser:
 
 class BrowserWrapper:
     b = None
+    # the driver is not thread-safe, so status polls and bot requests take turns using it
+    lock = threading.RLock()
 
     @classmethod
     def init(cls, url, uname, pwd):
@@ -121,5 +167,24 @@ class BrowserWrapper:
             cls.b.close(err_log=False)
             cls.b = None
 
+    @classmethod
+    def alive(cls):
+        """Liveness probe: PhantomJS process is running and answers the driver commands"""
+        b = cls.b
+        if not b or not b.process_alive():
+            return False
+        if not cls.lock.acquire(timeout=SUPERVISOR_PROBE_TIMEOUT_SECONDS):
+            return True  # busy with the long operation, the hung command would fail with the timeout anyway
+        try:
+            b.current_url()
+            return True
+        finally:
+            cls.lock.release()
+
+    @classmethod
+    def terminate(cls):
+        if cls.b:
+            cls.b.terminate()
+
 
 atexit.register(BrowserWrapper.kill)
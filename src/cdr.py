@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding=utf-8
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from src.app import vs
+from src.const import CDR_FIELDS, CDR_MATCH_SECONDS, CALL_TIME_FORMAT
+from src.digest import Digest
+from src.events import EventBus, CallEnded
+from src.metrics import Metrics
+from src.utils import log, current_date
+
+CdrRecord = namedtuple("CdrRecord", ["line", "started", "number", "seconds"])
+
+
+def parse_seconds(value):
+    """Duration is either the seconds or 'H:MM:SS'"""
+    value = (value or "").strip()
+    if value.isdigit():
+        return int(value)
+    parts = value.split(":")
+    if len(parts) in (2, 3) and all(part.isdigit() for part in parts):
+        return sum(int(part) * 60 ** i for i, part in enumerate(reversed(parts)))
+    return None
+
+
+def parse_record(line, status):
+    """Returns the last call record of the line taken from its status fields or None if there is no valid one"""
+    started = (status.get(CDR_FIELDS["started"]) or "").strip()
+    seconds = parse_seconds(status.get(CDR_FIELDS["seconds"]))
+    if not started or started.startswith("1970-01") or seconds is None:  # 1970 - GoIP clock is not set
+        return None
+    try:
+        started = datetime.strptime(started, CALL_TIME_FORMAT)
+    except ValueError:
+        return None
+    number = (status.get(CDR_FIELDS["number"]) or "").strip() or None
+    return CdrRecord(line, started, number, seconds)
+
+
+def normalize_number(number):
+    """+380..., 0... and 00380... are the same subscriber"""
+    return re.sub("[^0-9]", "", number or "")[-9:]
+
+
+def same_number(number, other):
+    if not number or not other:
+        return True  # unknown number doesn't tell the calls apart
+    return normalize_number(number) == normalize_number(other)
+
+
+def merge(record):
+    """Adds the call of the record to the history and the daily stats unless it's the call detected by the polls.
+    Done by the storage subscriber of the events, so the detected calls published before are stored already.
+    """
+    window = timedelta(seconds=CDR_MATCH_SECONDS)
+    known = vs.calls(record.started - window, record.started + window, line=record.line)
+    if any(same_number(record.number, number) for _, _, number, _, _, _ in known):
+        return False
+    ok = record.seconds > 0
+    log.info("[CDR] Line %d: missed call to %s at %s (%d sec)" %
+             (record.line, record.number, record.started, record.seconds), extra={"line": record.line})
+    Metrics.inc("goip_cdr_missed_calls_total", line=record.line)
+    Metrics.inc("goip_calls_total", line=record.line, result="ok" if ok else "failed")
+    if ok:
+        Metrics.inc("goip_call_seconds_total", record.seconds, line=record.line)
+    vs.add_call(record.started, record.number, record.seconds, ok, source="cdr", line=record.line)
+    if record.started.date() == current_date().date():  # otherwise the daily stats are reset already
+        Digest.call(record.line, record.seconds, ok)
+    return True
+
+
+class CdrReconciler:
+    """Merges the GoIP call records with the calls detected by the status polls. Calls which started and finished
+    in-between two polls are never seen by the line state machine, but the GoIP still records them: the records
+    newer than the last seen one which don't match any detected call are added to the history and the daily stats.
+    """
+    def __init__(self):
+        self.last_seen = {}  # line => start time of the last processed record
+
+    def new_record(self, line, status):
+        record = parse_record(line, status)
+        if record is None:
+            return None
+        if line not in self.last_seen:
+            self.last_seen[line] = vs.last_cdr_seen(line=line)
+        last_seen = self.last_seen[line]
+        if last_seen and record.started <= last_seen:
+            return None
+        self.last_seen[line] = record.started
+        vs.set_last_cdr_seen(record.started, line=line)
+        if last_seen is None:
+            log.info("[CDR] Line %d: starting from the record of %s" % (line, record.started))
+            return None  # the calls before the first record seen could have been counted already
+        return record
+
+    def reconcile(self, lines_status, idle_lines):
+        """Publishes the new records of the idle lines (the record of the call in progress is not final yet)
+        to be merged by the storage subscriber. Returns the records published.
+        """
+        records = []
+        for line, status in enumerate(lines_status, start=1):
+            if line not in idle_lines:
+                continue
+            record = self.new_record(line, status)
+            if record:
+                EventBus.publish(CallEnded(record.line, record.number, record.started, record.seconds,
+                                           record.seconds > 0, None, None, "cdr"))
+                records.append(record)
+        return records
@@ -38,6 +38,9 @@ except ImportError:
 # platform we are running the script on
 RUNNING_ON = sys.argv[1].replace("-", "") if len(sys.argv) > 1 else "raspberry"
 
+# Phone numbers assigned to the caller lines (line number -> phone) - specify the rest for GoIP-4/8/16
+LINE_SENDER_PHONES = {1: SENDER_PHONE}
+
 # whether screenshots should be stored on browser actions (use force=True to override)
 STORE_SCREENS = not IS_PROD
 
@@ -53,12 +56,203 @@ DATE_FORMAT = "%d.%m.%Y"
 # Default datetime format to be used
 DATETIME_FORMAT = "%d.%m.%Y %H:%M:%S"
 
+# Datetime format of the call history records and the GoIP call records (sorts as the text)
+CALL_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
 # Default log level of this script
 LOG_LEVEL = "INFO"
 
 # Default log output filename/location
 LOG_NAME = "out.log"
 
+# Log records per second allowed for each line of code logging something (DEBUG log level disables the limit)
+LOG_SITE_RATE = 1
+
+# Log records which could be written at once by a single line of code before the rate limit applies
+LOG_SITE_BURST = 20
+
+# Seconds in-between the summaries of the message repeating again and again ("repeated N times")
+LOG_REPEAT_SUMMARY_SECONDS = 10 * 60
+
+# Format of the log output: "text" or "json" (one object per line with gateway/line/state/duration fields)
+LOG_FORMAT = "text"
+
+# Max amount of the bot messages waiting to be delivered (the least important ones are dropped when exceeded)
+OUTBOX_SIZE = 100
+
+# Number of tries to deliver the bot message when Telegram is not reachable
+OUTBOX_RETRIES = 3
+
+# Seconds to wait for the pending bot messages to be delivered on exit
+OUTBOX_FLUSH_SECONDS = 10
+
+# Bot messages per second allowed for a single chat (Telegram allows ~20 messages per minute in a group)
+BOT_CHAT_RATE = 20 / 60
+
+# Bot messages which could be sent to a single chat at once before the rate limit applies
+BOT_CHAT_BURST = 3
+
+# Bot messages per second allowed for all the chats together (Telegram allows ~30 messages per second)
+BOT_GLOBAL_RATE = 30
+
+# Bot messages which could be sent to all the chats at once before the rate limit applies
+BOT_GLOBAL_BURST = 30
+
+# Max amount of the pending bot requests of a single user
+MAX_REQUESTS_PER_USER = 2
+
+# Public HTTPS URL Telegram should push the bot updates to (proxied to the local receiver below).
+# Updates are long-polled when not specified
+BOT_WEBHOOK_URL = None
+
+# Address the local receiver of the bot updates listens on
+BOT_WEBHOOK_LISTEN = "127.0.0.1"
+
+# Port the local receiver of the bot updates listens on
+BOT_WEBHOOK_PORT = 8443
+
+# URL path the bot updates are posted to
+BOT_WEBHOOK_PATH = "/bot"
+
+# Secret token Telegram sends along with each update (random one is generated on each start if not specified)
+BOT_WEBHOOK_SECRET = None
+
+# File to record the received bot updates to (to be replayed later with 'python -m src.bot.webhook')
+BOT_WEBHOOK_RECORD = None
+
+# Seconds the changed bot conversation state is kept in memory before being written to the DB in a batch
+BOT_PERSISTENCE_FLUSH_SECONDS = 5
+
+# Whether durations of the hot-path operations should be collected (no overhead at all when disabled)
+METRICS_ENABLED = True
+
+# Number of the most recent durations of each operation used to calculate the percentiles
+METRICS_SAMPLES = 1000
+
+# Seconds in-between the operation durations summaries written to the log
+METRICS_SUMMARY_SECONDS = 60 * 60
+
+# Port to serve the Prometheus metrics on (/metrics). Not served if not specified
+METRICS_PORT = None
+
+# Address to serve the Prometheus metrics on
+METRICS_LISTEN = "0.0.0.0"
+
+# Trace file with the spans of each monitor cycle (summarised by 'python -m src.tracing'). Not written if None
+TRACE_NAME = "trace.log"
+
+# Max size of the trace file before it's rotated
+TRACE_MAX_BYTES = 5 * 1024 * 1024
+
+# Amount of the rotated trace files to keep
+TRACE_BACKUPS = 3
+
+# Default duration of the sampling profiler run (started by SIGUSR1 or /profile bot command)
+PROFILE_SECONDS = 30
+
+# Max duration of the sampling profiler run which could be requested
+PROFILE_MAX_SECONDS = 300
+
+# Stack samples taken per second by the profiler
+PROFILE_RATE = 50
+
+# Amount of the functions listed in the profiler summary
+PROFILE_TOP = 15
+
+# File the raw line states are recorded to on each change (replayed by 'python -m src.replay'). Not written if None
+LINE_STATES_RECORD = "line-states.log"
+
+# Max size of the line states record before it's rotated
+LINE_STATES_MAX_BYTES = 5 * 1024 * 1024
+
+# Amount of the rotated line states records to keep
+LINE_STATES_BACKUPS = 10
+
+# In-flight call state older than that is not restored after the restart (the call is considered lost)
+CALL_STATE_MAX_AGE_SECONDS = 3 * 60 * 60
+
+# Seconds between the liveness probes of the supervised components (PhantomJS driver, SMPP session)
+SUPERVISOR_CHECK_SECONDS = 60
+
+# Max restarts of the single component within the budget window. Component is left down when it's exhausted
+SUPERVISOR_RESTART_BUDGET = 3
+
+# Window the component restarts are counted in
+SUPERVISOR_BUDGET_WINDOW_SECONDS = 60 * 60
+
+# Seconds the browser probe waits for the driver to be free. If it's still busy, only the process is checked
+SUPERVISOR_PROBE_TIMEOUT_SECONDS = 5
+
+# Seconds the single webdriver command might take before it's considered hung
+DRIVER_COMMAND_TIMEOUT_SECONDS = 120
+
+# Failed monitor cycles in a row the application gives up after (the components are restarted in-between)
+MONITOR_MAX_CYCLE_ERRORS = 10
+
+# Errors in a row which open the circuit of the endpoint (the calls are rejected at once till it's reset)
+CIRCUIT_FAILURES = 5
+
+# Seconds the circuit stays open before the trial call is let through
+CIRCUIT_RESET_SECONDS = 60
+
+# Retries of the failed calls allowed per monitor cycle over all the endpoints
+RETRY_BUDGET_PER_CYCLE = 10
+
+# Max delay between the retries (the back-off is not increased beyond it)
+RETRY_MAX_DELAY_SECONDS = 10
+
+# Timeout of the single HTTP request to the GoIP
+HTTP_TIMEOUT_SECONDS = 10
+
+# Seconds the USSD request (sending it and waiting for the response) should fit into
+USSD_DEADLINE_SECONDS = 40
+
+# Seconds between the RSS/CPU samples of PhantomJS and the application process
+WATCHDOG_SAMPLE_SECONDS = 30
+
+# PhantomJS RSS the driver is recycled after (once the lines are idle)
+WATCHDOG_BROWSER_MAX_RSS_MB = 250
+
+# PhantomJS CPU usage which is considered too high if it lasts for WATCHDOG_BROWSER_CPU_SAMPLES samples in a row
+WATCHDOG_BROWSER_MAX_CPU_PERCENT = 80
+
+# Samples in a row with the high CPU usage the driver is recycled after
+WATCHDOG_BROWSER_CPU_SAMPLES = 10
+
+# Min seconds between the driver recycles
+WATCHDOG_MIN_RECYCLE_SECONDS = 60 * 60
+
+# Ids of the last call record fields per line at the 'Status' page (l<line>_<id>): start time, duration, number
+CDR_FIELDS = {"started": "cdrt", "seconds": "cdrd", "number": "cdrn"}
+
+# Call record and the call detected by the status polls are the same call if they started within these seconds
+CDR_MATCH_SECONDS = 90
+
+# Minutes before the daily status (23:00) the balance is sampled in background for it
+DIGEST_SAMPLE_MINUTES = 15
+
+# Seconds the daily status might be late for (it waits for the call to finish), later it's skipped till tomorrow
+DAILY_STATUS_DEADLINE_SECONDS = 59 * 60
+
+# Max amount of the events waiting to be handled by the single subscriber (Telegram, storage, metrics)
+EVENT_QUEUE_SIZE = 1000
+
+# Seconds the publisher waits for the room in the full queue of the subscriber which must not lose the events
+EVENT_BLOCK_SECONDS = 1
+
+# Directory the call history is cached to as the columnar arrays for the analytics ('python -m src.analytics')
+ANALYTICS_CACHE = "call-analytics"
+
+# Amount of the hours/numbers listed in the call analytics
+ANALYTICS_TOP = 5
+
+# Min amount of the calls to the number to have its failure rate listed in the call analytics
+ANALYTICS_MIN_CALLS = 3
+
+# Days before today which are not cached for the call analytics - the calls might still be added to them late
+# (the call records merged after midnight, the calls crossing midnight)
+ANALYTICS_CACHE_LAG_DAYS = 2
+
 # SMPP port to be used for SMS monitoring
 SMPP_PORT = 7777
 
@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 # coding=utf-8
 import atexit
+import json
 from datetime import datetime
-from sqlite3worker import Sqlite3Worker
 
-from src.const import CUR_DIR, DATETIME_FORMAT
+from src.const import CUR_DIR, DATETIME_FORMAT, CALL_TIME_FORMAT
+from src.metrics import timed
 from src.utils import log
 
+# this will create separate DB for each platform used
+DATABASE = r"%s/sqlite.db" % CUR_DIR
+
 
 class DBStorage:
     create_table = """ CREATE TABLE IF NOT EXISTS db_dict (
@@ -17,16 +21,30 @@ class DBStorage:
     drop_index = " DROP INDEX IF EXISTS idx_dbdict_key; "
     create_index = """ CREATE UNIQUE INDEX IF NOT EXISTS idx_dbdict_key 
                         ON db_dict (key); """
+    # history of the calls - detected by the status polls or taken from the GoIP call records (source 'cdr')
+    create_calls_table = """ CREATE TABLE IF NOT EXISTS calls (
+                        id integer PRIMARY KEY,
+                        line integer NOT NULL,
+                        started text NOT NULL,
+                        number text,
+                        seconds integer NOT NULL,
+                        ok integer NOT NULL,
+                        source text NOT NULL); """
+    create_calls_index = """ CREATE INDEX IF NOT EXISTS idx_calls_started
+                        ON calls (started, line); """
 
     def __init__(self, recreate=False):
-        database = r"%s/sqlite.db" % CUR_DIR  # this will create separate DB for each platform used
         log.info("[DB] Start the module")
-        self.conn = Sqlite3Worker(database)
+        from sqlite3worker import Sqlite3Worker
+        self.conn = Sqlite3Worker(DATABASE)
         self.conn.execute(self.create_table)
         if recreate:
             self.conn.execute(self.drop_index)
         self.conn.execute(self.create_index)
+        self.conn.execute(self.create_calls_table)
+        self.conn.execute(self.create_calls_index)
 
+    @timed("db.get")
     def get(self, key, field="value", all_fields=False, notify=True):
         if notify:
             log.info("[DB] Get value for key '%s'" % key)
@@ -62,6 +80,7 @@ class DBStorage:
                   VALUES(?, ?, ?) '''
         self.conn.execute(sql, (key, value, date))
 
+    @timed("db.set")
     def set(self, key, value, date=datetime.now()):
         log.info("[DB] Set value for key '%s' = '%s'" % (key, value))
         self.insert(key=key, value=value, date=date)
@@ -76,6 +95,22 @@ class DBStorage:
         sql = 'DELETE FROM db_dict'
         self.conn.execute(sql)
 
+    @timed("db.add_call")
+    def add_call(self, line, started, number, seconds, ok, source):
+        sql = ''' INSERT INTO calls(line, started, number, seconds, ok, source)
+                  VALUES(?, ?, ?, ?, ?, ?) '''
+        self.conn.execute(sql, (line, started, number, seconds, ok, source))
+
+    def calls(self, since, till, line=None):
+        sql = ''' SELECT line, started, number, seconds, ok, source
+                  FROM calls
+                  WHERE started >= ? AND started < ?'''
+        params = (since, till)
+        if line is not None:
+            sql += " AND line = ?"
+            params += (line, )
+        return self.conn.execute(sql + " ORDER BY started", params)
+
     def close(self):
         if self.conn:
             self.conn.close()
@@ -90,16 +125,18 @@ class MemoryStorage:
     def set(self, key, value):
         self.vals.update({key: value})
 
+    def add_call(self, line, started, number, seconds, ok, source):
+        self.vals.setdefault("calls", []).append((line, started, number, seconds, ok, source))
+
+    def calls(self, since, till, line=None):
+        return sorted((call for call in self.vals.get("calls", [])
+                       if since <= call[1] < till and (line is None or call[0] == line)), key=lambda call: call[1])
+
     def close(self):
         pass
 
 
 class Storage:
-    try:
-        _db = DBStorage()
-    except Exception as e:
-        log.error("[Storage] Error while init of DB storage: %s. Using in-memory one" % e)
-        _db = MemoryStorage()
     _DAILY_CALLS_DURATION = "DAILY_CALL_DURATION"
     _WEEKLY_CALLS_DURATION = "WEEKLY_CALLS_DURATION"
     _OVERALL_CALLS_DURATION = "OVERALL_CALL_DURATION"
@@ -112,44 +149,59 @@ class Storage:
     _LAST_CDR_START = "LAST_CDR_START"
     _MONITOR_SLEPT_AT = "MONITOR_SLEPT_AT"
     _DAILY_STATUS_SENT = "DAILY_STATUS_SENT"
-
-    def daily_calls_duration(self, default=0, field="value"):
-        result = self._db.get(self._DAILY_CALLS_DURATION, field) or default
+    _CALL_STATE = "CALL_STATE"
+    _LAST_CDR_SEEN = "LAST_CDR_SEEN"
+
+    def __init__(self):
+        try:
+            self._db = DBStorage()
+        except Exception as e:
+            log.error("[Storage] Error while init of DB storage: %s. Using in-memory one" % e)
+            self._db = MemoryStorage()
+        atexit.register(self._db.close)
+
+    @staticmethod
+    def _line_key(key, line):
+        # keys of the 1st line are left as is to keep using the values already stored in the DB
+        return key if line == 1 else "%s_L%d" % (key, line)
+
+    def daily_calls_duration(self, default=0, field="value", line=1):
+        result = self._db.get(self._line_key(self._DAILY_CALLS_DURATION, line), field) or default
         if field == "value":
             return int(result)
         elif field == "date":
             return datetime.strptime(result, '%Y-%m-%d %H:%M:%S.%f')
         return result
 
-    def set_daily_calls_duration(self, value):
-        return self._db.set(self._DAILY_CALLS_DURATION, int(value))
+    def set_daily_calls_duration(self, value, line=1):
+        return self._db.set(self._line_key(self._DAILY_CALLS_DURATION, line), int(value))
 
-    def increase_daily_call_duration(self, value):
-        duration = int(self.daily_calls_duration(default=0))
+    def increase_daily_call_duration(self, value, line=1):
+        duration = int(self.daily_calls_duration(default=0, line=line))
         value = int(value)
-        self.set_daily_calls_duration(duration + value)
+        self.set_daily_calls_duration(duration + value, line=line)
 
-    def weekly_calls_duration(self, default=0):
-        return int(self._db.get(self._WEEKLY_CALLS_DURATION) or default)
+    def weekly_calls_duration(self, default=0, line=1):
+        return int(self._db.get(self._line_key(self._WEEKLY_CALLS_DURATION, line)) or default)
 
-    def set_weekly_calls_duration(self, value):
-        return self._db.set(self._WEEKLY_CALLS_DURATION, int(value))
+    def set_weekly_calls_duration(self, value, line=1):
+        return self._db.set(self._line_key(self._WEEKLY_CALLS_DURATION, line), int(value))
 
-    def increase_weekly_call_duration(self, value):
-        duration = int(self.weekly_calls_duration(default=0))
+    def increase_weekly_call_duration(self, value, line=1):
+        duration = int(self.weekly_calls_duration(default=0, line=line))
         value = int(value)
-        self.set_weekly_calls_duration(duration + value)
+        self.set_weekly_calls_duration(duration + value, line=line)
 
-    def overall_call_duration(self, default=0):
-        return int(self._db.get(self._OVERALL_CALLS_DURATION) or default)
+    def overall_call_duration(self, default=0, line=1):
+        return int(self._db.get(self._line_key(self._OVERALL_CALLS_DURATION, line)) or default)
 
-    def set_overall_call_duration(self, value):
-        return self._db.set(self._OVERALL_CALLS_DURATION, int(value))
+    def set_overall_call_duration(self, value, line=1):
+        return self._db.set(self._line_key(self._OVERALL_CALLS_DURATION, line), int(value))
 
-    def increase_overall_call_duration(self, value):
-        duration = self.overall_call_duration(default=0)
+    def increase_overall_call_duration(self, value, line=1):
+        duration = self.overall_call_duration(default=0, line=line)
         value = int(value)
-        self.set_overall_call_duration(duration + value)
+        self.set_overall_call_duration(duration + value, line=line)
 
     def daily_fixed_times(self, default=0):
         return int(self._db.get(self._DAILY_FIXED_TIMES) or default)
@@ -162,27 +214,27 @@ class Storage:
         value = int(value)
         self.set_daily_fixed_times(fixed + value)
 
-    def daily_ok_calls_amount(self, default=0):
-        return int(self._db.get(self._DAILY_OK_CALLS_AMOUNT) or default)
+    def daily_ok_calls_amount(self, default=0, line=1):
+        return int(self._db.get(self._line_key(self._DAILY_OK_CALLS_AMOUNT, line)) or default)
 
-    def set_daily_ok_calls_amount(self, value):
-        return self._db.set(self._DAILY_OK_CALLS_AMOUNT, int(value))
+    def set_daily_ok_calls_amount(self, value, line=1):
+        return self._db.set(self._line_key(self._DAILY_OK_CALLS_AMOUNT, line), int(value))
 
-    def increase_daily_ok_calls_amount(self, value):
-        calls = self.daily_ok_calls_amount(default=0)
+    def increase_daily_ok_calls_amount(self, value, line=1):
+        calls = self.daily_ok_calls_amount(default=0, line=line)
         value = int(value)
-        self.set_daily_ok_calls_amount(calls + value)
+        self.set_daily_ok_calls_amount(calls + value, line=line)
 
-    def daily_failed_calls_amount(self, default=0):
-        return int(self._db.get(self._DAILY_FAILED_CALLS_AMOUNT) or default)
+    def daily_failed_calls_amount(self, default=0, line=1):
+        return int(self._db.get(self._line_key(self._DAILY_FAILED_CALLS_AMOUNT, line)) or default)
 
-    def set_daily_failed_calls_amount(self, value):
-        return self._db.set(self._DAILY_FAILED_CALLS_AMOUNT, int(value))
+    def set_daily_failed_calls_amount(self, value, line=1):
+        return self._db.set(self._line_key(self._DAILY_FAILED_CALLS_AMOUNT, line), int(value))
 
-    def increase_daily_failed_calls_amount(self, value):
-        calls = self.daily_failed_calls_amount(default=0)
+    def increase_daily_failed_calls_amount(self, value, line=1):
+        calls = self.daily_failed_calls_amount(default=0, line=line)
         value = int(value)
-        self.set_daily_failed_calls_amount(calls + value)
+        self.set_daily_failed_calls_amount(calls + value, line=line)
 
     def last_date_error_notified(self, default=None):
         value = self._db.get(self._LAST_TIME_ERROR_NOTIFIED) or default
@@ -212,11 +264,34 @@ class Storage:
     def set_daily_status_sent(self, value):
         return self._db.set(self._DAILY_STATUS_SENT, value.strftime(DATETIME_FORMAT) if value else value)
 
-    def current_balance(self, default=0.0):
-        return float(self._db.get(self._INITIAL_BALANCE) or default)
+    def current_balance(self, default=0.0, line=1):
+        return float(self._db.get(self._line_key(self._INITIAL_BALANCE, line)) or default)
+
+    def set_current_balance(self, value, line=1):
+        return self._db.set(self._line_key(self._INITIAL_BALANCE, line), float(value))
 
-    def set_current_balance(self, value):
-        return self._db.set(self._INITIAL_BALANCE, float(value))
+    def call_state(self, line=1):
+        value = self._db.get(self._line_key(self._CALL_STATE, line))
+        return json.loads(value) if value else None
+
+    def set_call_state(self, value, line=1):
+        return self._db.set(self._line_key(self._CALL_STATE, line), json.dumps(value) if value else None)
+
+    def add_call(self, started, number, seconds, ok, source="poll", line=1):
+        return self._db.add_call(line, started.strftime(CALL_TIME_FORMAT), number, int(seconds), int(bool(ok)), source)
+
+    def calls(self, since, till, line=None):
+        """Returns the calls started within [since, till) as [(line, started, number, seconds, ok, source)]"""
+        return [(call_line, datetime.strptime(started, CALL_TIME_FORMAT), number, seconds, bool(ok), source)
+                for call_line, started, number, seconds, ok, source in
+                self._db.calls(since.strftime(CALL_TIME_FORMAT), till.strftime(CALL_TIME_FORMAT), line=line)]
+
+    def last_cdr_seen(self, line=1):
+        value = self._db.get(self._line_key(self._LAST_CDR_SEEN, line))
+        return datetime.strptime(value, CALL_TIME_FORMAT) if value else None
+
+    def set_last_cdr_seen(self, value, line=1):
+        return self._db.set(self._line_key(self._LAST_CDR_SEEN, line), value.strftime(CALL_TIME_FORMAT))
 
     def last_reg_status(self, default="UNDEFINED"):
         return self._db.get(self._LAST_REG_STATUS) or default
@@ -224,6 +299,3 @@ class Storage:
     def set_last_reg_status(self, value):
         return self._db.set(self._LAST_REG_STATUS, value)
 
-
-vs = Storage()
-atexit.register(vs._db.close)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# coding=utf-8
+import threading
+
+from src.app import vs
+from src.const import DATE_FORMAT
+from src.utils import log, current_time, current_date, seconds_to_time_str
+
+
+class LineDigest:
+    """Values of the single line the daily status is made of. Counters are loaded from the DB once
+    and then kept up to date by the events, balance is the latest USSD sample.
+    """
+    def __init__(self, line):
+        self.line = line
+        self.ok_calls = vs.daily_ok_calls_amount(line=line)
+        self.failed_calls = vs.daily_failed_calls_amount(line=line)
+        self.duration = vs.daily_calls_duration(line=line)
+        self.weekly_duration = vs.weekly_calls_duration(line=line)  # without today's calls
+        self.initial_balance = vs.current_balance(line=line)
+        self.clear_samples()
+
+    def clear_samples(self):
+        """Samples are per day, so the one missing on the next day is noticed and taken again"""
+        self.money = None
+        self.tariff = None
+        self.number_valid_till = None
+        self.monthly_minutes_left = None
+        self.monthly_valid_days = None
+        self.yearly_valid_till = None
+
+    def render(self, scheduled_run=True, today_is_sunday=False):
+        string = ""
+        all_calls = self.ok_calls + self.failed_calls
+        calls_stats = " (%d%%)" % (100 * self.ok_calls / all_calls) if all_calls > 0 else ""
+        if self.duration:
+            duration_str = "%s%s" % (seconds_to_time_str(self.duration, no_seconds=True), calls_stats)
+        else:
+            duration_str = "не було"
+        string += "Розмов %s\n" % duration_str
+        if today_is_sunday or not scheduled_run:  # if it's Sunday or on-demand info request
+            string += "За тиждень %s\n" % seconds_to_time_str(self.weekly_duration + self.duration, no_seconds=True)
+        if self.money is not None:
+            string += "На рахунку %s грн" % self.money
+            diff = round(self.money - self.initial_balance, 2)
+            if diff != 0:
+                string += " (%s грн)" % ("+%s" % diff if diff > 0 else str(diff))
+            string += "\n"
+        if self.monthly_minutes_left is not None:
+            days = self.monthly_valid_days
+            string += "%s хв %s\n" % (self.monthly_minutes_left, "на %s дні(в)" % days if days > 0 else "до сьогодні")
+        if self.tariff:
+            string += "Тариф %s\n" % self.tariff
+        if self.number_valid_till or self.yearly_valid_till:
+            if self.yearly_valid_till and self.number_valid_till and self.yearly_valid_till < self.number_valid_till:
+                valid_till = self.yearly_valid_till
+            else:
+                valid_till = self.number_valid_till or self.yearly_valid_till  # as 1 might be None
+            days_left = (valid_till - current_time()).days
+            if days_left < 10:
+                string += "<b>Поповни! Лишилось %s дні(в)</b>\n" % days_left
+            string += "Рік/номер до %s\n" % valid_till.strftime(DATE_FORMAT)
+        return string
+
+
+class Digest:
+    """Daily status maintained incrementally: calls, balance samples and fixes update it during the day,
+    so the report is just rendered from the memory, without USSD requests and DB reads in the monitor loop.
+    The counters are written to the DB through the digest as well, so the end-of-day rollover (done in background)
+    can't interleave with the call being recorded.
+    """
+    _lines = {}
+    _fixed_times = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def _line(cls, line):
+        digest = cls._lines.get(line)
+        if digest is None:
+            digest = cls._lines[line] = LineDigest(line)
+        return digest
+
+    @classmethod
+    def call(cls, line, seconds, ok):
+        with cls._lock:
+            digest = cls._line(line)
+            if ok:
+                digest.duration += int(seconds)
+                digest.ok_calls += 1
+                vs.increase_daily_call_duration(seconds, line=line)
+                vs.increase_daily_ok_calls_amount(1, line=line)
+            else:
+                digest.failed_calls += 1
+                vs.increase_daily_failed_calls_amount(1, line=line)
+
+    @classmethod
+    def fixed(cls):
+        with cls._lock:
+            cls._fixed_times = (cls._fixed_times or vs.daily_fixed_times()) + 1
+            vs.set_daily_fixed_times(cls._fixed_times)
+
+    @classmethod
+    def balance_sampled(cls, line, money, tariff, number_valid_till):
+        with cls._lock:
+            digest = cls._line(line)
+            digest.money, digest.tariff, digest.number_valid_till = money, tariff, number_valid_till
+
+    @classmethod
+    def monthly_sampled(cls, line, minutes_left, valid_days):
+        with cls._lock:
+            digest = cls._line(line)
+            digest.monthly_minutes_left, digest.monthly_valid_days = minutes_left, valid_days
+
+    @classmethod
+    def yearly_sampled(cls, line, valid_till):
+        with cls._lock:
+            cls._line(line).yearly_valid_till = valid_till
+
+    @classmethod
+    def sample(cls, lines=1):
+        """Takes the fresh balance samples (USSD requests) - they are reported to the digest by the sms module"""
+        from src.sms import balance, monthly_status, yearly_status
+        for line in range(1, lines + 1):
+            balance(line=line)
+            monthly_status(line=line)
+            yearly_status(line=line)
+
+    @classmethod
+    def sample_async(cls, lines=1):
+        def run():
+            try:
+                cls.sample(lines)
+            except Exception as e:
+                log.error("[Digest] Balance sampling failed: %s" % e)
+        threading.Thread(target=run, name="DigestSample", daemon=True).start()
+
+    @classmethod
+    def render(cls, lines=1, scheduled_run=True):
+        today_is_sunday = current_date().strftime("%w") == "0"
+        with cls._lock:
+            string = ""
+            for line in range(1, lines + 1):
+                line_string = cls._line(line).render(scheduled_run=scheduled_run, today_is_sunday=today_is_sunday)
+                if lines > 1:
+                    line_string = "<b>Лінія %d</b>\n%s" % (line, line_string)
+                string += line_string
+            fixed_times = cls._fixed_times if cls._fixed_times is not None else vs.daily_fixed_times()
+        if fixed_times:
+            string += "<b>Полагоджено %s раз(и)</b>\n" % fixed_times
+        return string
+
+    @classmethod
+    def rollover(cls, lines=1, reset_weekly=False):
+        """Starts the new day: today's calls go to the weekly and overall durations, the latest balance sample
+        becomes the initial balance of the new day. Weekly durations are reset as well at the end of the week.
+        """
+        if any(cls._line(line).money is None for line in range(1, lines + 1)):
+            try:
+                cls.sample(lines)  # the balance is required for the diff tomorrow, so make sure it's sampled
+            except Exception as e:
+                log.error("[Digest] Balance sampling failed: %s" % e)
+        with cls._lock:
+            for line in range(1, lines + 1):
+                digest = cls._line(line)
+                weekly = 0 if reset_weekly else digest.weekly_duration + digest.duration
+                vs.set_weekly_calls_duration(weekly, line=line)
+                vs.increase_overall_call_duration(digest.duration, line=line)
+                vs.set_current_balance(digest.money or 0.0, line=line)
+                vs.set_daily_calls_duration(0, line=line)
+                vs.set_daily_ok_calls_amount(0, line=line)
+                vs.set_daily_failed_calls_amount(0, line=line)
+                digest.weekly_duration = weekly
+                digest.initial_balance = digest.money or 0.0
+                digest.duration = digest.ok_calls = digest.failed_calls = 0
+                digest.clear_samples()
+            vs.set_daily_fixed_times(0)
+            cls._fixed_times = 0
+        log.info("[Digest] New day started for %d line(s)" % lines)
+
+    @classmethod
+    def rollover_async(cls, lines=1, reset_weekly=False):
+        def run():
+            try:
+                cls.rollover(lines, reset_weekly=reset_weekly)
+            except Exception as e:
+                log.error("[Digest] Rollover failed: %s" % e)
+        threading.Thread(target=run, name="DigestRollover", daemon=True).start()
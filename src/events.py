@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+from src.const import EVENT_QUEUE_SIZE, EVENT_BLOCK_SECONDS
+from src.metrics import Metrics, timing
+from src.utils import log
+
+# dialing of the call started or its status changed (msg - handle of the call progress message)
+CallStarted = namedtuple("CallStarted", ["line", "number", "status_message", "msg"])
+CallConnected = namedtuple("CallConnected", ["line", "number", "msg"])
+# source: 'poll' - the call is detected by the status polls, 'cdr' - taken from the GoIP call record (no message then)
+CallEnded = namedtuple("CallEnded", ["line", "number", "started", "seconds", "ok", "status_message", "msg", "source"])
+# fixing - the reset/restore is started, otherwise it's failed to fix
+RegistrationLost = namedtuple("RegistrationLost", ["status", "uptime_seconds", "talk_seconds", "fixing"])
+# kind: 'reset_restore' or 'reboot'
+GatewayRecovered = namedtuple("GatewayRecovered", ["kind"])
+SmsReceived = namedtuple("SmsReceived", ["sender", "text"])
+
+# what is done when the subscriber queue is full
+BLOCK, DROP_OLDEST, DROP_NEWEST = "block", "drop_oldest", "drop_newest"
+
+
+class Subscriber:
+    """Bounded queue of the events of the single consumer drained by its own worker thread,
+    so the slow consumer doesn't delay the publisher or the other consumers.
+    """
+    def __init__(self, name, handler, types, size=EVENT_QUEUE_SIZE, policy=BLOCK):
+        self.name = name
+        self.handler = handler
+        self.types = tuple(types)
+        self.size = size
+        self.policy = policy
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self._pid = None
+
+    def _ensure_worker(self):
+        # the worker thread is not inherited by the forked processes (SMPP listener), so each gets its own one
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._items = deque()
+        self._busy = False
+        threading.Thread(target=self._work, name="Events-%s" % self.name, daemon=True).start()
+
+    def put(self, event):
+        self._ensure_worker()
+        with self._cond:
+            if len(self._items) >= self.size:
+                if self.policy == BLOCK:
+                    # back-pressure: the publisher waits for the room, but not forever - the poll must go on
+                    self._cond.wait_for(lambda: len(self._items) < self.size, timeout=EVENT_BLOCK_SECONDS)
+                if len(self._items) >= self.size:
+                    victim = self._items.popleft() if self.policy == DROP_OLDEST else event
+                    self._drop(victim)
+                    if victim is event:
+                        return False
+            self._items.append(event)
+            Metrics.set("goip_event_queue_depth", len(self._items), subscriber=self.name)
+            self._cond.notify_all()
+        return True
+
+    def _drop(self, event):
+        self.dropped += 1
+        Metrics.inc("goip_events_dropped_total", subscriber=self.name)
+        log.warning("[Events] Queue of '%s' is full - dropping %s" % (self.name, type(event).__name__))
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._items)
+                event = self._items.popleft()
+                Metrics.set("goip_event_queue_depth", len(self._items), subscriber=self.name)
+                self._busy = True
+                self._cond.notify_all()
+            try:
+                with timing("events.%s" % self.name):
+                    self.handler(event)
+                self.handled += 1
+            except Exception as e:
+                self.errors += 1
+                Metrics.inc("goip_event_errors_total", subscriber=self.name)
+                log.error("[Events] '%s' failed to handle %s: %s" % (self.name, event, e))
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def flush(self, timeout):
+        if self._pid != os.getpid():
+            return True
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._items and not self._busy, timeout=timeout)
+
+    def depth(self):
+        return len(self._items) if self._pid == os.getpid() else 0
+
+
+class EventBus:
+    """In-process bus of the call and gateway events. The monitor loop only publishes the events -
+    Telegram messages, storage writes and metrics are done by the subscribers in their own threads.
+    Each subscriber gets the events of its types in the order they were published.
+    """
+    _subscribers = []
+    _lock = threading.Lock()
+
+    @classmethod
+    def subscribe(cls, name, handler, types, size=EVENT_QUEUE_SIZE, policy=BLOCK):
+        subscriber = Subscriber(name, handler, types, size=size, policy=policy)
+        with cls._lock:
+            cls._subscribers = [s for s in cls._subscribers if s.name != name] + [subscriber]
+        return subscriber
+
+    @classmethod
+    def publish(cls, event):
+        Metrics.inc("goip_events_total", event=type(event).__name__)
+        for subscriber in cls._subscribers:
+            if isinstance(event, subscriber.types):
+                subscriber.put(event)
+
+    @classmethod
+    def flush(cls, timeout=5.0):
+        """Waits for the queued events to be handled (e.g. before the exit). Returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        return all([s.flush(max(0.0, deadline - time.monotonic())) for s in cls._subscribers])
+
+    @classmethod
+    def summary(cls):
+        lines = ["%-10s %6s %7s %7s %6s" % ("subscriber", "queue", "handled", "dropped", "errors")]
+        for s in cls._subscribers:
+            lines.append("%-10s %6d %7d %7d %6d" % (s.name, s.depth(), s.handled, s.dropped, s.errors))
+        return "\n".join(lines)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding=utf-8
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.const import METRICS_LISTEN, METRICS_PORT
+from src.metrics import Metrics
+from src.utils import log
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, escape_label(value)) for key, value in labels)
+
+
+def render():
+    """Renders the collected metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, (kind, values) in Metrics.values().items():
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in sorted(values.items()):
+            lines.append("%s%s %s" % (name, format_labels(labels), float(value)))
+    # durations of the operations (poll cycle, USSD, Telegram delivery etc) are exposed as the single summary
+    name = "goip_operation_seconds"
+    lines.append("# TYPE %s summary" % name)
+    for operation, s in Metrics.snapshot().items():
+        for quantile in ["0.5", "0.95", "0.99"]:
+            labels = (("operation", operation), ("quantile", quantile))
+            lines.append("%s%s %s" % (name, format_labels(labels), s["p%d" % round(float(quantile) * 100)]))
+        labels = (("operation", operation), )
+        lines.append("%s_sum%s %s" % (name, format_labels(labels), s["sum"]))
+        lines.append("%s_count%s %s" % (name, format_labels(labels), s["count"]))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass  # scrapes are too frequent to be logged
+
+
+class MetricsExporter:
+    server = None
+
+    @classmethod
+    def start(cls, listen=METRICS_LISTEN, port=METRICS_PORT):
+        """Serves /metrics from the own thread, so scrapes never wait for the monitor loop."""
+        if cls.server or not port:
+            return
+        cls.server = ThreadingHTTPServer((listen, port), MetricsHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, name="Metrics", daemon=True).start()
+        log.info("[Metrics exporter] Listening on %s:%d" % (listen, port))
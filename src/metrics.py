@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+from src.const import METRICS_ENABLED, METRICS_SAMPLES
+from src.tracing import Tracer
+from src.utils import log
+
+
+class Histogram:
+    """Durations of the single operation. Percentiles are calculated over the last `samples` values."""
+    def __init__(self, samples=METRICS_SAMPLES):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.values = deque(maxlen=samples)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.values.append(value)
+
+    def percentile(self, p, values=None):
+        values = values if values is not None else sorted(self.values)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+    def snapshot(self):
+        values = sorted(self.values)
+        return {"count": self.count, "sum": self.total, "max": self.max, "p50": self.percentile(50, values),
+                "p95": self.percentile(95, values), "p99": self.percentile(99, values)}
+
+
+class Metrics:
+    COUNTER, GAUGE = "counter", "gauge"
+    enabled = METRICS_ENABLED
+    _histograms = {}
+    _values = {}  # name => (type, {labels => value})
+    _lock = threading.Lock()
+
+    @classmethod
+    def record(cls, name, seconds):
+        if not cls.enabled:
+            return
+        with cls._lock:
+            histogram = cls._histograms.get(name)
+            if histogram is None:
+                histogram = cls._histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    @classmethod
+    def _update(cls, kind, name, value, labels, increment):
+        if not cls.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with cls._lock:
+            _, values = cls._values.setdefault(name, (kind, {}))
+            values[key] = values.get(key, 0) + value if increment else value
+
+    @classmethod
+    def inc(cls, name, value=1, **labels):
+        """Increases the counter (names are expected to end with '_total' as Prometheus suggests)."""
+        cls._update(cls.COUNTER, name, value, labels, increment=True)
+
+    @classmethod
+    def set(cls, name, value, **labels):
+        """Sets the gauge value."""
+        cls._update(cls.GAUGE, name, value, labels, increment=False)
+
+    @classmethod
+    def values(cls):
+        with cls._lock:
+            return {name: (kind, dict(values)) for name, (kind, values) in sorted(cls._values.items())}
+
+    @classmethod
+    def snapshot(cls):
+        with cls._lock:
+            return {name: histogram.snapshot() for name, histogram in sorted(cls._histograms.items())}
+
+    @classmethod
+    def summary(cls):
+        lines = ["%-28s %7s %8s %8s %8s %8s" % ("operation", "count", "p50", "p95", "p99", "max")]
+        for name, s in cls.snapshot().items():
+            lines.append("%-28s %7d %8.3f %8.3f %8.3f %8.3f" % (name, s["count"], s["p50"], s["p95"], s["p99"], s["max"]))
+        return "\n".join(lines)
+
+    @classmethod
+    def log_summary(cls):
+        if cls.enabled:
+            log.info("[Metrics] Timings (sec):\n%s" % cls.summary())
+
+
+# the forked process (SMPP listener) could get the lock held by the other thread
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: setattr(Metrics, "_lock", threading.Lock()))
+
+
+class _Timing:
+    __slots__ = ("name", "started", "span")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.span = Tracer.start(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.started
+        Metrics.record(self.name, duration)
+        if self.span is not None:
+            Tracer.finish(self.span, duration)
+        return False
+
+
+class _NoTiming:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_timing = _NoTiming()
+
+
+def timing(name):
+    """Context manager recording the duration of its body as the `name` operation (and trace span)."""
+    return _Timing(name) if Metrics.enabled or Tracer.enabled else _no_timing
+
+
+def timed(name):
+    """Decorator recording the duration of each call as the `name` operation (and trace span).
+    Functions are left untouched when both metrics and tracing are disabled, so there is no overhead at all.
+    """
+    def deco_timed(f):
+        if not Metrics.enabled and not Tracer.enabled:
+            return f
+
+        @wraps(f)
+        def f_timed(*args, **kwargs):
+            started = time.perf_counter()
+            span = Tracer.start(name)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - started
+                Metrics.record(name, duration)
+                if span is not None:
+                    Tracer.finish(span, duration)
+        return f_timed
+    return deco_timed
@@ -1,101 +1,41 @@
 #!/usr/bin/env python
 # coding=utf-8
 import re
+import time
+from datetime import datetime
 
-from src.db import vs
+from src.app import App, vs, bot, pbot, scheduler
 from src.browser import BrowserWrapper, NotLoggedIn
-from src.bot.common import bot
-from src.bot.personal import RebootRequest, ResetRestoreRequest, BalanceRequest, pbot, SendUssdRequest, SendSmsRequest
-from src.const import DEFAULT_GOIP_PWD, SMPP_USER, SMPP_SECRET, SENDER_PHONE, \
-    GOIP_MONITOR_SLEEP_SECONDS, LAST_CALL_SLEEP_SECONDS, DATE_FORMAT, GREETING_PHRASES
-from src.sms import balance, monthly_status, yearly_status, SmsWrapper
+from src.bot.outbox import MessageHandle
+from src.cdr import CdrReconciler
+from src.const import DEFAULT_GOIP_PWD, SMPP_USER, SMPP_SECRET, LINE_SENDER_PHONES, \
+    GOIP_MONITOR_SLEEP_SECONDS, LAST_CALL_SLEEP_SECONDS, GREETING_PHRASES, METRICS_SUMMARY_SECONDS, \
+    DATETIME_FORMAT, CALL_STATE_MAX_AGE_SECONDS, MONITOR_MAX_CYCLE_ERRORS, DIGEST_SAMPLE_MINUTES, \
+    DAILY_STATUS_DEADLINE_SECONDS
+from src.digest import Digest
+from src.events import EventBus, CallStarted, CallConnected, CallEnded, RegistrationLost, GatewayRecovered
+from src.metrics import Metrics, timing
+from src.replay import LineStateRecorder
+from src.resilience import RetryBudget
+from src.sinks import subscribe_sinks
+from src.sms import SmsWrapper
+from src.startup import Startup, seconds_since_start
+from src.supervisor import Supervisor
+from src.tracing import trace
 from src.utils import random_list_item, current_time, seconds_to_time_str, log, passed_more_that_sec, \
-    current_date, sleep
-
-
-def reset_daily_values(money=0.0):
-    log.info("[Reset daily values] Setting initial values")
-    if not money:
-        _, money, _, _ = balance()
-    vs.set_current_balance(money)
-    vs.increase_overall_call_duration(vs.daily_calls_duration())
-    vs.set_daily_calls_duration(0)
-    vs.set_daily_fixed_times(0)
-    vs.set_daily_ok_calls_amount(0)
-    vs.set_daily_failed_calls_amount(0)
-
-
-def daily_balance_diff(money=0.0):
-    if not money:
-        _, money, _, _ = balance()
-    diff = round(money - vs.current_balance(), 2)
-    res = "+%s" % diff if diff > 0 else str(diff)
-    return diff != 0, res
-
-
-def daily_status(scheduled_run=True):
-    has_balance_info, money, tariff, number_valid_till = balance()
-    has_monthly_info, monthly_minutes_left, monthly_valid_days = monthly_status()
-    has_yearly_info, yearly_valid_till = yearly_status()
-    string = ""
-    ok_calls_amt = vs.daily_ok_calls_amount()
-    failed_calls_amt = vs.daily_failed_calls_amount()
-    all_calls_amt = ok_calls_amt + failed_calls_amt
-    calls_duration = vs.daily_calls_duration()
-    fixed_times = vs.daily_fixed_times()
-    today_is_sunday = current_date().strftime("%w") == "0"
-    # daily calls status
-    if all_calls_amt > 0:
-        calls_stats = " (%d%%)" % (100 * ok_calls_amt / all_calls_amt)
-    else:
-        calls_stats = ""
-    if calls_duration:
-        duration_str = seconds_to_time_str(calls_duration, no_seconds=True)  # omit the seconds part
-        duration_str = "%s%s" % (duration_str, calls_stats)
-        if scheduled_run:
-            vs.increase_weekly_call_duration(calls_duration)
-    else:
-        duration_str = "не було"
-    string += "Розмов %s\n" % duration_str
-    # weekly calls status
-    weekly_calls_duration = vs.weekly_calls_duration()
-    if not scheduled_run:  # as we do not increment weekly calls duration if it's a not scheduled_run
-        weekly_calls_duration += calls_duration
-    if today_is_sunday or not scheduled_run:  # if it's Sunday or on-demand info request
-        duration_str = seconds_to_time_str(weekly_calls_duration, no_seconds=True)  # omit the seconds part
-        string += "За тиждень %s\n" % duration_str
-    if has_balance_info:
-        string += "На рахунку %s грн" % money
-        has_money_diff, money_diff = daily_balance_diff(money=money)
-        if has_money_diff:
-            string += " (%s грн)" % money_diff
-        string += "\n"
-    if has_monthly_info:
-        days_add = "на %s дні(в)" % monthly_valid_days if monthly_valid_days > 0 else "до сьогодні"
-        string += "%s хв %s\n" % (monthly_minutes_left, days_add)
-    if fixed_times:
-        string += "<b>Полагоджено %s раз(и)</b>\n" % fixed_times
-    if tariff:
-        string += "Тариф %s\n" % tariff
-    if number_valid_till or yearly_valid_till:
-        if yearly_valid_till and yearly_valid_till < number_valid_till:
-            valid_till = yearly_valid_till
-        else:
-            valid_till = number_valid_till or yearly_valid_till  # as 1 might be None
-        days_left = (valid_till - current_time()).days
-        if days_left < 10:
-            string += "<b>Поповни! Лишилось %s дні(в)</b>\n" % days_left
-        string += "Рік/номер до %s\n" % valid_till.strftime(DATE_FORMAT)
-    if scheduled_run:
-        reset_daily_values(money=money)
-        if today_is_sunday:
-            vs.set_weekly_calls_duration(0)
-    return string
+    current_date, sleep, log_context, flush_log_repeats
+from src.watchdog import Watchdog
+
+
+def daily_status(lines=1, scheduled_run=True):
+    if not scheduled_run:  # on-demand request gets the fresh balance, the scheduled one uses the samples taken before
+        Digest.sample(lines)
+    return Digest.render(lines, scheduled_run=scheduled_run)
 
 
 class GoipMonitor:
-    goip_slept_at = None
     voip_connection_status = None
+    lines = 1
 
     def __init__(self, url, uname, pwd, sip, spwd):
         if not url.startswith("http"):
@@ -105,15 +45,37 @@ class GoipMonitor:
         self.pwd = pwd
         self.sip = sip
         self.spwd = spwd
-        self.init_browser()
-        self.init_sms()
+        # bot messages, storage writes and metrics of the events are done in background, off the monitor loop
+        subscribe_sinks(lines=lambda: self.lines)
+        # independent steps run concurrently - the slowest one (browser login) defines the startup time.
+        # SMPP listener is a forked process, so it's started on this thread rather than in the pool
+        Startup("GoipMonitor start") \
+            .add("browser", self.init_browser) \
+            .add("sms", self.init_sms, on_caller=True) \
+            .add("db", self.load_daily_state) \
+            .add("bot", bot.connect) \
+            .add("personal_bot", lambda: App.get("personal_bot")) \
+            .add("daily_values", self.init_daily_values, after=["browser", "sms", "db"]) \
+            .add("greeting", self.send_greeting, after=["db", "bot"]) \
+            .run()
+        log.info("[GoipMonitor] Started in %.1f sec since the application start" % seconds_since_start())
+        # the failed component is restarted on its own, without the reset of the whole application
+        Supervisor.register("browser", BrowserWrapper.alive, self.restart_browser)
+        Supervisor.register("smpp", SmsWrapper.alive, self.restart_sms)
+
+    def load_daily_state(self):
+        self.daily_values_date = vs.daily_calls_duration(field="date", default="1970-01-01 00:00:00.000").date()
+        self.monitor_slept_at = vs.monitor_slept_at(notify=True)
+
+    def init_daily_values(self):
         # if daily call duration is from today
-        if vs.daily_calls_duration(field="date", default="1970-01-01 00:00:00.000").date() != current_date().date():
-            vs.increase_weekly_call_duration(vs.daily_calls_duration())  # as we will reset this value
-            reset_daily_values()  # set default values for the daily status
+        if self.daily_values_date != current_date().date():
+            Digest.rollover(lines=self.lines)  # set default values for the daily status
         else:
             log.info("[GoipMonitor] Recent restart - do not reset daily calls duration.")
-        if passed_more_that_sec(vs.monitor_slept_at(notify=True), 30*60):  # if not restarted within 20-30 minutes
+
+    def send_greeting(self):
+        if passed_more_that_sec(self.monitor_slept_at, 30*60):  # if not restarted within 20-30 minutes
             bot.send(random_list_item(GREETING_PHRASES))
         else:
             log.info("[GoipMonitor] Regular restart - no greeting was sent")
@@ -126,76 +88,126 @@ class GoipMonitor:
             if pwd != DEFAULT_GOIP_PWD:
                 log.warning("[Init Browser] Logging in using default password")
                 BrowserWrapper.init(self.url, self.uname, DEFAULT_GOIP_PWD)
-        BrowserWrapper.b.driver.refresh()
+        BrowserWrapper.b.refresh()
+        self.lines = len(BrowserWrapper.b.lines_status()) or 1
+        log.info("[Init browser] Found %d line(s) at the caller" % self.lines)
+
+    def restart_browser(self):
+        BrowserWrapper.terminate()  # the command hung in PhantomJS fails at once and releases the browser lock
+        with BrowserWrapper.lock:
+            self.init_browser()
+            BrowserWrapper.b.open_menu("Status")
+
+    def recycle_browser(self, reason):
+        log.info("[GoipMonitor] Recycling the browser: %s" % reason)
+        with BrowserWrapper.lock, Supervisor.suspended("browser recycle"):
+            self.init_browser()
+            BrowserWrapper.b.open_menu("Status")
+
+    def line_numbers(self):
+        return range(1, self.lines + 1)
 
     def init_sms(self, notify=False):
         SmsWrapper.init(self.url, self.uname, self.pwd, notify_module_is_up=notify)
 
+    def restart_sms(self):
+        # no message on each failed attempt - Supervisor sends one when the restart budget is exhausted
+        SmsWrapper.init(self.url, self.uname, self.pwd, notify_module_is_down=False)
+
     def send_caller_status(self, status):
         seconds_up_sec = BrowserWrapper.b.uptime_sec()
-        up_str = seconds_to_time_str(seconds_up_sec)
-        talk_time_sec = vs.overall_call_duration()
-        talk_str = seconds_to_time_str(talk_time_sec)
+        talk_time_sec = sum(vs.overall_call_duration(line=line) for line in self.line_numbers())
         BrowserWrapper.b.screenshot(name="before-reset", force=True)
-        add_status = "\n%s\n" % status if status else ""
-        bot.send("Дзвонилка <b>не фуричить</b>.%sЗапущена вже %s\nНаговорили %s\nПереналаштовую..." %
-                 (add_status, up_str, talk_str))
+        EventBus.publish(RegistrationLost(status, seconds_up_sec, talk_time_sec, fixing=True))
 
     def reset_and_restore(self):
+        with Supervisor.suspended("reset and restore"):
+            self._reset_and_restore()
+
+    def _reset_and_restore(self):
         last_reg_status = vs.last_reg_status(None)
         log.info("[Reset and restore] Caller stopped working. %s" % last_reg_status)
+        Metrics.inc("goip_recoveries_total", kind="reset_restore")
         self.send_caller_status(last_reg_status)
-        vs.set_overall_call_duration(0)  # reset it as caller is not working
+        for line in self.line_numbers():
+            vs.set_overall_call_duration(0, line=line)  # reset it as caller is not working
         self.reset_config()
         self.restore_config()
         if self.statuses_ok():
             log.info("[Reset and restore] Caller is working now")
-            bot.send("Дзвонилка <b>працює</b>. Просто крутизна!")
+            EventBus.publish(GatewayRecovered("reset_restore"))
         else:
             log.info("[Reset and restore] Caller is not working after fix")
-            bot.send("Дзвонилка <b>не працює</b>. Спробую ще пізніше.")
+            EventBus.publish(RegistrationLost(vs.last_reg_status(), None, None, fixing=False))
 
-    def statuses_ok(self):
-        log.info("[Statuses ok] Checking")
-        b = BrowserWrapper.b
-        sim = b.by_id("l1_gsm_sim").text.strip()
-        gsm = b.by_id("l1_gsm_status").text.strip()
-        voip = b.by_id("l1_status_line").text.strip()
-        vs.set_last_reg_status(None)  # reset value
+    def line_status(self, status):
+        """Returns (voip_ok, reg_status) for the single line status taken from Browser.lines_status()"""
+        sim = status["gsm_sim"]
+        gsm = status["gsm_status"]
+        voip = status["status_line"]
         if voip == "401":
             log.error("[Statuses ok] Incorrect SIP username/password specified.")
-            # try to fix fix-able issue only once per day as more attempts are often useless
-            if vs.last_date_error_notified() and vs.last_date_error_notified().date() == current_time().date():
-                return True  # do not fix
-            vs.set_last_date_error_notified(current_time())
-            vs.set_last_reg_status("Помилка реєстрації VoIP. Невірний логін/пароль (код %s)" % voip)
-            return False  # try to fix
-        if voip == "403":
-            log.error("[Statuses ok] Error 403. No easy remedy for this")
-            vs.set_last_reg_status("Невідома помилка (код %s)" % voip)
+            return True, "Помилка реєстрації VoIP. Невірний логін/пароль (код %s)" % voip  # handled by the caller
         if voip != "Y":
+            if voip == "403":
+                log.error("[Statuses ok] Error 403. No easy remedy for this")
             log.error("[Statuses ok] VoIP registration failed (status = '%s')." % voip)
-            vs.set_last_reg_status("Помилка реєстрації VoIP (код %s)" % voip)
-            return False  # try to fix
+            return False, "Помилка реєстрації VoIP (код %s)" % voip  # try to fix
+        reg_status = None
         if sim != "Y":
             log.error("[Statuses ok] SIM not found. No easy remedy for this")
-            vs.set_last_reg_status("SIM не знайдено")
+            reg_status = "SIM не знайдено"
         if gsm != "Y":
             log.error("[Statuses ok] No GSM network. No easy remedy for this")
-            vs.set_last_reg_status("Помилка реєстрації GSM")
+            reg_status = "Помилка реєстрації GSM"
+        return True, reg_status
+
+    def statuses_ok(self, lines_status=None):
+        log.info("[Statuses ok] Checking")
+        if lines_status is None:
+            lines_status = BrowserWrapper.b.lines_status()
+        vs.set_last_reg_status(None)  # reset value
+        voip_ok, auth_failed, reg_statuses = True, False, []
+        for line, status in enumerate(lines_status, start=1):
+            line_voip_ok, reg_status = self.line_status(status)
+            Metrics.set("goip_registration_ok", 1 if status["status_line"] == "Y" else 0, line=line)
+            Metrics.set("goip_sim_ok", 1 if status["gsm_sim"] == "Y" else 0, line=line)
+            Metrics.set("goip_gsm_ok", 1 if status["gsm_status"] == "Y" else 0, line=line)
+            voip_ok = voip_ok and line_voip_ok
+            auth_failed = auth_failed or status["status_line"] == "401"
+            if reg_status:
+                reg_statuses.append(reg_status if len(lines_status) == 1 else "Лінія %d: %s" % (line, reg_status))
+        if reg_statuses:
+            vs.set_last_reg_status("\n".join(reg_statuses))
+        Metrics.set("goip_statuses_ok", 1 if voip_ok and not auth_failed else 0)
+        if not voip_ok:
+            return False  # try to fix
+        if auth_failed:
+            # try to fix fix-able issue only once per day as more attempts are often useless
+            if vs.last_date_error_notified() and vs.last_date_error_notified().date() == current_time().date():
+                return True  # do not fix
+            vs.set_last_date_error_notified(current_time())
+            return False  # try to fix
         vs.set_last_date_error_notified(None)
         return True  # do not try to fix
 
     def reboot(self):
+        with Supervisor.suspended("reboot"):
+            self._reboot()
+
+    def _reboot(self):
         log.info("[Reboot] Rebooting caller")
+        Metrics.inc("goip_recoveries_total", kind="reboot")
         SmsWrapper.kill()
         bot.send("Перезавантажую дзвонилку.")
         BrowserWrapper.b.go_relative_url("reboot.html")
         sleep(30)
-        self.init_browser()
-        self.init_sms(notify=True)
+        Startup("Reboot") \
+            .add("browser", self.init_browser) \
+            .add("sms", lambda: self.init_sms(notify=True), on_caller=True) \
+            .run()
         log.info("[Reboot] Finished reboot")
-        bot.send("Перезавантажено дзвонилку.")
+        EventBus.publish(GatewayRecovered("reboot"))
 
     def reset_config(self):
         log.info("[Reset config] Re-setting")
@@ -245,22 +257,25 @@ class GoipMonitor:
         b.set_text(b.by_id("gsm_outc_noans_t"), "60")
         b.save()
         b.open_menu("Call Out Auth")
-        b.set_select("line1_fw2pstn_auth_mode_select", "Whitelist")
+        for line in self.line_numbers():
+            b.set_select("line%d_fw2pstn_auth_mode_select" % line, "Whitelist")
         b.expand_items("Whitelist/Blacklist")
-        b.set_text(b.by_id("l1_voip_trust_num1"), "419522")
-        b.set_text(b.by_id("l1_voip_trust_num2"), "549950")
-        b.set_text(b.by_id("l1_voip_trust_num3"), "685171")
-        b.set_text(b.by_id("l1_voip_trust_num4"), "752227")
+        for line in self.line_numbers():
+            for i, num in enumerate(["419522", "549950", "685171", "752227"], start=1):
+                b.set_text(b.by_id("l%d_voip_trust_num%d" % (line, i)), num)
         b.save()
         b.open_menu("Call In")
-        b.by_id("line1_fw_to_voip_disable").click()
+        for line in self.line_numbers():
+            b.by_id("line%d_fw_to_voip_disable" % line).click()
         b.save()
         b.open_menu("SIM")
         b.by_id("gprs_disable").click()
         b.by_id("expiry_m_enable").click()
-        b.set_text(b.by_id("line1_gsm_num"), SENDER_PHONE)
-        b.set_text(b.by_id("line1_gsm_pin2"), "9819")
-        b.by_id("line1_exp_drop_disable").click()
+        for line in self.line_numbers():
+            if line in LINE_SENDER_PHONES:
+                b.set_text(b.by_id("line%d_gsm_num" % line), LINE_SENDER_PHONES[line])
+                b.set_text(b.by_id("line%d_gsm_pin2" % line), "9819")
+            b.by_id("line%d_exp_drop_disable" % line).click()
         b.save()
         b.open_menu("Tools")
         b.open_menu("User Management")
@@ -270,18 +285,17 @@ class GoipMonitor:
         b.set_text(b.by_xpath(xpath % "confirm_passwd"), self.pwd)
         b.by_xpath(parent + "input[@type='submit' and @value='Change']").click()
         sleep(10)
-        self.init_browser()
-        self.init_sms()
-        vs.increase_daily_fixed_times(1)
-
-    def goip_monitor(self):
-        # we couldn't afford sleep(600) because we are working with browser in the single thread
-        # instead - just skip method' body till the sleep time is elapsed
-        if self.goip_slept_at and not passed_more_that_sec(self.goip_slept_at, GOIP_MONITOR_SLEEP_SECONDS):
-            return True
-
-        cdr_started = BrowserWrapper.b.by_id("l1_cdrt").text.strip()
-        if cdr_started.startswith("1970-01"):
+        Startup("Restore config") \
+            .add("browser", self.init_browser) \
+            .add("sms", self.init_sms, on_caller=True) \
+            .run()
+        Digest.fixed()
+
+    def goip_monitor(self, lines_status=None):
+        """Checks the GoIP state and fixes it if needed. Run by the scheduler every GOIP_MONITOR_SLEEP_SECONDS"""
+        if lines_status is None:
+            lines_status = BrowserWrapper.b.lines_status()
+        if any((status["cdrt"] or "").startswith("1970-01") for status in lines_status):
             log.error("[GoipMonitor] Have internal GoIP issue (1970 year at clock).")
             if vs.last_date_cdr_restart() == current_time().date():  # if we had the same problem today
                 bot.send("Переналаштовую дзвонилку бо вона ґеґнула (1970 рік надворі)!")
@@ -295,14 +309,13 @@ class GoipMonitor:
             # just waiting for the fix to be applied. Nothing could be done now
             return False
         # reason for the status check is doing fix only if GoIP problem persists for >1 cycle
-        goip_is_working = self.statuses_ok()
+        goip_is_working = self.statuses_ok(lines_status)
         if not goip_is_working and vs.last_reg_status() == self.voip_connection_status:
             self.reset_and_restore()
             # open the 'Status' tab again to support the logic in rest of the cycle
             BrowserWrapper.b.open_menu("Status")
         self.voip_connection_status = vs.last_reg_status()
-        self.goip_slept_at = current_time()  # we have this in-memory var to decrease amt of calls to the DB
-        vs.set_monitor_slept_at(self.goip_slept_at)  # we are using this value as heartbeat for the whole GoIP monitor
+        vs.set_monitor_slept_at(current_time())  # we are using this value as heartbeat for the whole GoIP monitor
         log.info("[GoipMonitor] Sleeping for %d sec..." % GOIP_MONITOR_SLEEP_SECONDS)
         if not goip_is_working:  # just waiting for the fix to be applied. Nothing could be done now
             log.error("[GoipMonitor] Patient is not ok. Will check again soon.")
@@ -310,7 +323,7 @@ class GoipMonitor:
         return True
 
 
-class CallMonitor:
+class LineMonitor:
     IDLE = "IDLE"
     ACTIVE = "ACTIVE"
     ALERTING = "ALERTING"
@@ -333,60 +346,50 @@ class CallMonitor:
     msg_call_status = None
     last_called_number = None
     last_msg = None
-
-    def __init__(self, goip):
-        self.goip = goip
-        self.daily_status_sent_at = vs.daily_status_sent()
-
-    def monitor(self):
-        log.info("[CallMonitor] Started monitor")
-        BrowserWrapper.b.open_menu("Status")
-        waiting_from = None
-        while True:
-            if pbot.has_request():
-                skip_processing = False
-                request = pbot.request
-                log.info("[CallMonitor] Has personal bot request: %s" % request)
-                # reboot and reset/restore are still possible while in the call
-                # as we have a confirmation message before running each of them
-                if self.call_or_dialing_started():
-                    if isinstance(request, BalanceRequest)\
-                            or isinstance(request, SendSmsRequest)\
-                            or isinstance(request, SendUssdRequest):
-                        log.info("[CallMonitor] Could not process the request while in a call. Waiting...")
-                        skip_processing = True
-                if isinstance(request, RebootRequest) or isinstance(request, ResetRestoreRequest):
-                    waiting_from = None
-                if not skip_processing:
-                    log.info("[CallMonitor] Processing personal bot request")
-                    pbot.process_request(self.goip)
-                    log.info("[CallMonitor] Processed personal bot request")
-                    BrowserWrapper.b.open_menu("Status")
-            # send daily status every day once at 23:XX when no-one is using GoIP caller
-            if current_time().hour == 23 and not self.call_or_dialing_started() and\
-                    (not self.daily_status_sent_at or self.daily_status_sent_at.date() != current_date().date()):
-                self.daily_status_sent_at = current_time()  # using in-memory var to decrease amt of calls to DB
-                vs.set_daily_status_sent(self.daily_status_sent_at)
-                bot.send(daily_status())
-            # this should be checked every time, so no var defined above
-            sleep_for_sec = 2 if self.call_or_dialing_started() else LAST_CALL_SLEEP_SECONDS
-            # if not authorised for < 5 minutes - just wait for this issue to get fixed (with reset/restore?)
-            if not BrowserWrapper.b.is_authorized() and not passed_more_that_sec(waiting_from, 5 * 60):
-                log.warning("[CallMonitor] Browser is not ok - session is not authorised")
-                if waiting_from is None:
-                    waiting_from = current_time()
-                sleep(sleep_for_sec)
-                continue
-            waiting_from = None
-            # this is the way to get up-to-day info from the page
-            BrowserWrapper.b.driver.refresh()
-            if self.goip.goip_monitor():  # if all is fine with GoIP
-                self.call_monitor()  # run call monitor logic
-            else:
-                log.info("[CallMonitor] GoIP monitor is not ok")
-            sleep(sleep_for_sec, print_log=False)
-
-    def calculate_status(self):
+    # in-flight call state which is checkpointed to the DB on every change to be restored after the restart
+    SNAPSHOT_FIELDS = ["status", "call_number", "msg_call_status", "last_called_number"]
+    SNAPSHOT_TIMES = ["dialing_started", "call_started"]
+
+    def __init__(self, line=1):
+        self.line = line
+        self.checkpointed = None
+
+    def snapshot(self):
+        if not self.call_or_dialing_started():
+            return None
+        state = {name: getattr(self, name) for name in self.SNAPSHOT_FIELDS}
+        for name in self.SNAPSHOT_TIMES:
+            value = getattr(self, name)
+            state[name] = value.strftime(DATETIME_FORMAT) if value else None
+        # the edits of the progress message are continued after the restart (once it's delivered)
+        state["last_msg"] = self.last_msg.message_id if self.last_msg else None
+        return state
+
+    def checkpoint(self):
+        state = self.snapshot()
+        if state != self.checkpointed:  # the DB is written on the changes only
+            vs.set_call_state(state, line=self.line)
+            self.checkpointed = state
+
+    def restore(self):
+        state = vs.call_state(line=self.line)
+        if not state:
+            return
+        for name in self.SNAPSHOT_TIMES:
+            state[name] = datetime.strptime(state[name], DATETIME_FORMAT) if state[name] else None
+        started = state["call_started"] or state["dialing_started"]
+        if not started or (current_time() - started).total_seconds() > CALL_STATE_MAX_AGE_SECONDS:
+            log.warning("[Restore call] Line %d: dropping the call state from %s" % (self.line, started))
+            vs.set_call_state(None, line=self.line)
+            return
+        for name in self.SNAPSHOT_FIELDS + self.SNAPSHOT_TIMES:
+            setattr(self, name, state[name])
+        self.last_msg = MessageHandle.from_id(state["last_msg"]) if state["last_msg"] else None
+        self.checkpointed = self.snapshot()
+        log.info("[Restore call] Line %d: continuing the call to %s started at %s" %
+                 (self.line, self.any_call_number(), started))
+
+    def calculate_status(self, raw_status_string):
         def set_number(raw_status):
             m = re.search(self.STATUS_TO_NUMBER_REGEX, raw_status)
             if not m or len(m.groups()) < 2:
@@ -401,7 +404,8 @@ class CallMonitor:
             if self.status != value:
                 self.status = value
                 self.status_changed = True
-        raw_status_string = BrowserWrapper.b.by_id("l1_line_state").text.strip()
+                for state in [self.IDLE, self.ACTIVE, self.ALERTING, self.DIALING, self.CONNECTED]:
+                    Metrics.set("goip_line_state", 1 if state == value else 0, line=self.line, state=state)
         # IDLE -> just waiting for the call to happen
         if raw_status_string == "IDLE":
             set_status(self.IDLE)
@@ -418,17 +422,20 @@ class CallMonitor:
         elif raw_status_string.startswith("CONNECTED"):
             set_status(self.CONNECTED)
         else:
-            raise Exception("Unknown raw status: %s" % raw_status_string)
+            raise Exception("Unknown raw status of line %d: %s" % (self.line, raw_status_string))
         set_number(raw_status_string)
 
     def any_call_number(self):
         return self.last_called_number or self.call_number or "'невідомо кого'"
 
-    def bot_message(self, text):
-        text = text.format(number=self.any_call_number())
-        if self.last_msg:
-            return bot.edit(msg=self.last_msg, text=text)
-        return bot.send(text=text)
+    def publish(self, event):
+        EventBus.publish(event)
+
+    def progress_message(self):
+        """Handle of the call progress message - it's sent by the first event of the call and edited by the rest"""
+        if self.last_msg is None:
+            self.last_msg = MessageHandle()
+        return self.last_msg
 
     def call_or_dialing_started(self):
         return self.call_started or self.dialing_started
@@ -440,9 +447,10 @@ class CallMonitor:
         except TypeError as e:  # if call already started
             log.warning("[Start call] Exception getting message from call status: %s" % e)
             log_msg, self.msg_call_status = self.STATUS_LOG_MSG.get(self.DIALING)
-        log.info("[Start call] %s" % log_msg)
+        log.info("[Start call] Line %d: %s" % (self.line, log_msg))
         if self.status_changed:
-            self.last_msg = self.bot_message(self.msg_call_status)
+            self.publish(CallStarted(self.line, self.last_called_number or self.call_number, self.msg_call_status,
+                                     self.progress_message()))
 
     def start_call(self):
         # this could happen when previous call ended and new started in-between check cycles
@@ -453,41 +461,186 @@ class CallMonitor:
             self.start_dialing()
         # start actual call
         if not self.call_started:
-            log.info("[Process call] Started call to %s" % self.call_number)
-            self.last_msg = self.bot_message("Говоримо з %s" % self.call_number)
+            log.info("[Process call] Line %d: started call to %s" % (self.line, self.call_number))
+            self.publish(CallConnected(self.line, self.call_number, self.progress_message()))
             self.call_started = current_time()
             self.last_called_number = self.call_number
 
     def finish_call(self):
         number = self.any_call_number()
-        log.info("[Finish call] Processing call end for '%s'" % number)
+        log.info("[Finish call] Processing call end for '%s' (line %d)" % (number, self.line))
         started_when = self.call_or_dialing_started()
         log.info("[Finish call] Call started at %s" % started_when)
         seconds = (current_time() - started_when).seconds
         log.info("[Finish call] Overall call duration is %s seconds" % seconds)
         duration_str = seconds_to_time_str(seconds, no_seconds=(seconds > 3600))
-        log.info("[Finish call] Call to %s ended (%s)" % (number, duration_str))
-        if self.call_started:
-            text = "Дзвоник до %s - %s" % (number, duration_str)
-            vs.increase_daily_call_duration(seconds)
-            vs.increase_daily_ok_calls_amount(1)
-        else:
-            if self.msg_call_status:
-                text = self.msg_call_status + random_list_item(self.ERROR_PHRASES)
-            else:
-                text = "Ймовірно невдалий дзвоник до {number}"
-            vs.increase_daily_failed_calls_amount(1)
-        self.bot_message(text)
+        log.info("[Finish call] Call to %s ended (%s)" % (number, duration_str), extra={"duration": seconds})
+        self.publish(CallEnded(self.line, self.last_called_number or self.call_number, started_when, seconds,
+                               bool(self.call_started), self.msg_call_status, self.last_msg, "poll"))
         self.dialing_started = self.call_started = self.last_called_number = self.msg_call_status = self.last_msg = None
 
-    def call_monitor(self):
-        self.calculate_status()
+    def call_monitor(self, raw_status_string):
+        self.calculate_status(raw_status_string)
+        with log_context(line=self.line, state=self.status):
+            self.process_status()
+        self.checkpoint()
+
+    def process_status(self):
         if self.status == self.IDLE:
             if self.call_or_dialing_started():
                 self.finish_call()  # back to idle
             return
-        log.info("[Monitor call status] Status string = '%s'" % self.status)
+        log.info("[Monitor call status] Line %d status string = '%s'" % (self.line, self.status))
         if self.status in self.STARTING_CALL_STATUSES:
             self.start_dialing()
         if self.status == self.CONNECTED:
             self.start_call()
+
+
+class CallMonitor:
+    waiting_from = None
+    first_cycle = True
+    cycle_errors = 0
+
+    def __init__(self, goip):
+        self.goip = goip
+        self.daily_status_sent_at = vs.daily_status_sent()
+        self.line_monitors = []
+        self.init_line_monitors()
+        self.cdr = CdrReconciler()
+
+    def init_line_monitors(self):
+        # keep the state machines of the lines that are still present (number of lines is re-discovered on re-login)
+        lines = self.goip.lines
+        added = [LineMonitor(line) for line in range(len(self.line_monitors) + 1, lines + 1)]
+        for line_monitor in added:
+            line_monitor.restore()  # the call might be in progress while the application was restarted
+        self.line_monitors = self.line_monitors[:lines] + added
+
+    def call_or_dialing_started(self):
+        return any(lm.call_or_dialing_started() for lm in self.line_monitors)
+
+    def can_process_request(self, request):
+        # reboot and reset/restore are still possible while in the call
+        return request.allowed_in_call or not self.call_or_dialing_started()
+
+    def process_request(self, request):
+        log.info("[CallMonitor] Processing personal bot request %s" % request)
+        if request.restarts_caller:
+            with BrowserWrapper.lock:
+                pbot.process_request(request, self.goip)
+                self.waiting_from = None
+        else:  # the rest (balance, USSD, SMS) doesn't use the browser, so the polls go on meanwhile
+            pbot.process_request(request, self.goip)
+        log.info("[CallMonitor] Processed personal bot request %s" % request)
+        with BrowserWrapper.lock:
+            BrowserWrapper.b.open_menu("Status")
+
+    def schedule(self):
+        """Periodic work of the monitor loop. All the jobs run in the monitor thread, taking turns with the polls"""
+        scheduler.every("poll", LAST_CALL_SLEEP_SECONDS, self.poll, propagate=True)
+        scheduler.every("goip.check", GOIP_MONITOR_SLEEP_SECONDS, self.goip_check)
+        # send daily status every day once at 23:XX when no-one is using GoIP caller. Weekly durations are reset on Sunday
+        scheduler.cron("daily.status", self.send_daily_status, hour=23, weekdays=range(6),
+                       deadline=DAILY_STATUS_DEADLINE_SECONDS, catch_up=True)
+        scheduler.cron("weekly.status", lambda: self.send_daily_status(reset_weekly=True), hour=23, weekdays=[6],
+                       deadline=DAILY_STATUS_DEADLINE_SECONDS, catch_up=True)
+        # the balance is sampled in background a bit earlier, so the daily status is just rendered at 23:XX
+        scheduler.cron("digest.sample", self.sample_digest, hour=22, minute=60 - DIGEST_SAMPLE_MINUTES,
+                       deadline=DIGEST_SAMPLE_MINUTES * 60, catch_up=True)
+        scheduler.every("metrics.summary", METRICS_SUMMARY_SECONDS, self.log_metrics, first_in=METRICS_SUMMARY_SECONDS)
+
+    def monitor(self):
+        log.info("[CallMonitor] Started monitor")
+        BrowserWrapper.b.open_menu("Status")
+        self.schedule()
+        while True:
+            try:
+                scheduler.run_due()
+            except Exception as e:  # only the poll job propagates the errors
+                self.cycle_errors += 1
+                log.error("[CallMonitor] Cycle failed (%d in a row): %s" % (self.cycle_errors, e))
+                Metrics.inc("goip_cycle_errors_total")
+                if self.cycle_errors >= MONITOR_MAX_CYCLE_ERRORS:
+                    raise
+                Supervisor.check()  # restart the failed component only, the rest keeps the state
+            sleep(scheduler.seconds_till_next(), print_log=False)
+
+    def poll(self):
+        with BrowserWrapper.lock, trace("cycle", calls=self.call_or_dialing_started()), timing("monitor.cycle"):
+            started = time.perf_counter()
+            sleep_for_sec = self.monitor_cycle()
+        self.cycle_errors = 0
+        log.debug("[CallMonitor] Cycle finished", extra={"duration": round(time.perf_counter() - started, 3)})
+        if self.first_cycle:
+            self.first_cycle = False
+            log.info("[CallMonitor] First status poll done in %.1f sec since the application start" %
+                     seconds_since_start())
+            # bot requests are processed by the separate worker, taking turns with the polls to use the browser.
+            # It's started after the first poll to have the caller monitored as soon as possible
+            pbot.start_processing(run=self.process_request, can_run=self.can_process_request)
+        return sleep_for_sec
+
+    def goip_check(self):
+        if self.waiting_from is not None:
+            return LAST_CALL_SLEEP_SECONDS  # not authorised - the poll is waiting for the fix, check once it's done
+        with BrowserWrapper.lock, timing("goip.monitor"):
+            BrowserWrapper.b.refresh()
+            if not self.goip.goip_monitor(BrowserWrapper.b.lines_status()):
+                log.info("[CallMonitor] GoIP monitor is not ok")
+
+    def send_daily_status(self, reset_weekly=False):
+        if self.daily_status_sent_at and self.daily_status_sent_at.date() == current_date().date():
+            return None  # sent already (e.g. before the restart)
+        if self.call_or_dialing_started():
+            return 60  # postponed till the call is over
+        self.daily_status_sent_at = current_time()  # using in-memory var to decrease amt of calls to DB
+        vs.set_daily_status_sent(self.daily_status_sent_at)
+        with timing("daily.status"):
+            bot.send(daily_status(lines=self.goip.lines))
+        Digest.rollover_async(lines=self.goip.lines, reset_weekly=reset_weekly)
+
+    def sample_digest(self):
+        if self.call_or_dialing_started():
+            return 60
+        Digest.sample_async(lines=self.goip.lines)
+
+    @staticmethod
+    def log_metrics():
+        Metrics.log_summary()
+        flush_log_repeats()
+
+    def monitor_cycle(self):
+        """Runs a single status poll and returns the seconds to sleep before the next one"""
+        RetryBudget.refill()
+        # this should be checked every time, so no var defined above
+        sleep_for_sec = 2 if self.call_or_dialing_started() else LAST_CALL_SLEEP_SECONDS
+        # if not authorised for < 5 minutes - just wait for this issue to get fixed (with reset/restore?)
+        if not BrowserWrapper.b.is_authorized() and not passed_more_that_sec(self.waiting_from, 5 * 60):
+            log.warning("[CallMonitor] Browser is not ok - session is not authorised")
+            if self.waiting_from is None:
+                self.waiting_from = current_time()
+            return sleep_for_sec
+        self.waiting_from = None
+        # this is the way to get up-to-day info from the page
+        BrowserWrapper.b.refresh()
+        # all the lines are read at once, so multi-line callers cost a single status poll
+        lines_status = BrowserWrapper.b.lines_status()
+        with timing("lines.monitor"):
+            self.call_monitor(lines_status)  # run call monitor logic
+        recycle_reason = Watchdog.recycle_due()
+        if recycle_reason and not self.call_or_dialing_started():  # the driver is restarted only when lines are idle
+            self.goip.recycle_browser(recycle_reason)
+            Watchdog.recycled()
+        return sleep_for_sec
+
+    def call_monitor(self, lines_status):
+        if lines_status and len(lines_status) != self.goip.lines:
+            log.info("[CallMonitor] Number of lines changed: %d => %d" % (self.goip.lines, len(lines_status)))
+            self.goip.lines = len(lines_status)
+        if len(self.line_monitors) != self.goip.lines:
+            self.init_line_monitors()
+        for line_monitor, status in zip(self.line_monitors, lines_status):
+            LineStateRecorder.record(line_monitor.line, status["line_state"])
+            line_monitor.call_monitor(status["line_state"])
+        self.cdr.reconcile(lines_status, [lm.line for lm in self.line_monitors if not lm.call_or_dialing_started()])
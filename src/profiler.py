@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from src.const import PROFILE_SECONDS, PROFILE_RATE, PROFILE_MAX_SECONDS, PROFILE_TOP, CUR_DIR
+from src.utils import log
+
+
+def frame_label(code):
+    return "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+
+
+class Profiler:
+    """Sampling profiler of the running process: stacks of all the threads are taken `rate` times
+    per second for `seconds` by the separate thread, so nothing has to be changed in the profiled code.
+    Result is the collapsed-stack file ("thread;outer;...;inner count" - flamegraph.pl input)
+    and the summary of the top functions.
+    """
+    _lock = threading.Lock()
+    _thread = None
+
+    @classmethod
+    def running(cls):
+        return cls._thread is not None and cls._thread.is_alive()
+
+    @classmethod
+    def start(cls, seconds=PROFILE_SECONDS, rate=PROFILE_RATE, on_done=None):
+        """Starts the profiling in background. Returns False if it is running already.
+        :param on_done: called with the summary text once the profiling is over
+        """
+        seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+        with cls._lock:
+            if cls.running():
+                return False
+            cls._thread = threading.Thread(target=cls._run, args=(seconds, rate, on_done), name="Profiler",
+                                           daemon=True)
+            cls._thread.start()
+        return True
+
+    @classmethod
+    def _run(cls, seconds, rate, on_done):
+        log.info("[Profiler] Sampling %d times per second for %d seconds" % (rate, seconds))
+        interval = 1.0 / rate
+        own_id = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        spent = 0.0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            sample_started = time.perf_counter()
+            if sample_started >= deadline:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            sample_finished = time.perf_counter()
+            spent += sample_finished - sample_started
+            time.sleep(max(0.0, interval - (sample_finished - sample_started)))
+        elapsed = time.perf_counter() - started
+        filename = "{0}/profile-{1}.folded".format(CUR_DIR, time.strftime("%Y%m%d-%H%M%S"))
+        with open(filename, "w", encoding="utf-8") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+        text = "%s\n\nSamples: %d in %.1f sec, sampler overhead: %.2f%%\nStacks: %s" % (
+            summary(stacks, samples), samples, elapsed, 100 * spent / elapsed, filename)
+        log.info("[Profiler] Done\n%s" % text)
+        if on_done:
+            try:
+                on_done(text)
+            except Exception as e:
+                log.error("[Profiler] Unable to report the result: %s" % e)
+
+    @classmethod
+    def install_signal(cls, signum=getattr(signal, "SIGUSR1", None)):
+        """`kill -USR1 <pid>` starts the profiling with the default settings (not available on Windows)."""
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signum, lambda *_: cls.start())
+        log.info("[Profiler] Send signal %d to pid %d to start profiling" % (signum, os.getpid()))
+
+
+def summary(stacks, samples, top=PROFILE_TOP):
+    """Top functions by the self (on top of the stack) and total (anywhere in the stack) share of samples."""
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")[1:]  # thread name goes first
+        if not frames:
+            continue
+        own[frames[-1]] += count
+        for name in set(frames):
+            total[name] += count
+    samples = samples or 1
+    lines = ["%-44s %6s %6s" % ("function", "self%", "total%")]
+    for name, count in own.most_common(top):
+        lines.append("%-44s %6.1f %6.1f" % (name[-44:], 100.0 * count / samples, 100.0 * total[name] / samples))
+    return "\n".join(lines)
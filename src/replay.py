@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+import json
+import logging
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from src.const import LINE_STATES_RECORD, LINE_STATES_MAX_BYTES, LINE_STATES_BACKUPS, LAST_CALL_SLEEP_SECONDS, \
+    CUR_DIR
+from src.tracing import read_traces
+from src.utils import Clock, create_file_logger, log
+
+
+class LineStateRecorder:
+    """Records the raw line state strings read from the GoIP (only the changes) with their timestamps."""
+    enabled = bool(LINE_STATES_RECORD)
+    _last = {}
+    _logger = None
+
+    @classmethod
+    def record(cls, line, raw_status_string):
+        if not cls.enabled or cls._last.get(line) == raw_status_string:
+            return
+        cls._last[line] = raw_status_string
+        if cls._logger is None:
+            cls._logger = create_file_logger("Goip Line States", LINE_STATES_RECORD, LINE_STATES_MAX_BYTES,
+                                             LINE_STATES_BACKUPS)
+        cls._logger.info(json.dumps({"ts": round(time.time(), 3), "line": line, "state": raw_status_string}))
+
+
+class ReplayResult:
+    def __init__(self):
+        self.calls = defaultdict(list)  # line => [(started, seconds, ok)]
+        self.messages = 0
+        self.states = defaultdict(int)  # line => recorded states
+        self.missed = defaultdict(int)  # line => recorded states never seen by the monitor cycle
+        self.connects = defaultdict(int)  # line => calls in the record (CONNECTED to the new number)
+        self.cycles = 0
+        self.virtual_seconds = 0.0
+        self.seconds = 0.0
+
+
+def line_monitor_class(result):
+    """LineMonitor collecting the calls and bot messages instead of publishing the events."""
+    from src.events import CallEnded
+    from src.monitors import LineMonitor
+
+    class ReplayLineMonitor(LineMonitor):
+        def publish(self, event):
+            result.messages += 1  # each call event is the bot message
+            if isinstance(event, CallEnded):
+                result.calls[self.line].append((event.started, event.seconds, event.ok))
+
+        def checkpoint(self):
+            pass
+    return ReplayLineMonitor
+
+
+def replay(events, cycle_seconds=0.0, in_call_sleep=2, idle_sleep=LAST_CALL_SLEEP_SECONDS):
+    """Feeds the recorded (ts, line, state) events through the line state machines with the virtual clock.
+    The monitor cycles are emulated as CallMonitor.monitor() does them: state of each line is read once per cycle
+    and the sleep in-between depends on whether there is a call. Idle periods are skipped at once.
+    """
+    result = ReplayResult()
+    events = sorted(events, key=lambda event: event[0])  # stable for the states recorded at the same time
+    if not events:
+        return result
+    lines = max(line for _, line, _ in events)
+    monitor_class = line_monitor_class(result)
+    monitors = [monitor_class(line) for line in range(1, lines + 1)]
+    current = {line: "IDLE" for line in range(1, lines + 1)}
+    seen = dict(current)
+    pending = defaultdict(int)  # line => states changed since the last cycle
+    last = {}
+    for _, line, state in events:
+        result.states[line] += 1
+        if state.startswith("CONNECTED") and last.get(line) != state:
+            result.connects[line] += 1
+        last[line] = state
+    now = events[0][0]
+    real_now = Clock.now
+    Clock.now = lambda: datetime.fromtimestamp(now)
+    started = time.perf_counter()
+    try:
+        i = 0
+        while i < len(events):
+            while i < len(events) and events[i][0] <= now:
+                _, line, state = events[i]
+                if state != current[line]:
+                    current[line] = state
+                    pending[line] += 1
+                i += 1
+            for monitor in monitors:
+                line = monitor.line
+                if pending[line]:
+                    # only the latest of the states changed in-between the cycles is seen
+                    result.missed[line] += pending[line] - (1 if current[line] != seen[line] else 0)
+                    pending[line] = 0
+                    seen[line] = current[line]
+                monitor.call_monitor(current[line])
+            result.cycles += 1
+            in_call = any(monitor.call_or_dialing_started() for monitor in monitors)
+            sleep_for = (in_call_sleep if in_call else idle_sleep) + cycle_seconds
+            if not in_call and i < len(events) and events[i][0] > now + sleep_for:
+                # nothing happens till the next event - jump to the first cycle after it
+                sleep_for *= int((events[i][0] - now) // sleep_for)
+            now += sleep_for
+    finally:
+        Clock.now = real_now
+    result.seconds = time.perf_counter() - started
+    result.virtual_seconds = now - events[0][0]
+    return result
+
+
+def read_events(filename):
+    return [(entry["ts"], entry["line"], entry["state"]) for entry in read_traces(filename)]
+
+
+def report(result):
+    print("Replayed %.1f days in %.2f sec (x%d), %d monitor cycles, %d bot messages" % (
+        result.virtual_seconds / 86400, result.seconds, result.virtual_seconds / (result.seconds or 1e-9),
+        result.cycles, result.messages))
+    print("%-5s %8s %8s %10s %8s %8s %8s %10s" % ("line", "states", "missed", "connected", "calls", "ok", "failed",
+                                                   "talk sec"))
+    for line in sorted(result.states):
+        ok = [seconds for _, seconds, call_ok in result.calls[line] if call_ok]
+        print("%-5d %8d %8d %10d %8d %8d %8d %10d" % (
+            line, result.states[line], result.missed[line], result.connects[line], len(result.calls[line]), len(ok),
+            len(result.calls[line]) - len(ok), sum(ok)))
+
+
+if __name__ == '__main__':
+    # python -m src.replay [line-states-file] [monitor cycle duration seconds]
+    args = sys.argv[1:]
+    log.setLevel(logging.WARNING)  # state machine logs every transition
+    report(replay(read_events(args[0] if args else "{0}/{1}".format(CUR_DIR, LINE_STATES_RECORD)),
+                  cycle_seconds=float(args[1]) if len(args) > 1 else 0.0))
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# coding=utf-8
+import asyncio
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from src.const import CIRCUIT_FAILURES, CIRCUIT_RESET_SECONDS, RETRY_BUDGET_PER_CYCLE, RETRY_MAX_DELAY_SECONDS
+from src.metrics import Metrics
+from src.utils import log
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling the endpoint after `failures` errors in a row. Once `reset_seconds` pass, the single trial call
+    is let through: its success closes the circuit, any error opens it again.
+    Only the errors of `trips_on` types count (by default the network ones - requests errors are OSError too).
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, name, failures=CIRCUIT_FAILURES, reset_seconds=CIRCUIT_RESET_SECONDS, trips_on=(OSError, )):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.trips_on = trips_on
+        self.state = self.CLOSED
+        self.errors = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name, **kwargs):
+        with cls._breakers_lock:
+            breaker = cls._breakers.get(name)
+            if breaker is None:
+                breaker = cls._breakers[name] = cls(name, **kwargs)
+            return breaker
+
+    @classmethod
+    def states(cls):
+        with cls._breakers_lock:
+            return {name: breaker.state for name, breaker in sorted(cls._breakers.items())}
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN  # the trial call
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                log.info("[Circuit] '%s' is closed again" % self.name)
+                Metrics.set("goip_circuit_open", 0, endpoint=self.name)
+            self.state = self.CLOSED
+            self.errors = 0
+
+    def failure(self, error, counts=True):
+        """`counts` - whether the error is the endpoint failure (one of `trips_on`). The trial call fails on any one"""
+        with self._lock:
+            if counts:
+                self.errors += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and counts and self.errors >= self.failures):
+                log.error("[Circuit] '%s' is open for %d sec after %d error(s), last: %s" %
+                          (self.name, self.reset_seconds, self.errors, error))
+                Metrics.set("goip_circuit_open", 1, endpoint=self.name)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+_active_breakers = ContextVar("active_breakers", default=frozenset())
+
+
+class _BreakerScope:
+    """Single call through the breaker. The nested scopes of the same breaker (e.g. the retried call made inside
+    the retried one) are the part of the outer call, so the call is allowed and counted once
+    """
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.token = None
+
+    def __enter__(self):
+        active = _active_breakers.get()
+        if self.breaker.name in active:
+            return self.breaker
+        if not self.breaker.allow():
+            Metrics.inc("goip_circuit_rejected_total", endpoint=self.breaker.name)
+            raise CircuitOpen("Endpoint '%s' is down, call is rejected" % self.breaker.name)
+        self.token = _active_breakers.set(active | {self.breaker.name})
+        return self.breaker
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.token is None:
+            return False
+        _active_breakers.reset(self.token)
+        if exc_type is None:
+            self.breaker.success()
+        else:
+            self.breaker.failure(exc, counts=issubclass(exc_type, self.breaker.trips_on))
+        return False
+
+
+def breaker(name):
+    """Circuit breaker of the endpoint to be used as context manager: with breaker("goip.http"): ..."""
+    return _BreakerScope(CircuitBreaker.get(name))
+
+
+class RetryBudget:
+    """Amount of retries (after the failed attempt) of the single caller shared by all the endpoints, so the nested
+    retries can't multiply the waits. Each caller has its own budget, so the monitor, the bot requests and the digest
+    don't spend each other's one: the monitor refills it at the start of each cycle, the retried call made outside
+    of the cycle (other threads) gets the budget of its own shared by the nested retries.
+    """
+    size = RETRY_BUDGET_PER_CYCLE
+
+    def __init__(self):
+        self.left = self.size
+        self._lock = threading.Lock()  # the context with the budget might be copied to the other thread
+
+    def take(self):
+        with self._lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+    @classmethod
+    def refill(cls):
+        """Gives the fresh budget to the caller (the current thread)"""
+        _budget.set(cls())
+
+
+_deadline = ContextVar("deadline", default=None)
+_budget = ContextVar("retry_budget", default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """Limits the retries inside the block (nested ones too) to `seconds` from now"""
+    outer = _deadline.get()
+    value = time.monotonic() + seconds
+    token = _deadline.set(min(value, outer) if outer else value)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+class _Attempts:
+    """State of the single retried call, shared by the sync and async wrappers"""
+    def __init__(self, policy):
+        self.policy = policy
+        self.attempt = 0
+        self.delay = policy.delay
+        outer = _deadline.get()
+        own = time.monotonic() + policy.deadline if policy.deadline else None
+        self.deadline = min(d for d in (outer, own) if d) if outer or own else None
+        self.budget = _budget.get() or RetryBudget()
+
+    def enter(self):
+        # nested retries fit into this call's deadline and share its budget
+        return _deadline.set(self.deadline), _budget.set(self.budget)
+
+    @staticmethod
+    def exit(tokens):
+        _deadline.reset(tokens[0])
+        _budget.reset(tokens[1])
+
+    def before(self):
+        if not self.attempt and self.deadline and time.monotonic() >= self.deadline:  # retries are bounded by delays
+            raise DeadlineExceeded("Deadline of '%s' is exceeded after %d attempt(s)" %
+                                   (self.policy.endpoint, self.attempt))
+        self.attempt += 1
+        return breaker(self.policy.endpoint) if self.policy.endpoint else _no_breaker
+
+    def next_delay(self, reason):
+        """Returns the seconds to wait before the next attempt or None if the call should give up"""
+        if self.attempt >= self.policy.tries:
+            return None
+        if isinstance(reason, BaseException) and not self.budget.take():
+            log.warning("[Retry] Retry budget is spent - giving up on '%s'" % self.policy.endpoint)
+            return None
+        if self.policy.jitter and isinstance(reason, BaseException):
+            # full jitter of the back-off after the error, so the retries of the concurrent callers don't hit
+            # the gateway at once. The result which is not ready yet is polled with the fixed delay
+            delay = random.uniform(0, min(self.delay, self.policy.max_delay))
+        else:
+            delay = self.delay
+        self.delay *= self.policy.backoff
+        if self.deadline:
+            delay = min(delay, self.deadline - time.monotonic())
+            if delay <= 0:
+                return None
+        log.info("[Retry] '%s' attempt %d: %s. Retrying in %.1f seconds..." %
+                 (self.policy.endpoint, self.attempt, reason, delay))
+        Metrics.inc("goip_retries_total", endpoint=self.policy.endpoint)
+        return delay
+
+
+class _NoBreaker:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_breaker = _NoBreaker()
+
+
+class RetryPolicy:
+    """Decorator retrying the function (sync or async) with the jittered exponential back-off.
+    :param endpoint: name of the circuit breaker the attempts go through (None - no breaker)
+    :param tries: number of times to try (not retry) before giving up
+    :param retry_on: exception types to retry on, by default the transient network ones (requests errors are OSError
+        too). CircuitOpen and DeadlineExceeded are never retried
+    :param retry_if: predicate of the result to be retried (e.g. the response is not ready yet).
+        Such retries don't count as failures of the endpoint, don't take the retry budget and are not jittered
+    :param deadline: seconds all the attempts should fit into (the outer deadline() applies as well)
+    The last exception is raised when giving up, the last result is returned for `retry_if` results.
+    """
+    def __init__(self, endpoint=None, tries=3, delay=1, backoff=2, max_delay=RETRY_MAX_DELAY_SECONDS,
+                 retry_on=(OSError, ), retry_if=None, deadline=None, jitter=True):
+        self.endpoint = endpoint
+        self.tries = tries
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.retry_if = retry_if
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def _retryable(self, e):
+        return isinstance(e, self.retry_on) and not isinstance(e, (CircuitOpen, DeadlineExceeded))
+
+    def __call__(self, f):
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def f_retry_async(*args, **kwargs):
+                attempts = _Attempts(self)
+                tokens = attempts.enter()
+                try:
+                    return await self._run_async(attempts, f, args, kwargs)
+                finally:
+                    attempts.exit(tokens)
+            return f_retry_async
+
+        @wraps(f)
+        def f_retry(*args, **kwargs):
+            attempts = _Attempts(self)
+            tokens = attempts.enter()
+            try:
+                return self._run(attempts, f, args, kwargs)
+            finally:
+                attempts.exit(tokens)
+        return f_retry
+
+    async def _run_async(self, attempts, f, args, kwargs):
+        while True:
+            try:
+                with attempts.before():
+                    result = await f(*args, **kwargs)
+                if not self.retry_if or not self.retry_if(result):
+                    return result
+                delay = attempts.next_delay("result %r" % (result, ))
+            except Exception as e:
+                if not self._retryable(e):
+                    raise
+                delay = attempts.next_delay(e)
+                if delay is None:
+                    raise
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
+
+    def _run(self, attempts, f, args, kwargs):
+        while True:
+            try:
+                with attempts.before():
+                    result = f(*args, **kwargs)
+                if not self.retry_if or not self.retry_if(result):
+                    return result
+                delay = attempts.next_delay("result %r" % (result, ))
+            except Exception as e:
+                if not self._retryable(e):
+                    raise
+                delay = attempts.next_delay(e)
+                if delay is None:
+                    raise
+            if delay is None:
+                return result
+            time.sleep(delay)
+
+
+def retry(endpoint=None, **kwargs):
+    """@retry("goip.http", tries=3, deadline=30) - see RetryPolicy for the parameters"""
+    return RetryPolicy(endpoint, **kwargs)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# coding=utf-8
+import heapq
+import itertools
+import threading
+import time
+from datetime import timedelta
+
+from src.metrics import Metrics
+from src.utils import log, current_time
+
+
+class Job:
+    INTERVAL, CRON, ONCE = "interval", "cron", "once"
+
+    def __init__(self, name, func, kind, interval=None, hour=0, minute=0, weekdays=None, deadline=None,
+                 propagate=False):
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.interval = interval
+        self.hour = hour
+        self.minute = minute
+        self.weekdays = weekdays  # datetime.weekday() values the cron job runs on (Monday is 0), None - every day
+        self.deadline = deadline  # seconds the run might be late for, later runs are skipped as missed
+        self.propagate = propagate  # errors are raised to the loop rather than logged
+        self.due = None  # time.monotonic() of the next run
+        self.postponed_from = None  # due time of the run the job has postponed (its deadline still applies)
+        self.slot = None  # wall-clock time of the next cron run
+        self.runs = 0
+        self.missed = 0
+        self.errors = 0
+        self.max_jitter = 0.0
+        self.cancelled = False
+
+    def next_slot(self, after):
+        """Next wall-clock time of the cron job after the given one"""
+        slot = after.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if slot <= after:
+            slot += timedelta(days=1)
+        while self.weekdays is not None and slot.weekday() not in self.weekdays:
+            slot += timedelta(days=1)
+        return slot
+
+    def __repr__(self):
+        return "<job '%s' %s>" % (self.name, self.kind)
+
+
+class Scheduler:
+    """Runs the periodic jobs of the monitor loop: interval, cron-like (at hh:mm on given weekdays) and one-shot ones.
+    Jobs are kept in the min-heap by the time of their next run, so the loop sleeps exactly till the next due job.
+    The job might return the seconds to run it again in (e.g. the poll depends on whether there is a call,
+    the daily report is postponed till the call ends). Jitter (how late the job started) and missed runs
+    (started later than the job deadline, so skipped) are recorded per job.
+    Jobs run in the thread calling run_due().
+    """
+    def __init__(self):
+        self._heap = []  # (due, sequence, job) - the sequence keeps the order of the jobs due at the same time
+        self._jobs = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def _push(self, job, due):
+        job.due = due
+        with self._lock:
+            heapq.heappush(self._heap, (due, next(self._sequence), job))
+
+    def _add(self, job, due):
+        with self._lock:
+            previous = self._jobs.get(job.name)
+            if previous:
+                previous.cancelled = True  # the replaced job is dropped once it's popped from the heap
+            self._jobs[job.name] = job
+        self._push(job, due)
+        return job
+
+    def every(self, name, seconds, func, first_in=0.0, deadline=None, propagate=False):
+        job = Job(name, func, Job.INTERVAL, interval=seconds, deadline=deadline, propagate=propagate)
+        return self._add(job, time.monotonic() + first_in)
+
+    def cron(self, name, func, hour, minute=0, weekdays=None, deadline=None, catch_up=False):
+        """Runs the job at hour:minute. With catch_up the job runs right away if it's started within the deadline
+        after today's slot (e.g. the application is restarted at 23:10 and the report is still to be sent).
+        """
+        job = Job(name, func, Job.CRON, hour=hour, minute=minute, weekdays=weekdays, deadline=deadline)
+        now = current_time()
+        job.slot = job.next_slot(now - timedelta(seconds=deadline) if catch_up and deadline else now)
+        return self._add(job, time.monotonic() + max(0.0, (job.slot - now).total_seconds()))
+
+    def once(self, name, func, seconds=0.0, deadline=None):
+        return self._add(Job(name, func, Job.ONCE, deadline=deadline), time.monotonic() + seconds)
+
+    def cancel(self, name):
+        with self._lock:
+            job = self._jobs.pop(name, None)
+        if job:
+            job.cancelled = True
+
+    def seconds_till_next(self):
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            return max(0.0, self._heap[0][0] - time.monotonic()) if self._heap else None
+
+    def run_due(self):
+        """Runs all the jobs which are due by now. Returns the amount of jobs run"""
+        ran = 0
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > time.monotonic():
+                    return ran
+                due, _, job = heapq.heappop(self._heap)
+            if job.cancelled:
+                continue
+            self._run(job, due)
+            ran += 1
+
+    def _run(self, job, due):
+        now = time.monotonic()
+        jitter = now - due
+        Metrics.record("jitter.%s" % job.name, jitter)
+        job.max_jitter = max(job.max_jitter, jitter)
+        late = now - (job.postponed_from or due)
+        again_in = None
+        if job.deadline is not None and late > job.deadline:
+            job.missed += 1
+            Metrics.inc("goip_job_missed_total", job=job.name)
+            log.warning("[Scheduler] Job '%s' missed its run (%.1f sec late)" % (job.name, late))
+        else:
+            job.runs += 1
+            try:
+                again_in = job.func()
+            except Exception as e:
+                job.errors += 1
+                Metrics.inc("goip_job_errors_total", job=job.name)
+                if job.propagate:
+                    self._reschedule(job, due, None)  # the job keeps running after the loop handles the error
+                    raise
+                log.error("[Scheduler] Job '%s' failed: %s" % (job.name, e))
+        self._reschedule(job, due, again_in)
+
+    def _reschedule(self, job, due, again_in):
+        if job.cancelled:
+            return
+        now = time.monotonic()
+        postponed = isinstance(again_in, (int, float)) and not isinstance(again_in, bool)
+        job.postponed_from = (job.postponed_from or due) if postponed and job.kind != Job.INTERVAL else None
+        if postponed:
+            self._push(job, now + again_in)
+        elif job.kind == Job.INTERVAL:
+            self._push(job, now + job.interval)
+        elif job.kind == Job.CRON:
+            job.slot = job.next_slot(max(current_time(), job.slot))
+            self._push(job, now + (job.slot - current_time()).total_seconds())
+        else:
+            with self._lock:
+                if self._jobs.get(job.name) is job:  # might be replaced by the new one with the same name already
+                    del self._jobs[job.name]
+
+    def summary(self):
+        lines = ["%-18s %6s %6s %6s %10s" % ("job", "runs", "missed", "errors", "jitter max")]
+        with self._lock:
+            jobs = sorted(self._jobs.items())
+        for name, job in jobs:
+            lines.append("%-18s %6d %6d %6d %10.3f" % (name, job.runs, job.missed, job.errors, job.max_jitter))
+        return "\n".join(lines)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding=utf-8
+import weakref
+
+from src.app import vs, bot
+from src.bot.outbox import NORMAL, LOW
+from src.cdr import CdrRecord, merge
+from src.digest import Digest
+from src.events import EventBus, CallStarted, CallConnected, CallEnded, RegistrationLost, GatewayRecovered, \
+    SmsReceived, BLOCK, DROP_OLDEST
+from src.metrics import Metrics
+from src.utils import random_list_item, seconds_to_time_str
+
+
+class TelegramSink:
+    """Bot messages of the events. The call progress is a single message edited as the call goes on."""
+    RECOVERED_MESSAGES = {
+        "reset_restore": "Дзвонилка <b>працює</b>. Просто крутизна!",
+        "reboot": "Перезавантажено дзвонилку."}
+
+    def __init__(self, lines):
+        self.lines = lines  # returns the current number of lines
+        self._sent = weakref.WeakSet()  # handles of the progress messages which are sent already
+
+    @staticmethod
+    def number(event):
+        return event.number or "'невідомо кого'"
+
+    def call_message(self, event, text, priority=LOW):
+        if self.lines() > 1:  # messages of multi-line callers are prefixed with the line number to tell the calls apart
+            text = "Лінія %d: %s" % (event.line, text)
+        text = text.format(number=self.number(event))
+        msg = event.msg
+        if msg is not None and (msg.resolved() or msg in self._sent):
+            return bot.edit(msg=msg, text=text, priority=priority)
+        if msg is not None:
+            self._sent.add(msg)
+        return bot.send(text=text, priority=priority, handle=msg)
+
+    def __call__(self, event):
+        from src.monitors import LineMonitor
+        if isinstance(event, CallStarted):
+            self.call_message(event, event.status_message)
+        elif isinstance(event, CallConnected):
+            self.call_message(event, "Говоримо з %s" % event.number)
+        elif isinstance(event, CallEnded) and event.source == "poll":
+            if event.ok:
+                duration_str = seconds_to_time_str(event.seconds, no_seconds=(event.seconds > 3600))
+                text = "Дзвоник до %s - %s" % (self.number(event), duration_str)
+            elif event.status_message:
+                text = event.status_message + random_list_item(LineMonitor.ERROR_PHRASES)
+            else:
+                text = "Ймовірно невдалий дзвоник до {number}"
+            self.call_message(event, text, priority=NORMAL)  # the final call result is more important than its progress
+        elif isinstance(event, RegistrationLost):
+            if event.fixing:
+                add_status = "\n%s\n" % event.status if event.status else ""
+                bot.send("Дзвонилка <b>не фуричить</b>.%sЗапущена вже %s\nНаговорили %s\nПереналаштовую..." %
+                         (add_status, seconds_to_time_str(event.uptime_seconds),
+                          seconds_to_time_str(event.talk_seconds)))
+            else:
+                bot.send("Дзвонилка <b>не працює</b>. Спробую ще пізніше.")
+        elif isinstance(event, GatewayRecovered):
+            bot.send(self.RECOVERED_MESSAGES[event.kind])
+        elif isinstance(event, SmsReceived):
+            bot.send("Отримано СМС від %s\n%s" % (event.sender, event.text), escape=True)
+
+
+def store(event):
+    """Call history and the daily counters"""
+    if event.source == "cdr":
+        merge(CdrRecord(event.line, event.started, event.number, event.seconds))  # might be the call seen already
+        return
+    # the history is also used to tell the calls missed by the polls from the detected ones
+    vs.add_call(event.started, event.number, event.seconds, event.ok, line=event.line)
+    Digest.call(event.line, event.seconds, event.ok)
+
+
+def count(event):
+    if isinstance(event, SmsReceived):
+        Metrics.inc("goip_sms_received_total")
+    elif event.source == "poll":  # the calls taken from the call records are counted once they are merged
+        Metrics.inc("goip_calls_total", line=event.line, result="ok" if event.ok else "failed")
+        if event.ok:
+            Metrics.inc("goip_call_seconds_total", event.seconds, line=event.line)
+
+
+def subscribe_sinks(lines):
+    """Subscribes the consumers of the events. Storage and Telegram ones must not lose the events, so the publisher
+    waits for them a bit when their queues are full. Metrics are the least important - the oldest ones are dropped
+    """
+    EventBus.subscribe("telegram", TelegramSink(lines), [CallStarted, CallConnected, CallEnded, RegistrationLost,
+                                                         GatewayRecovered, SmsReceived], policy=BLOCK)
+    EventBus.subscribe("storage", store, [CallEnded], policy=BLOCK)
+    EventBus.subscribe("metrics", count, [CallEnded, SmsReceived], policy=DROP_OLDEST)
@@ -3,16 +3,19 @@
 import atexit
 import multiprocessing
 import re
-import requests
+import threading
 import xml.etree.ElementTree as ET
 
 from datetime import datetime
 from random import randint
-from smpplib import client as smpp_client, gsm, consts, exceptions
+from src.app import bot
 from src.const import SMPP_USER, SMPP_PORT, SMPP_SECRET, SENDER_PHONE, USSD_YEARLY_STATUS,\
-    USSD_MONTHLY_STATUS, USSD_GENERAL_STATUS
-from src.bot.common import bot
-from src.utils import retry, current_time, log, sleep
+    USSD_MONTHLY_STATUS, USSD_GENERAL_STATUS, HTTP_TIMEOUT_SECONDS, USSD_DEADLINE_SECONDS
+from src.digest import Digest
+from src.events import EventBus, SmsReceived
+from src.metrics import Metrics, timed
+from src.resilience import retry, breaker, CircuitOpen, DeadlineExceeded
+from src.utils import current_time, log, sleep
 
 
 def decode_msg(msg, encoding="utf-16be"):
@@ -32,7 +35,7 @@ def process_received_msg(pdu):
         content = decode_msg(pdu.message_payload)
     content = content or "<empty>"
     log.info("[Process Received SMS] Message from: %s, content: %s" % (frm, content))
-    bot.send("Отримано СМС від %s\n%s" % (frm, content), escape=True)
+    EventBus.publish(SmsReceived(frm, content))  # handled in the listener process which got it
 
 
 def process_sent_msg(pdu):
@@ -47,17 +50,22 @@ def process_sent_msg(pdu):
 
 class Sms:
     _all_processes = []
+    # GoIP keeps the single USSD per line (the key of the last one), so the USSDs of the line are sent one by one
+    _ussd_locks = {}
+    _ussd_locks_lock = threading.Lock()
     CHECK_STATUS = '%s/default/en_US/send_status.xml?u=%s&p=%s'
     SEND_USSD = 'http://%s:%s@%s/default/en_US/sms_info.html?type=ussd'
+    SEND_SMS = '%s/default/en_US/send.html'
 
-    def __init__(self, url, uname, pwd, notify_module_is_up=False):
+    def __init__(self, url, uname, pwd, notify_module_is_up=False, notify_module_is_down=True):
         self.url = url
         self.ip = url.split('://')[1] if url.startswith('http') else url
         self.uname = uname
         self.pwd = pwd
         log.info("[SMS Monitoring] Started")
+        from smpplib import client as smpp_client, exceptions
         try:
-            client = smpp_client.Client(self.ip, SMPP_PORT)
+            client = smpp_client.Client(self.ip.split(":")[0], SMPP_PORT)  # IP might have the web UI port
             client.set_message_received_handler(lambda pdu: process_received_msg(pdu))
             client.set_message_sent_handler(lambda pdu: process_sent_msg(pdu))
             client.connect()
@@ -71,11 +79,16 @@ class Sms:
                 bot.send("СМС моніторинг працює")
             self.client = client
         except exceptions.ConnectionError as e:
-            bot.send("СМС моніторинг не працює.")
+            if notify_module_is_down:
+                bot.send("СМС моніторинг не працює.")
             raise Exception("SMS module is down", e)
 
-    def send_sms(self, num, msg):
-        log.info("[Send SMS] Number '%s', message '%s'" % (num, msg))
+    @timed("smpp.send_sms")
+    def send_sms(self, num, msg, line=None):
+        log.info("[Send SMS] Number '%s', message '%s', line '%s'" % (num, msg, line or "any"))
+        if line:  # SMPP leaves the line choice to the GoIP, so use its HTTP API to send through the specific one
+            return self.send_line_sms(num, msg, line)
+        from smpplib import gsm, consts
         # Two parts, UCS2, SMS with UDH
         parts, encoding_flag, msg_type_flag = gsm.make_parts(msg)
         for part in parts:
@@ -90,35 +103,59 @@ class Sms:
                 registered_delivery=True,
             )
             log.debug("[Send SMS] PDU Sequence # %d" % pdu.sequence)
-        bot.send("Надсилаю СМС до %s\n%s" % num, msg)
-
-    def send_ussd(self, num, bot_msg=False):
+        bot.send("Надсилаю СМС до %s\n%s" % (num, msg))
+
+    @timed("http.send_sms")
+    def send_line_sms(self, num, msg, line):
+        import requests
+        with breaker("goip.http"):
+            result = requests.get(self.SEND_SMS % self.url, timeout=HTTP_TIMEOUT_SECONDS,
+                                  params={'u': self.uname, 'p': self.pwd, 'l': line, 'n': num, 'm': msg})
+        log.info("[Send SMS] Line %d response: %s" % (line, result.text.strip()))
+        bot.send("Надсилаю СМС до %s (лінія %d)\n%s" % (num, line, msg))
+
+    @timed("http.ussd_send")
+    def send_ussd(self, num, bot_msg=False, line=1):
+        import requests
         if bot_msg:
             bot.send("Надсилаю USSD: %s" % num)
         key = '%d' % randint(10000, 1000000)
-        requests.post(
-            url=self.SEND_USSD % (self.uname, self.pwd, self.ip),
-            data={'line1': '1', 'smskey': key, 'action': 'USSD', 'telnum': num, 'send': 'Send'}
-        )
-        return self.process_ussd_response(num, key)
-
-    @retry(tries=10, delay=2, backoff=1)
-    def process_ussd_response(self, num, key):
-        result = requests.get(self.CHECK_STATUS % (self.url, self.uname, self.pwd))
+        with self.ussd_lock(line):
+            with breaker("goip.http"):
+                requests.post(
+                    url=self.SEND_USSD % (self.uname, self.pwd, self.ip), timeout=HTTP_TIMEOUT_SECONDS,
+                    data={'line%d' % line: '1', 'smskey': key, 'action': 'USSD', 'telnum': num, 'send': 'Send'}
+                )
+            return self.process_ussd_response(num, key, line=line)
+
+    @classmethod
+    def ussd_lock(cls, line):
+        with cls._ussd_locks_lock:
+            return cls._ussd_locks.setdefault(line, threading.Lock())
+
+    @timed("http.ussd_response")
+    @retry("goip.http", tries=10, delay=2, backoff=1, retry_if=lambda response: response is None)
+    def process_ussd_response(self, num, key, line=1):
+        import requests
+        result = requests.get(self.CHECK_STATUS % (self.url, self.uname, self.pwd), timeout=HTTP_TIMEOUT_SECONDS)
         xml = ET.fromstring(result.content)
-        id = xml.findall("id1")[0].text
+        id = xml.findall("id%d" % line)[0].text
         if id != key:
             raise Exception("Didn't find the proper key in the USSD response (expected='%s', got='%s')" % (key, id))
-        status = xml.findall("status1")[0].text.strip()
-        log.info("[USSD Response] Status of '%s' USSD code is '%s'" % (num, status))
+        status = xml.findall("status%d" % line)[0].text.strip()
+        log.info("[USSD Response] Status of '%s' USSD code on line %d is '%s'" % (num, line, status))
         if status == "DONE":
-            response = xml.findall("error1")[0].text
+            response = xml.findall("error%d" % line)[0].text
             if "GSM_LOGOUT" in response:
                 raise Exception("GSM module is not ready yet")
             log.info("[USSD Response] Received: %s" % response)
             return response
         log.info("[USSD Response] Waiting for the USSD response")
 
+    def alive(self):
+        """Liveness probe: listener process is running. No PDUs are sent - the socket is shared with the listener"""
+        return bool(self._all_processes) and all(process.is_alive() for process in self._all_processes)
+
     def close(self, force=False):
         if not self._all_processes:
             return
@@ -132,6 +169,7 @@ class Sms:
         log.info("[Close] Terminating processes for SMS monitoring")
         for process in self._all_processes:
             process.terminate()
+        del self._all_processes[:]  # the list is shared, so the next session doesn't see the terminated ones
 
 
 class SmsWrapper:
@@ -139,11 +177,13 @@ class SmsWrapper:
     _inited = False
 
     @classmethod
-    def init(cls, url, uname, pwd, notify_module_is_up=False):
+    def init(cls, url, uname, pwd, notify_module_is_up=False, notify_module_is_down=True):
         cls.kill()
         try:
-            cls.sms = Sms(url, uname, pwd, notify_module_is_up=notify_module_is_up)
+            cls.sms = Sms(url, uname, pwd, notify_module_is_up=notify_module_is_up,
+                          notify_module_is_down=notify_module_is_down)
             cls._inited = True
+            Metrics.set("goip_smpp_bound", 1)
         except Exception as e:
             log.error(e)
 
@@ -151,8 +191,13 @@ class SmsWrapper:
     def inited(cls):
         return cls._inited
 
+    @classmethod
+    def alive(cls):
+        return cls.inited() and cls.sms.alive()
+
     @classmethod
     def kill(cls, force=False):
+        Metrics.set("goip_smpp_bound", 0)
         if cls.inited():
             cls._inited = False
         if cls.sms:
@@ -163,23 +208,27 @@ class SmsWrapper:
 atexit.register(SmsWrapper.kill, True)
 
 
-@retry(tries=3)
-def ussd_if_possible(code):
-    return SmsWrapper.sms.send_ussd(code)
+@retry("goip.http", tries=3, delay=3, retry_if=lambda response: response is None, deadline=USSD_DEADLINE_SECONDS)
+def ussd_if_possible(code, line=1):
+    return SmsWrapper.sms.send_ussd(code, line=line)
 
 
-def send_sms(num, msg):
+def send_sms(num, msg, line=None):
     if not SmsWrapper.inited():
         log.error("[Send SMS] Not able to send SMS to '%s' as SMS module is down" % num)
         return None
-    return SmsWrapper.sms.send_sms(num=num, msg=msg)
+    return SmsWrapper.sms.send_sms(num=num, msg=msg, line=line)
 
 
-def parse_ussd(code, regex, default=None):
+def parse_ussd(code, regex, default=None, line=1):
     if not SmsWrapper.inited():
         log.error("[Parse USSD] Not able to call USSD '%s' as SMS module is down" % code)
         return None
-    string = ussd_if_possible(code)
+    try:
+        string = ussd_if_possible(code, line=line)
+    except (CircuitOpen, DeadlineExceeded) as e:  # GoIP is down - fail fast rather than wait for it
+        log.error("[Parse USSD] USSD '%s' is not sent: %s" % (code, e))
+        return default
     if not string:
         log.error("[Parse USSD] Nothing returned from USSD command: %s" % code)
         return default
@@ -199,28 +248,34 @@ MONTHLY_STATUS_REGEX = ".*? ([\\d]*) hv.*?Diie do ([\\d]{1,2}.[\\d]{1,2}.[\\d]{2
 BALANCE_REGEX = ".*? ([0-9.]*) grn. Tar[iy]{1}f '(.*?)'.*? do ([\\d]{1,2}.[\\d]{1,2}.[\\d]{4})"
 
 
-def yearly_status():
-    has_status, valid_till = parse_ussd(USSD_YEARLY_STATUS, YEARLY_STATUS_REGEX, [False, None])
+def yearly_status(line=1):
+    has_status, valid_till = parse_ussd(USSD_YEARLY_STATUS, YEARLY_STATUS_REGEX, [False, None], line=line)
     if has_status:
         log.info("[Yearly status] Found information: valid till '%s'" % valid_till)
         valid_till = datetime.strptime(valid_till, "%d.%m.%y")
+        Digest.yearly_sampled(line, valid_till)
     return has_status, valid_till
 
 
-def monthly_status():
-    has_status, minutes_left, valid_till = parse_ussd(USSD_MONTHLY_STATUS, MONTHLY_STATUS_REGEX, [False, None, None])
+def monthly_status(line=1):
+    has_status, minutes_left, valid_till = parse_ussd(USSD_MONTHLY_STATUS, MONTHLY_STATUS_REGEX, [False, None, None],
+                                                      line=line)
     valid_days = 0
     if has_status:
         log.info("[Monthly status] Found information: minutes left '%s', valid till '%s'" % (minutes_left, valid_till))
         valid_till_date = datetime.strptime(valid_till, "%d.%m.%y")
         valid_days = (valid_till_date - current_time()).days
+        Digest.monthly_sampled(line, minutes_left, valid_days)
     return has_status, minutes_left, valid_days
 
 
-def balance():
-    has_status, money, tariff, valid_till = parse_ussd(USSD_GENERAL_STATUS, BALANCE_REGEX, [False, 0, None, None])
+def balance(line=1):
+    has_status, money, tariff, valid_till = parse_ussd(USSD_GENERAL_STATUS, BALANCE_REGEX, [False, 0, None, None],
+                                                       line=line)
     if has_status:
         log.info("[Balance] Found information: money '%s', tariff '%s', valid till '%s'" % (money, tariff, valid_till))
         money = float(money)
+        Metrics.set("goip_balance_uah", money, line=line)
         valid_till = datetime.strptime(valid_till, "%d.%m.%Y")
+        Digest.balance_sampled(line, money, tariff, valid_till)
     return has_status, money, tariff, valid_till
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.metrics import Metrics
+from src.utils import log
+
+# the startup time is measured from the moment the application modules are imported
+PROCESS_STARTED = time.monotonic()
+
+
+class Startup:
+    """Dependency graph of the initialization steps. Each step starts in its own thread as soon as the steps
+    it depends on are done, so the independent I/O waits (browser login, SMPP bind, DB, Telegram) overlap.
+    If the step fails, the steps depending on it are skipped and the first error is raised once the rest are done.
+    The steps forking the processes (SMPP listener) run on the calling thread rather than in the pool: they start
+    once the ready pool steps are submitted, so the pool threads are just starting rather than deep in their work.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.steps = {}  # name => (func, dependencies, whether it runs on the calling thread)
+        self.timings = {}  # name => (started offset, duration)
+        self.skipped = []
+
+    def add(self, name, func, after=(), on_caller=False):
+        self.steps[name] = (func, tuple(after), on_caller)
+        return self
+
+    def _run_step(self, name, started):
+        step_started = time.monotonic()
+        try:
+            return self.steps[name][0]()
+        finally:
+            duration = time.monotonic() - step_started
+            self.timings[name] = (step_started - started, duration)
+            Metrics.record("startup.%s" % name, duration)
+
+    def run(self):
+        started = time.monotonic()
+        done, failed, errors = set(), set(), []
+        running = {}
+        with ThreadPoolExecutor(max_workers=len(self.steps) or 1, thread_name_prefix="Startup") as executor:
+            while True:
+                on_caller = []
+                for name, (_, after, caller) in self.steps.items():
+                    if name in done or name in failed or name in running.values():
+                        continue
+                    if any(dep in failed for dep in after):
+                        failed.add(name)
+                        self.skipped.append(name)
+                    elif all(dep in done for dep in after):
+                        if caller:
+                            on_caller.append(name)
+                        else:
+                            running[executor.submit(self._run_step, name, started)] = name
+                for name in on_caller:
+                    try:
+                        self._run_step(name, started)
+                        done.add(name)
+                    except Exception as e:
+                        log.error("[Startup] %s: step '%s' failed: %s" % (self.name, name, e))
+                        failed.add(name)
+                        errors.append(e)
+                if on_caller:
+                    continue  # the steps depending on them might be ready now
+                if not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception():
+                        log.error("[Startup] %s: step '%s' failed: %s" % (self.name, name, future.exception()))
+                        failed.add(name)
+                        errors.append(future.exception())
+                    else:
+                        done.add(name)
+        self.ready_in = time.monotonic() - started
+        Metrics.record("startup.%s.ready" % self.name, self.ready_in)
+        log.info("[Startup] %s %s in %.2f sec: %s" % (self.name, "failed" if errors else "ready", self.ready_in,
+                                                      self.summary()))
+        if errors:
+            raise errors[0]
+        return self
+
+    def summary(self):
+        items = ["%s %.2f (+%.2f)" % (name, duration, offset)
+                 for name, (offset, duration) in sorted(self.timings.items(), key=lambda item: item[1][0])]
+        if self.skipped:
+            items.append("skipped: %s" % ", ".join(self.skipped))
+        return ", ".join(items)
+
+
+def seconds_since_start():
+    return time.monotonic() - PROCESS_STARTED
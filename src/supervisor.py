@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from src.const import SUPERVISOR_CHECK_SECONDS, SUPERVISOR_RESTART_BUDGET, SUPERVISOR_BUDGET_WINDOW_SECONDS
+from src.metrics import Metrics
+from src.utils import log
+
+
+class Component:
+    def __init__(self, name, probe, restart, budget, window):
+        self.name = name
+        self.probe = probe  # returns True while the component is alive
+        self.restart = restart
+        self.budget = budget
+        self.window = window
+        self.failed_at = None  # when the failure was noticed, None while the component is alive
+        self.restarts = deque()  # times of the restarts within the budget window
+        self.recoveries = []  # seconds it took to recover
+        self.budget_notified = False
+
+    def alive(self):
+        try:
+            return bool(self.probe())
+        except Exception as e:
+            log.error("[Supervisor] Probe of '%s' failed: %s" % (self.name, e))
+            return False
+
+    def budget_left(self, now):
+        while self.restarts and now - self.restarts[0] > self.window:
+            self.restarts.popleft()
+        return self.budget - len(self.restarts)
+
+    def mttr(self):
+        return sum(self.recoveries) / len(self.recoveries) if self.recoveries else None
+
+
+class Supervisor:
+    """Watches the long-living components (PhantomJS driver, SMPP session) with the liveness probes and restarts
+    only the one which failed, while the rest keeps running. Restarts are limited by the budget per time window,
+    so the component which can't recover (e.g. GoIP is down) doesn't end up restarted in a loop.
+    """
+    _components = {}
+    _lock = threading.RLock()  # checks are serialised, so the component isn't restarted twice at once
+    _suspend_lock = threading.Lock()  # separate one as the restart in progress might wait for the suspended body
+    _suspended = 0
+    _thread = None
+
+    @classmethod
+    def register(cls, name, probe, restart, budget=SUPERVISOR_RESTART_BUDGET, window=SUPERVISOR_BUDGET_WINDOW_SECONDS):
+        with cls._lock:
+            cls._components[name] = Component(name, probe, restart, budget, window)
+
+    @classmethod
+    @contextmanager
+    def suspended(cls, reason):
+        """The components are expected to be down in the body (e.g. the caller is rebooted), so no checks are done"""
+        with cls._suspend_lock:
+            cls._suspended += 1
+        log.info("[Supervisor] Suspended: %s" % reason)
+        try:
+            yield
+        finally:
+            with cls._suspend_lock:
+                cls._suspended -= 1
+            for component in list(cls._components.values()):
+                component.failed_at = None  # the downtime in the body is not the failure
+
+    @classmethod
+    def check(cls, name=None):
+        """Probes the components (all or the named one) and restarts the failed ones. Returns True if all are alive"""
+        with cls._lock:
+            components = [cls._components[name]] if name else list(cls._components.values())
+            return all([cls._check(component) for component in components])
+
+    @classmethod
+    def _check(cls, component):
+        if cls._suspended or component.alive():
+            return True
+        now = time.monotonic()
+        if component.failed_at is None:
+            component.failed_at = now
+            log.error("[Supervisor] Component '%s' is down" % component.name)
+            Metrics.inc("goip_component_failures_total", component=component.name)
+        if component.budget_left(now) <= 0:
+            if not component.budget_notified:
+                component.budget_notified = True
+                log.error("[Supervisor] Restart budget of '%s' is exhausted (%d in %d sec)" %
+                          (component.name, component.budget, component.window))
+                from src.app import bot
+                bot.send("Не вдається перезапустити %s. Спробую ще пізніше." % component.name)
+            return False
+        component.restarts.append(now)
+        log.warning("[Supervisor] Restarting '%s' (%d restart(s) left)" %
+                    (component.name, component.budget_left(now)))
+        Metrics.inc("goip_component_restarts_total", component=component.name)
+        try:
+            component.restart()
+        except Exception as e:
+            log.error("[Supervisor] Restart of '%s' failed: %s" % (component.name, e))
+            return False
+        if not component.alive():
+            return False
+        recovered_in = time.monotonic() - component.failed_at
+        component.failed_at = None
+        component.budget_notified = False
+        component.recoveries.append(recovered_in)
+        Metrics.record("supervisor.recovery.%s" % component.name, recovered_in)
+        log.info("[Supervisor] Component '%s' recovered in %.1f sec (MTTR %.1f sec)" %
+                 (component.name, recovered_in, component.mttr()))
+        return True
+
+    @classmethod
+    def _run(cls, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                cls.check()
+            except Exception as e:
+                log.error("[Supervisor] Check failed: %s" % e)
+
+    @classmethod
+    def start(cls, interval=SUPERVISOR_CHECK_SECONDS):
+        if cls._thread is None:
+            cls._thread = threading.Thread(target=cls._run, args=(interval, ), name="Supervisor", daemon=True)
+            cls._thread.start()
+
+    @classmethod
+    def summary(cls):
+        lines = []
+        for component in list(cls._components.values()):  # no lock - the restart in progress might take a while
+            mttr = component.mttr()
+            lines.append("%s: %s, відновлень %d, MTTR %s" % (
+                component.name, "не працює" if component.failed_at is not None else "працює",
+                len(component.recoveries), "%.1f сек" % mttr if mttr is not None else "-"))
+        return "\n".join(lines)
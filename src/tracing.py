@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding=utf-8
+import glob
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from src.const import TRACE_NAME, TRACE_MAX_BYTES, TRACE_BACKUPS, CUR_DIR
+from src.utils import create_file_logger
+
+
+class Span:
+    __slots__ = ("name", "started", "duration", "children")
+
+    def __init__(self, name, started):
+        self.name = name
+        self.started = started
+        self.duration = 0.0
+        self.children = []
+
+    def to_list(self, root_started):
+        # compact form: [name, start offset ms, duration ms, [children]]
+        return [self.name, round((self.started - root_started) * 1000, 1), round(self.duration * 1000, 1),
+                [child.to_list(root_started) for child in self.children]]
+
+
+class Tracer:
+    """Spans of the single monitor cycle (or bot request) are collected in memory and written
+    as one JSON line to the rotating trace file once the cycle is over.
+    Spans opened outside of a trace (no active root span in the thread) are ignored.
+    """
+    enabled = bool(TRACE_NAME)
+    _local = threading.local()
+    _logger = None
+
+    @classmethod
+    def _writer(cls):
+        if cls._logger is None:  # written off the monitor thread like the regular log
+            cls._logger = create_file_logger("Goip Trace", TRACE_NAME, TRACE_MAX_BYTES, TRACE_BACKUPS)
+        return cls._logger
+
+    @classmethod
+    def start(cls, name):
+        """Opens the child span of the current one. Returns None if there is no active trace."""
+        stack = getattr(cls._local, "stack", None)
+        if not stack:
+            return None
+        span = Span(name, time.perf_counter())
+        stack[-1].children.append(span)
+        stack.append(span)
+        return span
+
+    @classmethod
+    def finish(cls, span, duration):
+        span.duration = duration
+        stack = cls._local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    @classmethod
+    def begin(cls, name):
+        """Opens the root span of the new trace in the current thread."""
+        if not cls.enabled or getattr(cls._local, "stack", None):
+            return None
+        root = Span(name, time.perf_counter())
+        cls._local.stack = [root]
+        cls._local.wall_started = time.time()
+        return root
+
+    @classmethod
+    def end(cls, root, **attrs):
+        if root is None:
+            return
+        root.duration = time.perf_counter() - root.started
+        cls._local.stack = None
+        entry = dict(attrs, ts=round(cls._local.wall_started, 3), span=root.to_list(root.started))
+        cls._writer().info(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+
+
+@contextmanager
+def trace(name, **attrs):
+    """Wraps the whole monitor cycle (or bot request) into the root span."""
+    root = Tracer.begin(name)
+    try:
+        yield
+    finally:
+        Tracer.end(root, **attrs)
+
+
+def read_traces(filename):
+    # rotated files go first as they are older
+    for name in sorted(glob.glob(filename + ".*"), reverse=True) + [filename]:
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def collapse(span, prefix, totals):
+    name, _, duration, children = span
+    path = "%s;%s" % (prefix, name) if prefix else name
+    total, own = totals.get(path, (0.0, 0.0))
+    totals[path] = (total + duration, own + duration - sum(child[2] for child in children))
+    for child in children:
+        collapse(child, path, totals)
+
+
+def print_span(span, indent=0):
+    name, offset, duration, children = span
+    print("%s%-40s +%8.1f ms %8.1f ms" % ("  " * indent, name, offset, duration))
+    for child in children:
+        print_span(child, indent + 1)
+
+
+def summarise(filename, top=5, folded=False):
+    traces = list(read_traces(filename))
+    if not traces:
+        print("No traces found in '%s'" % filename)
+        return
+    totals = {}
+    for entry in traces:
+        collapse(entry["span"], "", totals)
+    if folded:  # input for flamegraph.pl and alike: "path;to;span self-time-ms"
+        for path, (_, own) in sorted(totals.items()):
+            print("%s %d" % (path, round(own)))
+        return
+    print("Traces: %d\n\nSlowest %d:" % (len(traces), top))
+    for entry in sorted(traces, key=lambda e: e["span"][2], reverse=True)[:top]:
+        print("\n%s" % time.strftime("%d.%m.%Y %H:%M:%S", time.localtime(entry["ts"])))
+        print_span(entry["span"])
+    print("\nBreakdown (total ms / self ms / share of all traces):")
+    overall = sum(entry["span"][2] for entry in traces) or 1
+    for path, (total, own) in sorted(totals.items(), key=lambda item: item[1][1], reverse=True):
+        print("%-60s %10.1f %10.1f %5.1f%%" % (path, total, own, 100 * own / overall))
+
+
+if __name__ == '__main__':
+    # python -m src.tracing [trace-file] [slowest-amount | --folded]
+    args = sys.argv[1:]
+    summarise(args[0] if args else "{0}/{1}".format(CUR_DIR, TRACE_NAME),
+              top=int(args[1]) if len(args) > 1 and args[1].isdigit() else 5, folded="--folded" in args)
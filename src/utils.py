@@ -1,27 +1,208 @@
 #!/usr/bin/env python
 # coding=utf-8
+import json
+import os
+import queue
+import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime
-from logging import StreamHandler
-from logging.handlers import TimedRotatingFileHandler
+from logging import StreamHandler, Formatter, Filter, DEBUG, makeLogRecord, getLogger
+from logging.handlers import TimedRotatingFileHandler, RotatingFileHandler, QueueHandler, QueueListener
 from random import randint
 from functools import wraps
 
-from src.const import LOG_LEVEL, LOG_NAME, CUR_DIR
+from src.const import LOG_LEVEL, LOG_NAME, LOG_FORMAT, CUR_DIR, IP, LOG_SITE_RATE, LOG_SITE_BURST, \
+    LOG_REPEAT_SUMMARY_SECONDS
 
+LOG_TEXT_FORMAT = "%(asctime)s [%(threadName)-12.12s] %(message)s"
 
-def set_log_level():
-    import logging as log
+# structured fields each log record carries (when known) - set with log_context() or passed with extra={...}
+LOG_FIELDS = ("gateway", "line", "state", "duration")
+
+_log_context = threading.local()
+
+
+@contextmanager
+def log_context(**fields):
+    """Adds the fields to all the records logged by the current thread inside the block."""
+    previous = getattr(_log_context, "fields", {})
+    _log_context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _log_context.fields = previous
+
+
+class ContextFilter(Filter):
+    def filter(self, record):
+        record.gateway = IP
+        for key, value in getattr(_log_context, "fields", {}).items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class LogSite:
+    def __init__(self, burst):
+        self.message = None
+        self.record = None
+        self.repeats = 0
+        self.suppressed = 0
+        self.summary_at = time.monotonic()
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+
+class RepeatFilter(Filter):
+    """Collapses identical consecutive messages of the same line of code into "repeated N times" summaries
+    and limits the amount of the different messages each line of code could log (excess is only counted).
+    """
+    def __init__(self, handler, rate=LOG_SITE_RATE, burst=LOG_SITE_BURST, summary_seconds=LOG_REPEAT_SUMMARY_SECONDS):
+        super().__init__()
+        self.handler = handler
+        self.rate = rate
+        self.burst = burst
+        self.summary_seconds = summary_seconds
+        self.sites = {}
+        self._lock = threading.Lock()
+        # the forked process (SMPP listener) could get the lock held by the other thread
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reinit_lock)
+
+    def reinit_lock(self):
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if getattr(record, "aggregated", False):
+            return True
+        message = record.getMessage()
+        now = time.monotonic()
+        with self._lock:
+            site = self.sites.get((record.pathname, record.lineno))
+            if site is None:
+                site = self.sites[(record.pathname, record.lineno)] = LogSite(self.burst)
+            if message == site.message:
+                site.repeats += 1
+                site.record = record
+                if now - site.summary_at < self.summary_seconds:
+                    return False
+                summary = self._summary(site, now)  # long outage - let them know it's still repeating
+                site.repeats = 0
+                self._emit(summary)
+                return False
+            summary = self._summary(site, now)
+            site.tokens = min(self.burst, site.tokens + (now - site.updated_at) * self.rate)
+            site.updated_at = now
+            if site.tokens < 1:
+                site.suppressed += 1
+                passed = False
+            else:
+                site.tokens -= 1
+                site.message, site.record, site.repeats = message, record, 0
+                if site.suppressed:
+                    record.msg, record.args = "%s [%d similar messages suppressed]" % (message, site.suppressed), None
+                    site.suppressed = 0
+                passed = True
+        self._emit(summary)
+        return passed
+
+    def _summary(self, site, now):
+        if not site.repeats:
+            return None
+        site.summary_at = now
+        summary = makeLogRecord(site.record.__dict__)
+        summary.msg, summary.args = "%s [repeated %d times]" % (site.message, site.repeats), None
+        summary.aggregated = True
+        return summary
+
+    def _emit(self, summary):
+        if summary is not None:
+            self.handler.handle(summary)
+
+    def flush(self):
+        """Writes the summaries of all the repeats not reported yet."""
+        now = time.monotonic()
+        with self._lock:
+            summaries = [self._summary(site, now) for site in self.sites.values()]
+            for site in self.sites.values():
+                site.repeats = 0
+        for summary in summaries:
+            self._emit(summary)
+
+
+class JsonFormatter(Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "thread": record.threadName,
+                 "message": record.getMessage()}
+        entry.update({field: getattr(record, field) for field in LOG_FIELDS if getattr(record, field, None) is not None})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class AsyncQueueHandler(QueueHandler):
+    """Passes the records to the QueueListener thread, so the log I/O is done off the calling threads.
+    Forked processes (SMPP listener) do not have the listener thread, so they write to the handlers directly.
+    """
+    def __init__(self, handlers):
+        super().__init__(queue.Queue(-1))
+        self.pid = os.getpid()
+        self.handlers = handlers
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        self.listening = True
+
+    def emit(self, record):
+        if os.getpid() == self.pid:
+            return super().emit(record)
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def close(self):
+        # called by logging.shutdown() on exit - the queued records are written before the handlers are closed
+        if self.listening and os.getpid() == self.pid:
+            self.listening = False
+            self.listener.stop()
+        super().close()
+
+
+def create_log_handlers(filename, log_format=LOG_FORMAT):
+    formatter = JsonFormatter() if log_format == "json" else Formatter(LOG_TEXT_FORMAT)
     sh = StreamHandler()
     sh.setLevel(LOG_LEVEL)  # output to console with specified LOG LEVEL
-    fh = TimedRotatingFileHandler("{0}/{1}".format(CUR_DIR, LOG_NAME), when="d", interval=15, backupCount=3)
-    fh.setLevel(log.DEBUG)  # output to file with DEBUG log level always
+    fh = TimedRotatingFileHandler(filename, when="d", interval=15, backupCount=3)
+    fh.setLevel(DEBUG)  # output to file with DEBUG log level always
+    for handler in [sh, fh]:
+        handler.setFormatter(formatter)
+    return [sh, fh]
+
+
+def create_file_logger(name, filename, max_bytes, backups):
+    """Logger writing the plain messages to the separate size-rotated file off the calling thread."""
+    handler = RotatingFileHandler("{0}/{1}".format(CUR_DIR, filename), maxBytes=max_bytes, backupCount=backups)
+    handler.setFormatter(Formatter("%(message)s"))
+    queue_handler = AsyncQueueHandler([handler])
+    queue_handler.setFormatter(Formatter("%(message)s"))
+    logger = getLogger(name)
+    logger.propagate = False
+    logger.setLevel(DEBUG)
+    logger.addHandler(queue_handler)
+    return logger
+
+
+def set_log_level():
+    import logging as log
+    qh = AsyncQueueHandler(create_log_handlers("{0}/{1}".format(CUR_DIR, LOG_NAME)))
+    qh.setFormatter(Formatter("%(message)s"))  # the actual formatting is done by the handlers behind the queue
+    qh.addFilter(ContextFilter())
+    if LOG_LEVEL != "DEBUG":  # full fidelity when debugging
+        qh.addFilter(RepeatFilter(qh))
     log.basicConfig(
         level=log.NOTSET,
-        format="%(asctime)s [%(threadName)-12.12s] %(message)s",
         handlers=[
-            sh,
-            fh
+            qh
         ])
     return log.getLogger("Goip Monitor")
 
@@ -29,16 +210,27 @@ def set_log_level():
 log = set_log_level()
 
 
+def flush_log_repeats():
+    for f in log.root.handlers[0].filters if log.root.handlers else []:
+        if isinstance(f, RepeatFilter):
+            f.flush()
+
+
 def passed_more_that_sec(time_from, sec):
     return time_from and sec and (current_time() - time_from).seconds > sec
 
 
+class Clock:
+    """Source of the current time - replaced by the virtual clock when the recorded line states are replayed."""
+    now = datetime.now
+
+
 def current_time():
-    return datetime.now()
+    return Clock.now()
 
 
 def current_date():
-    return datetime.today()
+    return Clock.now()
 
 
 def sleep(seconds, print_log=True):
@@ -79,44 +271,11 @@ def safe(msg=None):
                     log.error("[Safe] Exception occurred while running safe() method:")
                     log.error(e)
                     if msg:
-                        from src.bot.common import bot
-                        bot.send(msg)
+                        from src.app import bot
+                        from src.bot.outbox import HIGH
+                        bot.send(msg, priority=HIGH)
                 except Exception as e1:
                     log.error("[Safe] Some really bad exception has happened while handling method exception:")
                     log.error(e1)
         return f_safe  # true decorator
     return deco_safe
-
-
-def retry(ex=None, tries=4, delay=3, backoff=2):
-    """Retry calling the decorated function using an exponential backoff.
-    :param tries: number of times to try (not retry) before giving up
-    :type tries: int
-    :param delay: initial delay between retries in seconds
-    :type delay: int
-    :param backoff: backoff multiplier e.g. value of 2 will double the delay
-        each retry
-    :type backoff: int
-    """
-    def deco_retry(f):
-        @wraps(f)
-        def f_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-            res = None
-            while mtries > 1:
-                if ex:
-                    try:
-                        return f(*args, **kwargs)
-                    except ex:
-                        pass
-                else:
-                    res = f(*args, **kwargs)
-                    if res is not None:
-                        return res
-                log.info("[Retry Deco] Retrying in %d seconds..." % mdelay)
-                time.sleep(mdelay)
-                mtries -= 1
-                mdelay *= backoff
-            return res
-        return f_retry  # true decorator
-    return deco_retry
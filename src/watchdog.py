@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import threading
+import time
+
+from src.const import WATCHDOG_SAMPLE_SECONDS, WATCHDOG_BROWSER_MAX_RSS_MB, WATCHDOG_BROWSER_MAX_CPU_PERCENT, \
+    WATCHDOG_BROWSER_CPU_SAMPLES, WATCHDOG_MIN_RECYCLE_SECONDS
+from src.metrics import Metrics
+from src.utils import log
+
+PROC_STAT = "/proc/%s/stat"
+
+
+def read_stat(pid):
+    """Returns (RSS bytes, CPU seconds spent) of the process read from /proc or None if there is no such process"""
+    try:
+        with open(PROC_STAT % pid) as f:
+            stat = f.read()
+    except OSError:
+        return None
+    fields = stat.rsplit(")", 1)[1].split()  # command name might have spaces, so the fields go after it
+    utime, stime, rss_pages = int(fields[11]), int(fields[12]), int(fields[21])
+    return rss_pages * os.sysconf("SC_PAGE_SIZE"), (utime + stime) / os.sysconf("SC_CLK_TCK")
+
+
+def browser_pid():
+    from src.browser import BrowserWrapper
+    b = BrowserWrapper.b
+    try:
+        return b.driver.service.process.pid if b and b.driver else None
+    except AttributeError:
+        return None
+
+
+class Watchdog:
+    """Samples RSS and CPU of the PhantomJS process and the application itself from /proc and exports them
+    as metrics. PhantomJS leaks memory over the long sessions, so once it's over the limits the driver recycle
+    is requested - the monitor loop does it when the lines are idle. Disabled where there is no /proc (Windows, Mac).
+    """
+    enabled = os.path.exists(PROC_STAT % "self")
+    recycle_reason = None  # why the browser should be recycled, None if it shouldn't
+    recycled_at = None
+    _cpu = {}  # process => (CPU seconds, sampled at, pid)
+    _high_cpu_samples = 0
+    _thread = None
+
+    @classmethod
+    def sample_process(cls, name, pid):
+        """Returns (RSS MB, CPU % since the previous sample) and exports them, None if the process is not found"""
+        stat = read_stat(pid)
+        if stat is None:
+            cls._cpu.pop(name, None)
+            return None
+        rss, cpu_seconds = stat
+        now = time.monotonic()
+        previous = cls._cpu.get(name)
+        cls._cpu[name] = (cpu_seconds, now, pid)
+        cpu = 0.0
+        if previous and previous[2] == pid and now > previous[1]:
+            cpu = 100 * (cpu_seconds - previous[0]) / (now - previous[1])
+        Metrics.set("goip_process_rss_bytes", rss, process=name)
+        Metrics.set("goip_process_cpu_percent", round(cpu, 1), process=name)
+        return rss / 1024 / 1024, cpu
+
+    @classmethod
+    def sample(cls):
+        cls.sample_process("python", os.getpid())
+        pid = browser_pid()
+        browser = cls.sample_process("phantomjs", pid) if pid else None
+        if browser is None or cls.recycle_reason:
+            return
+        rss_mb, cpu = browser
+        cls._high_cpu_samples = cls._high_cpu_samples + 1 if cpu > WATCHDOG_BROWSER_MAX_CPU_PERCENT else 0
+        if rss_mb > WATCHDOG_BROWSER_MAX_RSS_MB:
+            cls.recycle_reason = "rss %d MB" % rss_mb
+        elif cls._high_cpu_samples >= WATCHDOG_BROWSER_CPU_SAMPLES:
+            cls.recycle_reason = "cpu %d%% for %d samples" % (cpu, cls._high_cpu_samples)
+        if cls.recycle_reason:
+            log.warning("[Watchdog] PhantomJS is over the limits (%s) - recycle it when idle" % cls.recycle_reason)
+
+    @classmethod
+    def recycle_due(cls):
+        """Returns the reason if the browser should be recycled now"""
+        if not cls.recycle_reason:
+            return None
+        if cls.recycled_at and time.monotonic() - cls.recycled_at < WATCHDOG_MIN_RECYCLE_SECONDS:
+            return None  # the limits are too low for the fresh driver - don't recycle it in a loop
+        return cls.recycle_reason
+
+    @classmethod
+    def recycled(cls):
+        Metrics.inc("goip_browser_recycles_total")
+        cls.recycle_reason = None
+        cls.recycled_at = time.monotonic()
+        cls._high_cpu_samples = 0
+
+    @classmethod
+    def _run(cls, interval):
+        while True:
+            try:
+                cls.sample()
+            except Exception as e:
+                log.error("[Watchdog] Sampling failed: %s" % e)
+            time.sleep(interval)
+
+    @classmethod
+    def start(cls, interval=WATCHDOG_SAMPLE_SECONDS):
+        if not cls.enabled:
+            log.info("[Watchdog] No /proc on this platform - resources are not watched")
+            return
+        if cls._thread is None:
+            cls._thread = threading.Thread(target=cls._run, args=(interval, ), name="Watchdog", daemon=True)
+            cls._thread.start()